@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+modules/address_extract.py — v6.3.0
+單次掃描的取餐/送達地址抽取（取代 app.py v6.2.1 的多次掃描版本，結果相同；
+唯一刻意的差異是「取餐地點」錨點，見第 4 點）：
+1. 每行只做一次正規化（預先編譯的樣式），同一輪找出「送餐資訊」「(O)」「取餐地點」錨點，
+   並記下錨點前後最近的地址樣式行；評分只對候選視窗內的行做。
+2. 之後的候選、回溯、去重複策略都只查這份逐行紀錄，不再重掃 lines。
+3. 回傳 pickup / dropoff 以及依分數排序的候補。
+4. 與舊版不同：含「取餐地點」的行視同 (O) 錨點，地址前的標籤會清掉；「取餐地點：地址」同一行時直接取該行，
+   否則取餐視窗只到「送餐資訊」為止（舊版回傳「取餐地點台南市…」，或視窗跨過錨點取到送達地址）。
+   bench/corpus/ocr_texts.jsonl 以 expected 標記這些樣本，bench.bench_extract 對它們改比 expected，
+   其餘樣本仍須與舊版完全相同。
+"""
+
+import re
+import logging
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = "辨識中/無法擷取"
+UNKNOWN_SAME = "辨識中/無法擷取(疑同送達)"
+
+_TW_CITY = r"(台北市|新北市|桃園市|台中市|台南市|高雄市|基隆市|新竹市|嘉義市|新竹縣|苗栗縣|彰化縣|南投縣|雲林縣|嘉義縣|屏東縣|宜蘭縣|花蓮縣|台東縣|澎湖縣|連江縣|金門縣)"
+_TW_ROAD = r"[^\s\d]+(?:路|街|大道|巷|弄)[^,\s]*"
+_ADDR_LIKE = re.compile(rf"{_TW_CITY}|{_TW_ROAD}|(\d+號)")
+_CITY_RE = re.compile(_TW_CITY)
+_ROAD_RE = re.compile(_TW_ROAD)
+_NO_RE = re.compile(r"\d+號")
+_DIGITS_RE = re.compile(r"\d{3,6}")
+_SPACES_RE = re.compile(r"\s+")
+_NORM_RE = re.compile(r"[\s：:]+")
+_NON_WORD_RE = re.compile(r"[^一-龥a-zA-Z0-9]")
+
+_DROP_ANCHOR = "送餐資訊"
+_PICK_ANCHORS = ("(O)", "O)")
+_PICK_LABEL = "取餐地點"     # 「取餐地點：地址」或單獨一行標題，同 (O) 視為取餐錨點
+_DROP_WINDOW = 4          # 送餐資訊之後幾行
+_DROP_ALT_WINDOW = 5      # 去重複時放寬到幾行
+_PICK_WINDOW = 3          # (O) 之後幾行
+_MIN_SCORE = 3
+
+
+def cleanup_line(s: str) -> str:
+    s = s.strip()
+    s = s.replace("：", ":").replace("公司:", "").replace(_PICK_LABEL, "")  # 去掉常見干擾前綴
+    return _SPACES_RE.sub(" ", s)
+
+def _normalize(s: str) -> str:
+    """與 postal_lookup.normalize_address 結果相同，合併成一次替換"""
+    return _NORM_RE.sub("", s).replace("臺", "台") if s else ""
+
+def same_key(s: str) -> str:
+    """比較兩段地址是否相同用的鍵（只留中英數）"""
+    return _NON_WORD_RE.sub("", _normalize(s))
+
+def score_address(s: str) -> int:
+    """s 需已正規化；城市 3、道路 3、門牌 2、3-6 位數字 1"""
+    score = 0
+    if _CITY_RE.search(s): score += 3
+    if _ROAD_RE.search(s): score += 3
+    if _NO_RE.search(s): score += 2
+    if _DIGITS_RE.search(s): score += 1
+    return score
+
+
+class _Line:
+    """一行 OCR；clean / score / key 用到才算（多數行只需要 addr_like）"""
+    __slots__ = ("raw", "norm", "addr_like", "_clean", "_score")
+
+    def __init__(self, raw: str, norm: str, addr_like: bool):
+        self.raw = raw              # strip 後原文
+        self.norm = norm            # _normalize(raw)
+        self.addr_like = addr_like
+        self._clean: Optional[str] = None
+        self._score = -1
+
+    @property
+    def clean(self) -> str:
+        """等同 normalize_address(cleanup_line(raw))；沒有「公司」「取餐地點」字樣時就是 norm"""
+        if self._clean is None:
+            dirty = "公司" in self.raw or _PICK_LABEL in self.raw
+            self._clean = _normalize(cleanup_line(self.raw)) if dirty else self.norm
+        return self._clean
+
+    @property
+    def score(self) -> int:
+        if self._score < 0:
+            self._score = score_address(self.clean)
+        return self._score
+
+    @property
+    def key(self) -> str:
+        return _NON_WORD_RE.sub("", self.norm)
+
+
+@dataclass
+class AddressResult:
+    pickup: str
+    dropoff: str
+    pickup_alternates: List[str] = field(default_factory=list)
+    dropoff_alternates: List[str] = field(default_factory=list)
+
+    @property
+    def pair(self) -> Tuple[str, str]:
+        return self.pickup, self.dropoff
+
+
+def _scan(ocr_text: str):
+    """單次掃描：逐行紀錄 + 錨點 + 錨點前後最近的地址樣式行"""
+    recs: List[_Line] = []
+    idx_drop = idx_o = -1
+    last_addr = -1              # 目前為止最後一個地址樣式行
+    back_addr = -1              # 送餐資訊之前最後一個地址樣式行
+    left_addr = -1              # (O) 之前最後一個地址樣式行
+    first_addr = -1             # 全文第一個地址樣式行
+    fwd_addr = -1               # 送餐資訊之後第一個地址樣式行
+    for raw in ocr_text.splitlines():
+        ln = raw.strip()
+        if not ln:
+            continue
+        i = len(recs)
+        n = _normalize(ln)
+        addr_like = bool(_ADDR_LIKE.search(n))
+        recs.append(_Line(ln, n, addr_like))
+
+        if idx_drop < 0 and _DROP_ANCHOR in ln.replace(" ", ""):
+            idx_drop, back_addr = i, last_addr
+        elif idx_drop >= 0 and addr_like and fwd_addr < 0:
+            fwd_addr = i
+        if idx_o < 0 and (ln.startswith(_PICK_ANCHORS) or _PICK_LABEL in n):
+            idx_o, left_addr = i, last_addr
+        if addr_like:
+            last_addr = i
+            if first_addr < 0:
+                first_addr = i
+    if idx_drop < 0:
+        fwd_addr = first_addr
+    return recs, idx_drop, idx_o, back_addr, left_addr, fwd_addr
+
+
+def _ranked(cands: Sequence[_Line]) -> List[str]:
+    """依 (分數, 字串) 由高到低；只取分數達門檻者"""
+    return [c.clean for c in sorted(cands, key=lambda c: (c.score, c.clean), reverse=True)
+            if c.score >= _MIN_SCORE]
+
+def _best(cands: Sequence[_Line]) -> Optional[str]:
+    best = None
+    for c in cands:
+        if best is None or (c.score, c.clean) > (best.score, best.clean):
+            best = c
+    return best.clean if best is not None and best.score >= _MIN_SCORE else None
+
+
+def extract(ocr_text: str) -> AddressResult:
+    """
+    明確以「送餐資訊」區塊抽 dropoff；
+    取餐地址優先用 (O) / 取餐地點 行與其後 1-3 行；若缺，再用「送餐資訊」之前最後一個地址樣式行。
+    若兩者相同，啟動候補策略避免重複。
+    """
+    if not ocr_text:
+        return AddressResult(UNKNOWN, UNKNOWN)
+
+    recs, h, o, back, left, fwd = _scan(ocr_text)
+    logger.info("[ADDR] OCR 行數：%d", len(recs))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[ADDR] 片段預覽：%s", [r.raw for r in recs[:8]])
+
+    # 1) 送餐資訊區塊作為 dropoff
+    drop = None
+    drop_win: List[_Line] = []
+    if h >= 0:
+        drop_win = recs[h + 1: h + 1 + _DROP_WINDOW]
+        drop = _best(drop_win)
+        if not drop:
+            # 若 pick_best 失敗，合併看看
+            merged = _normalize(cleanup_line("".join(r.raw for r in drop_win)))
+            if _ADDR_LIKE.search(merged):
+                drop = merged
+
+    # 2) 取餐地址：優先 (O) 起始行之後 1-3 行；(O) 行本身有時包含地址
+    #    「取餐地點」行：該行本身就是地址時直接採用，否則視窗只到送餐資訊為止（不會取到送達地址）
+    pick = None
+    pick_win: List[_Line] = []
+    if o >= 0:
+        pick_win = recs[o + 1: o + 1 + _PICK_WINDOW]
+        if _PICK_LABEL in recs[o].norm:
+            end = min(o + 1 + _PICK_WINDOW, h) if h > o else o + 1 + _PICK_WINDOW
+            pick_win = recs[o: end]
+            if recs[o].score >= _MIN_SCORE:
+                pick = recs[o].clean
+        pick = pick or _best(pick_win)
+        if not pick and recs[o].addr_like:
+            pick = recs[o].clean
+
+    # 3) 送餐資訊之前最後一個像地址的行
+    if not pick and h > 0 and back >= 0:
+        pick = recs[back].clean
+        logger.info("[ADDR] 取餐回溯候選 -> %s", pick)
+
+    # 4) 送餐資訊之後（或全文）第一個像地址的行
+    if not drop and fwd >= 0:
+        drop = recs[fwd].clean
+        logger.info("[ADDR] 送達回溯候選 -> %s", drop)
+
+    # 5) 最終保底
+    pick = pick or UNKNOWN
+    drop = drop or UNKNOWN
+
+    # 6) 去重複策略：若相同，嘗試替換另一候補
+    pick_key = same_key(pick)
+    if pick_key and pick_key == same_key(drop):
+        logger.warning("[ADDR] 取餐/送達相同，啟動去重複策略：%s", pick)
+        if h >= 0:
+            alt = [r for r in recs[h + 1: h + 1 + _DROP_ALT_WINDOW] if not (r.key and r.key == pick_key)]
+            drop2 = _best(alt)
+            if drop2 and same_key(drop2) != pick_key:
+                drop = drop2
+        drop_key = same_key(drop)
+        if pick_key and pick_key == drop_key and o > 0 and left >= 0:
+            pick2 = recs[left].clean
+            if same_key(pick2) != drop_key:
+                pick = pick2
+                pick_key = same_key(pick)
+        if pick_key and pick_key == drop_key:
+            pick = UNKNOWN_SAME
+
+    logger.info("[ADDR] 最終取餐：%s", pick)
+    logger.info("[ADDR] 最終送達：%s", drop)
+    return AddressResult(
+        pick, drop,
+        pickup_alternates=[s for s in _ranked(pick_win) if s != pick],
+        dropoff_alternates=[s for s in _ranked(drop_win) if s != drop],
+    )
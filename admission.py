@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+modules/admission.py — v6.3.0
+/callback 入口把關（驗章後、入列前）：
+1. 去重：LINE 逾時重送的事件（同一 webhookEventId / message id）在 DEDUPE_TTL_SEC 內只處理一次；
+   以有界的時間窗集合記錄（最多 DEDUPE_MAX 筆，過期或超量時從最舊的開始丟）。
+2. 限流：每位使用者一個 token bucket（每分鐘 RATE_LIMIT_PER_MIN 張、可連發 RATE_LIMIT_BURST 張），
+   連點重傳或洗版的使用者會先被擋下，不佔 OCR / Maps。
+3. 兩者都在單一行程內記錄；gunicorn 多 worker 時各自獨立（重送若落到別的 worker 仍會被處理一次，
+   限流上限約為 worker 數倍）。
+公平排程（同一使用者不能塞滿佇列）見 modules.jobs 的 FairQueue。
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from modules.metrics import Counter
+
+DEDUPE_TTL = float(os.getenv("DEDUPE_TTL_SEC", "600"))
+DEDUPE_MAX = int(os.getenv("DEDUPE_MAX", "20000"))
+RATE_LIMIT_PER_MIN = float(os.getenv("RATE_LIMIT_PER_MIN", "10"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "5"))
+RATE_LIMIT_USERS = int(os.getenv("RATE_LIMIT_USERS", "10000"))
+
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+RATE_LIMITED = "rate_limited"
+
+RATE_LIMITED_TEXT = "⚠️ 傳送太頻繁，請稍候再傳。"
+
+ADMISSION = Counter("delivery_admission_total", "webhook 圖片事件入口判定（accepted / duplicate / rate_limited）",
+                    ["result"])
+
+
+class RecentIds:
+    """有界時間窗集合；add() 回傳 True 表示第一次出現"""
+
+    def __init__(self, ttl: float = DEDUPE_TTL, maxsize: int = DEDUPE_MAX):
+        self.ttl = ttl
+        self.maxsize = max(1, maxsize)
+        self._seen: "OrderedDict[str, float]" = OrderedDict()     # id → 到期時間（插入順序 = 到期順序）
+        self._lock = threading.Lock()
+
+    def add(self, key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen
+            while seen:
+                oldest, expires = next(iter(seen.items()))
+                if expires > now and len(seen) < self.maxsize:
+                    break
+                del seen[oldest]
+            if key in seen:
+                return False
+            seen[key] = now + self.ttl
+            return True
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+class RateLimiter:
+    """每個 key 一個 token bucket；閒置到補滿的 bucket 超量時優先淘汰（LRU）"""
+
+    def __init__(self, per_min: float = RATE_LIMIT_PER_MIN, burst: float = RATE_LIMIT_BURST,
+                 max_keys: int = RATE_LIMIT_USERS):
+        self.rate = per_min / 60.0
+        self.burst = max(1.0, burst)
+        self.max_keys = max(1, max_keys)
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()   # key → [tokens, 上次補充時間]
+        self._lock = threading.Lock()
+
+    def allow(self, key: str, cost: float = 1.0) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None:
+                b = self._buckets[key] = [self.burst, now]
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+                b[1] = now
+            if b[0] >= cost:
+                b[0] -= cost
+                return True
+            return False
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class Admission:
+    def __init__(self, dedupe: Optional[RecentIds] = None, limiter: Optional[RateLimiter] = None):
+        self.dedupe = dedupe if dedupe is not None else RecentIds()
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self._lock = threading.Lock()
+        self._stats = {ACCEPTED: 0, DUPLICATE: 0, RATE_LIMITED: 0}
+
+    def _count(self, result: str) -> str:
+        ADMISSION.inc(result=result)
+        with self._lock:
+            self._stats[result] += 1
+        return result
+
+    def check(self, event: Any) -> str:
+        """LINE MessageEvent → ACCEPTED / DUPLICATE / RATE_LIMITED"""
+        event_id = getattr(event, "webhook_event_id", None)
+        message_id = getattr(getattr(event, "message", None), "id", None)
+        keys = [f"e:{event_id}"] if event_id else []
+        if message_id:
+            keys.append(f"m:{message_id}")
+        # 兩個 id 都要登記（重送時 webhookEventId 不變；不同事件帶同一訊息也算重複）
+        fresh = [self.dedupe.add(k) for k in keys]
+        if keys and not all(fresh):
+            return self._count(DUPLICATE)
+        user_id = getattr(getattr(event, "source", None), "user_id", None)
+        if user_id and not self.limiter.allow(user_id):
+            return self._count(RATE_LIMITED)
+        return self._count(ACCEPTED)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s: Dict[str, Any] = dict(self._stats)
+        s["tracked_ids"] = len(self.dedupe)
+        s["tracked_users"] = len(self.limiter)
+        return s
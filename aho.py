@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+modules/aho.py — v6.3.0
+純 Python Aho–Corasick 多字串比對（黑名單、道路索引共用）：
+建好自動機後，一次掃過文字即可找出所有關鍵字出現位置，成本與關鍵字數量無關。
+"""
+
+from collections import deque
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
+
+
+class Match(NamedTuple):
+    start: int
+    end: int          # 不含
+    value: Any
+
+
+class Automaton:
+    """add() 完所有關鍵字後呼叫 build()；build 後不可再 add。"""
+
+    def __init__(self) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 每個節點的輸出：[(關鍵字長度, value)]，本節點的（較長）排在前面
+        self._out: List[List[Tuple[int, Any]]] = [[]]
+        self._count = 0
+        self._built = False
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, word: str, value: Any = None) -> None:
+        if self._built:
+            raise RuntimeError("automaton already built")
+        if not word:
+            return
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((len(word), word if value is None else value))
+        self._count += 1
+
+    def build(self) -> "Automaton":
+        goto, fail, out = self._goto, self._fail, self._out
+        q = deque(goto[0].values())
+        while q:
+            node = q.popleft()
+            for ch, nxt in goto[node].items():
+                q.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+        self._built = True
+        return self
+
+    def iter(self, text: str) -> Iterator[Match]:
+        """依結束位置順序列出所有（可重疊）命中"""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                for length, value in out[node]:
+                    yield Match(i + 1 - length, i + 1, value)
+
+    def find_all(self, text: str) -> List[Match]:
+        return list(self.iter(text))
+
+    def longest(self, text: str) -> List[Match]:
+        """最長優先、其次最早出現；同長同位置保留加入順序"""
+        return sorted(self.iter(text), key=lambda m: (-(m.end - m.start), m.start))
@@ -1,20 +1,30 @@
 # -*- coding: utf-8 -*-
 """
-app.py — v6.2.1 Address Picker Fix + Dual-Channel Blob + Full Logging
-修正：OCR 取餐/送達地址抽取邏輯，避免兩者重複；加入候補策略與詳細 log。
+app.py — v6.3.0 Async Job Pipeline
+v6.2.1：OCR 取餐/送達地址抽取邏輯，避免兩者重複；加入候補策略與詳細 log。
+v6.3.0：/callback 只驗章與入列即回 200；OCR → 地址 → Maps → 報告改由背景 worker 執行，
+        結果以 reply（token 過期則 push）送回。佇列滿時直接回覆忙碌訊息。
+        Maps 前先以離線估算預篩（明顯不划算的單不查 Maps），Maps 無結果時改用估算；報告標明距離來源。
+        分析完的訂單交給背景批次寫入 orders 表；/orders/summary 提供時段收益、熱門取餐點、黑名單命中率。
+        log 改走 modules.logconfig（QueueHandler 非同步、輪替、JSON、[ADDR] 取樣）。
+        分流（modules.triage）：先用低解析度掃描判斷金額/平台，最短可能距離都達不到門檻的單，
+        先以目標解析度重新辨識金額行確認金額，才直接拒單（不做完整辨識、補全與 Maps）。
+        畫面符合平台樣板（modules.ocr_templates）時只裁金額/地址區域平行辨識，否則整頁辨識；
+        OCR_LAYOUT=1 時 OCR 輸出版面（字詞座標 + 信心值，modules.layout），地址依「送餐資訊」/(O) 錨點位置抽取；
+        預設關閉，待 bench 的版面準確率勝過逐行文字抽取再開。
+        /callback 入口去重（LINE 重送的事件只處理一次）、每位使用者 token bucket 限流；
+        背景佇列依使用者輪流排程，單一使用者洗版不會卡住其他人。
+        正式環境以 gunicorn 多行程啟動（gunicorn.conf.py）：master 先 preload() 載入唯讀資料並跑一張合成訂單，
+        gc.freeze 後再 fork，worker 以 copy-on-write 共用同一份。
 """
 
 import os
-import io
-import re
 import json
-import sqlite3
+import io
+import time
 import logging
-from typing import Tuple, List, Optional
-from flask import Flask, request, jsonify
-from PIL import Image
-import pytesseract
-import requests
+from typing import Dict, Optional, Tuple
+from flask import Flask, Response, request, jsonify
 
 # ───────────────────────────────────────────────
 # LINE Bot SDK (v3.x)
@@ -26,6 +36,7 @@ from linebot.v3.messaging import (
     MessagingApi,
     MessagingApiBlob,
     ReplyMessageRequest,
+    PushMessageRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import TextMessageContent, ImageMessageContent
@@ -37,22 +48,38 @@ LINE_ENABLED = bool(LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET)
 # ───────────────────────────────────────────────
 # Internal modules
 # ───────────────────────────────────────────────
-from modules.maps import get_distance_duration
-from modules.postal_lookup import compose_clean_address, normalize_address
+from modules.maps import get_distance_duration, DISTANCE_CACHE
+from modules.distance_estimate import (
+    Estimate, SOURCE_LABELS, SOURCE_MAPS, SOURCE_NONE, SOURCE_TRIAGE, estimate as estimate_distance,
+    prefilter_reject, prefiltered, resolve,
+)
+from modules.postal_lookup import compose_clean_address
+from modules.address_extract import UNKNOWN, extract as extract_address_result, same_key
+from modules.features import scan as scan_features
+from modules.analysis import threshold_for
+from modules.jobs import JobQueue, QueueFullError
+from modules.admission import DUPLICATE, RATE_LIMITED, RATE_LIMITED_TEXT, Admission
+from modules.http_client import get_client as get_http_client
+from modules import metrics
+from modules.metrics import span, new_request_id, get_request_id
+from modules.logconfig import setup_logging
+from modules.ocr_engine import OCR_LAYOUT, OrderOCR, get_engine as get_ocr_engine
+from modules.layout import extract as extract_layout_addresses
+from modules.ocr_templates import OCR_TEMPLATES, get_registry as get_template_registry
+from modules.ocr_cache import OCRCache, OCRResult
+from modules.blacklist import get_engine as get_blacklist_engine
+from modules.blob import BytesLike, ImageTooLargeError, accept_bytes, content_length, read_chunks
+from modules.db import close_all as close_databases
+from modules.triage import (
+    TRIAGE_ENABLED, amount_box, read_amount, triage, stats as triage_stats,
+)
+from modules.order_store import ORDER_STORE_ENABLED, OrderRecord, get_store as get_order_store
 
 # ───────────────────────────────────────────────
-# Logging（檔案 + 主控台）
+# Logging（檔案 + 主控台，皆由背景 listener 寫出）
 # ───────────────────────────────────────────────
+setup_logging()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-if not any(isinstance(h, logging.FileHandler) for h in logger.handlers):
-    fh = logging.FileHandler("delivery_ai.log", encoding="utf-8")
-    fh.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(fh)
-if not any(isinstance(h, logging.StreamHandler) for h in logger.handlers):
-    sh = logging.StreamHandler()
-    sh.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
-    logger.addHandler(sh)
 
 # ───────────────────────────────────────────────
 # Flask
@@ -61,188 +88,86 @@ app = Flask(__name__)
 app.config["JSON_AS_ASCII"] = False
 DB_PATH = "delivery_ai.db"
 
+# ───────────────────────────────────────────────
+# 背景工作佇列（worker 於第一次入列時才啟動）
+# ───────────────────────────────────────────────
+JOB_QUEUE = JobQueue(
+    workers=int(os.getenv("JOB_WORKERS", "4")),
+    maxsize=int(os.getenv("JOB_QUEUE_SIZE", "64")),
+    name="line-image",
+)
+# 重送去重 + 每位使用者限流
+ADMISSION = Admission()
+# reply token 有效時間有限；排隊超過此秒數改用 push
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+LINE_BLOB_TIMEOUT = float(os.getenv("LINE_BLOB_TIMEOUT", "15"))
+TOO_LARGE_TEXT = "⚠️ 圖片檔案過大，請改傳截圖。"
+FAILED_TEXT = "⚠️ 分析失敗，請稍後再傳一次。"
+
+# 重傳/近似重傳的截圖直接取用先前 OCR 與抽取結果
+OCR_CACHE = OCRCache(db_path=DB_PATH)
+
+QUEUE_GAUGE = metrics.Gauge("delivery_job_queue", "背景工作佇列狀態", ["field"])
+for _f in ("depth", "keys", "busy", "rejected", "completed", "failed", "wait_ms_p95", "run_ms_p95"):
+    QUEUE_GAUGE.set_function(lambda _f=_f: JOB_QUEUE.stats()[_f], field=_f)
+
 # ───────────────────────────────────────────────
 # 工具
 # ───────────────────────────────────────────────
 def check_blacklist(text: str) -> str:
+    """DB + data/ 黑名單（Aho–Corasick 一次掃描；來源變動時自動重建）"""
     try:
-        if not os.path.exists(DB_PATH):
+        engine = get_blacklist_engine()
+        if not engine.has_sources():
             return "資料庫不存在"
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT keyword FROM blacklist")
-        rows = c.fetchall()
-        conn.close()
-        text_l = text.lower()
-        matched = [kw for (kw,) in rows if kw and kw.strip() and kw.lower() in text_l]
+        matched = engine.match(text)
         return "、".join(matched) if matched else "未命中"
     except Exception as e:
         logger.error(f"check_blacklist 例外：{e}")
         return "檢查失敗"
 
-def extract_amount(ocr_text: str) -> float:
-    if not ocr_text:
-        return 0.0
-    t = ocr_text.replace(",", "")
-    m = re.search(r"\$?\s*([0-9]+\.[0-9]{1,2})\s*\$?", t)
-    if m:
-        return float(m.group(1))
-    m = re.search(r"(?:NT\$|NTD|\$)?\s*([0-9]{2,5})\s*(?:元|塊|NT\$|NTD)?", t)
-    return float(m.group(1)) if m else 0.0
-
-def detect_platform(ocr_text: str) -> str:
-    if re.search(r"\$?\s*\d+\.\d{1,2}\s*\$?", ocr_text):
-        return "Foodpanda"
-    if re.search(r"Uber\s*Eats|ubereats", ocr_text, flags=re.I):
-        return "Uber Eats"
-    if "送餐資訊" in ocr_text:
-        return "Foodpanda"
-    return "未知平台"
-
-_TW_CITY = r"(台北市|新北市|桃園市|台中市|台南市|高雄市|基隆市|新竹市|嘉義市|新竹縣|苗栗縣|彰化縣|南投縣|雲林縣|嘉義縣|屏東縣|宜蘭縣|花蓮縣|台東縣|澎湖縣|連江縣|金門縣)"
-_TW_ROAD = r"[^\s\d]+(?:路|街|大道|巷|弄)[^,\s]*"
-_ADDR_LIKE = re.compile(rf"{_TW_CITY}|{_TW_ROAD}|(\d+號)")
-
-def _is_addr_like(s: str) -> bool:
-    s2 = normalize_address(s)
-    return bool(_ADDR_LIKE.search(s2))
-
-def _cleanup_line(s: str) -> str:
-    s = s.strip()
-    s = s.replace("：", ":").replace("公司:", "")  # 去掉常見干擾前綴
-    s = re.sub(r"\s+", " ", s)
-    return s
-
-def _pick_best_addr(cands: List[str]) -> Optional[str]:
-    """在候選行中挑最像地址的一行；若無則 None"""
-    scored = []
-    for c in cands:
-        s = normalize_address(_cleanup_line(c))
-        score = 0
-        if re.search(_TW_CITY, s): score += 3
-        if re.search(_TW_ROAD, s): score += 3
-        if re.search(r"\d+號", s): score += 2
-        if re.search(r"\d{3,6}", s): score += 1  # 郵遞區或門牌數字
-        scored.append((score, s))
-    scored.sort(reverse=True)
-    return scored[0][1] if scored and scored[0][0] >= 3 else None
-
-def _are_same_addr(a: str, b: str) -> bool:
-    sa = re.sub(r"[^一-龥a-zA-Z0-9]", "", normalize_address(a))
-    sb = re.sub(r"[^一-龥a-zA-Z0-9]", "", normalize_address(b))
-    return bool(sa) and sa == sb
-
 def extract_addresses(ocr_text: str) -> Tuple[str, str]:
-    """
-    改良版：明確以「送餐資訊」區塊抽 dropoff；
-    取餐地址優先用 (O) 行與其後 1-3 行；若缺，再用「送餐資訊」之前最後一個地址樣式行。
-    若兩者相同，啟動候補策略避免重複。
-    """
-    if not ocr_text:
-        return "辨識中/無法擷取", "辨識中/無法擷取"
-
-    raw_lines = [ln for ln in ocr_text.splitlines()]
-    lines = [ln for ln in (l.strip() for l in raw_lines) if ln.strip()]
-    logger.info(f"[ADDR] OCR 行數：{len(lines)}")
-    logger.info(f"[ADDR] 片段預覽：{lines[:8]}")
-
-    # 1) 找送餐資訊區塊作為 dropoff
-    idx_drop_hdr = -1
-    for i, ln in enumerate(lines):
-        if "送餐資訊" in ln.replace(" ", ""):
-            idx_drop_hdr = i
-            break
-
-    drop = None
-    if idx_drop_hdr >= 0:
-        cand = lines[idx_drop_hdr + 1 : idx_drop_hdr + 5]
-        logger.info(f"[ADDR] 送餐資訊候選：{cand}")
-        drop = _pick_best_addr(cand)
-
-        # 若 pick_best 失敗，合併看看
-        if not drop:
-            merged = normalize_address(_cleanup_line("".join(cand)))
-            if _is_addr_like(merged):
-                drop = merged
-
-    # 2) 取餐地址：優先 (O) 起始行之後 1-3 行
-    pick = None
-    idx_o = -1
-    for i, ln in enumerate(lines):
-        if ln.strip().startswith("(O)") or ln.strip().startswith("O)"):
-            idx_o = i
-            break
-    if idx_o >= 0:
-        cand = lines[idx_o + 1 : idx_o + 4]
-        logger.info(f"[ADDR] 取餐(O)候選：{cand}")
-        pick = _pick_best_addr(cand)
-        if not pick:
-            # (O) 行本身有時包含地址
-            if _is_addr_like(lines[idx_o]):
-                pick = normalize_address(_cleanup_line(lines[idx_o]))
-
-    # 3) 若還沒有 pick，用「送餐資訊之前」最後一個像地址的行
-    if not pick and idx_drop_hdr > 0:
-        back = [ln for ln in lines[:idx_drop_hdr] if _is_addr_like(ln)]
-        if back:
-            pick = normalize_address(_cleanup_line(back[-1]))
-            logger.info(f"[ADDR] 取餐回溯候選：{back[-3:]} -> {pick}")
-
-    # 4) 若還沒有 drop，從「送餐資訊之後」挑第一個像地址的行
-    if not drop:
-        fwd = [ln for ln in lines[idx_drop_hdr + 1 :]] if idx_drop_hdr >= 0 else lines
-        fwd = [ln for ln in fwd if _is_addr_like(ln)]
-        if fwd:
-            drop = normalize_address(_cleanup_line(fwd[0]))
-            logger.info(f"[ADDR] 送達回溯候選：{fwd[:3]} -> {drop}")
-
-    # 5) 最終保底
-    if not pick:
-        pick = "辨識中/無法擷取"
-    if not drop:
-        drop = "辨識中/無法擷取"
-
-    # 6) 去重複策略：若相同，嘗試替換另一候補
-    if _are_same_addr(pick, drop):
-        logger.warning(f"[ADDR] 取餐/送達相同，啟動去重複策略：{pick}")
-        # 嘗試：送達改用送餐資訊塊中的次佳
-        if idx_drop_hdr >= 0:
-            cand = lines[idx_drop_hdr + 1 : idx_drop_hdr + 6]
-            # 去掉與 pick 相同者
-            alt = [c for c in cand if not _are_same_addr(c, pick)]
-            drop2 = _pick_best_addr(alt)
-            if drop2 and not _are_same_addr(drop2, pick):
-                drop = drop2
-        # 若仍相同，嘗試取餐用 (O) 前一個地址行
-        if _are_same_addr(pick, drop):
-            left = [ln for ln in lines[: max(idx_o, 0)] if _is_addr_like(ln)]
-            if left:
-                pick2 = normalize_address(_cleanup_line(left[-1]))
-                if not _are_same_addr(pick2, drop):
-                    pick = pick2
-
-        # 仍相同就只保留送達，取餐標記
-        if _are_same_addr(pick, drop):
-            pick = "辨識中/無法擷取(疑同送達)"
-
-    logger.info(f"[ADDR] 最終取餐：{pick}")
-    logger.info(f"[ADDR] 最終送達：{drop}")
-    return pick, drop
-
-def ocr_image_bytes(image_bytes: bytes) -> str:
+    """取餐/送達地址（單次掃描版，見 modules/address_extract.py）"""
+    return extract_address_result(ocr_text).pair
+
+def ocr_image_bytes(image_bytes: BytesLike, lines=None) -> str:
+    """交給 OCR 行程池（前處理 + ROI 於子行程完成）；lines 為分流時已做的低解析度掃描"""
     try:
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        text = pytesseract.image_to_string(img, lang="chi_tra+eng")
-        text = re.sub(r"[ \t]+", " ", text).replace("臺", "台")
-        logger.info(f"OCR 擷取完成（{len(text)}字）")
+        text = get_ocr_engine().recognize(image_bytes, lines)
+        metrics.OCR_CHARS.observe(len(text))
+        logger.info("OCR 擷取完成（%d字）", len(text))
         return text
     except Exception as e:
         logger.error(f"OCR 失敗：{e}")
         return ""
 
-def build_report(platform, amount, pickup, dropoff, dist_km, dur_min, bl) -> str:
+def ocr_order(image_bytes: BytesLike, lines=None) -> OrderOCR:
+    """一次 OCR 呼叫：樣板區域辨識，不符合時在同一張前處理後的圖上改做版面（OCR_LAYOUT=1）或整頁辨識；
+    lines 為分流時已做的低解析度掃描"""
+    try:
+        res = get_ocr_engine().recognize_order(image_bytes, lines, OCR_TEMPLATES, OCR_LAYOUT)
+    except Exception as e:
+        logger.error(f"OCR 失敗：{e}")
+        return OrderOCR(lines or [])
+    if res.template_miss:
+        logger.info("[TPL] %s 欄位不完整，改走整頁辨識", res.template_miss)
+    if res.template is not None:
+        tpl = res.template
+        logger.info("[TPL] %s：$%s %s → %s", tpl.template, tpl.amount, tpl.pickup, tpl.dropoff)
+    elif res.layout is not None:
+        layout = res.layout
+        metrics.OCR_CHARS.observe(len(layout.text))
+        logger.info("OCR 版面擷取完成（%d 行 / %d字，丟棄低信心 %d）", len(layout.lines), len(layout.text),
+                    layout.dropped)
+    else:
+        metrics.OCR_CHARS.observe(len(res.text))
+        logger.info("OCR 擷取完成（%d字）", len(res.text))
+    return res
+
+def build_report(platform, amount, pickup, dropoff, dist_km, dur_min, bl, source=None) -> str:
     earning_per_km = round(amount / dist_km, 2) if dist_km > 0 else 0.0
-    threshold = 15.0
+    threshold = threshold_for(platform)
+    source_line = f"【距離來源】：{SOURCE_LABELS.get(source, source)}\n" if source else ""
     suggestion = "✅ 收益良好，建議接單" if earning_per_km >= threshold else f"⚠️ 低於門檻 ({threshold} 元/km)，建議拒單"
     return (
         f"【平台】：{platform}\n"
@@ -251,17 +176,212 @@ def build_report(platform, amount, pickup, dropoff, dist_km, dur_min, bl) -> str
         f"【送達地址】：{dropoff}\n"
         f"【距離】：{dist_km:.2f} 公里\n"
         f"【耗時】：約 {dur_min:.1f} 分鐘\n"
+        f"{source_line}"
         f"【黑名單】：{bl}\n"
         f"【每公里收益】：{earning_per_km} 元/km\n"
         f"【建議】：{suggestion}"
     )
 
+def extract_order(image_bytes: BytesLike, keys=None, lines=None) -> OCRResult:
+    """(快取) OCR → 平台/金額/地址；CPU 密集，ASGI 模式下丟到 executor 執行"""
+    keys = keys or OCR_CACHE.keys_for(image_bytes)
+    cached = OCR_CACHE.get(keys)
+    if cached:
+        return cached
+    with span("ocr"):
+        res = ocr_order(image_bytes, lines)
+    tpl, layout = res.template, res.layout
+    if tpl is not None:
+        # 區域外的文字（店名、備註）沿用低解析度掃描，黑名單仍看得到
+        ocr_text = "\n".join([text for _, _, text in res.lines] + list(tpl.texts.values()))
+    elif layout is not None:
+        ocr_text = layout.text
+    else:
+        ocr_text = res.text
+    with span("extract"):
+        if tpl is not None:
+            result = OCRResult(ocr_text, tpl.platform, tpl.amount, tpl.pickup, tpl.dropoff)
+        else:
+            feats = scan_features(ocr_text)
+            if layout is not None:
+                pickup, dropoff = extract_layout_addresses(layout).pair
+            else:
+                pickup, dropoff = extract_addresses(ocr_text)
+            result = OCRResult(ocr_text, feats.platform, feats.amount, pickup, dropoff)
+    OCR_CACHE.put(keys, result)
+    return result
+
+def scan_verifier(lines):
+    """OCR 快取近似命中的驗證：低解析度掃描讀到的金額要與候選相同，掃得到的地址也要相同；
+    掃描讀不到金額時一律不沿用"""
+    text = "\n".join(t for _, _, t in lines or ())
+    amount = scan_features(text).amount
+    if amount <= 0:
+        return None
+    seen = extract_address_result(text)
+
+    def verify(cand: OCRResult) -> bool:
+        if abs(cand.amount - amount) > 0.005:
+            return False
+        for addr, other in ((seen.pickup, cand.pickup), (seen.dropoff, cand.dropoff)):
+            if not addr.startswith(UNKNOWN) and same_key(addr) != same_key(other):
+                return False
+        return True
+    return verify
+
+def triage_order(image_bytes: BytesLike) -> Tuple[Optional[str], Optional[OCRResult]]:
+    """分流：回傳 (拒單報告, None)，或 (None, 完整 OCR 結果) 繼續正常流程。
+    快取命中時不必分流（完整結果已經有了；近似命中以掃描結果驗證後才算）；拒單的結果不寫入 OCR 快取。"""
+    keys = OCR_CACHE.keys_for(image_bytes)
+    cached = OCR_CACHE.get(keys)
+    if cached:
+        return None, cached
+    lines = None
+    try:
+        with span("triage_ocr"):
+            lines = get_ocr_engine().scan(image_bytes)
+        verify = scan_verifier(lines)
+        if verify is not None:
+            cached = OCR_CACHE.get(keys, verify)
+            if cached:
+                return None, cached
+        with span("triage"):
+            verdict = triage("\n".join(text for _, _, text in lines),
+                             confirm=lambda amount: confirm_amount(image_bytes, lines, amount))
+    except Exception as e:
+        logger.error(f"分流失敗，改走完整流程：{e}")
+        verdict = None
+    if verdict is not None and verdict.reject:
+        order = OCRResult("\n".join(text for _, _, text in lines), verdict.platform, verdict.amount,
+                          verdict.pickup or "辨識中/無法擷取", verdict.dropoff or "辨識中/無法擷取")
+        return finish_report(order, verdict.km, verdict.mins, SOURCE_TRIAGE), None
+    return None, extract_order(image_bytes, keys, lines)
+
+def confirm_amount(image_bytes: BytesLike, lines, amount: float) -> bool:
+    """分流拒單前以目標解析度重新辨識金額行；找不到該行或讀數不同回 False（放行）"""
+    box = amount_box(lines, amount)
+    if box is None:
+        return False
+    with span("triage_confirm"):
+        text = get_ocr_engine().read_amount(image_bytes, box)
+    return read_amount(text) == amount
+
+def enrich_addresses(order: OCRResult) -> Tuple[str, str, bool]:
+    """補全地址；第三個值表示是否需要查 Maps"""
+    pickup, dropoff = order.pickup, order.dropoff
+    with span("enrich"):
+        pick_c = compose_clean_address(pickup) if "辨識中" not in pickup else pickup
+        drop_c = compose_clean_address(dropoff) if "辨識中" not in dropoff else dropoff
+
+    # 若兩者仍判定相同，直接回報並避免發送 0 距離誤導
+    if (isinstance(pick_c, str) and isinstance(drop_c, str) and pick_c == drop_c) or \
+       (isinstance(pick_c, str) and "辨識中" in pick_c) and (isinstance(drop_c, str) and "辨識中" in drop_c):
+        logger.warning("[MAPS] 取餐/送達仍相同或皆未知，跳過距離計算。")
+        return pick_c, drop_c, False
+    return pick_c, drop_c, True
+
+def estimate_route(order: OCRResult, pick_c: str, drop_c: str) -> Tuple[Optional[Estimate], bool]:
+    """離線估算距離/時間；第二個值為 True 表示預估已明顯低於門檻，不必再查 Maps"""
+    with span("estimate"):
+        est = estimate_distance(pick_c, drop_c)
+    return est, prefilter_reject(order.amount, est, threshold_for(order.platform))
+
+def finish_report(order: OCRResult, dist: float, dur: float, source: str = SOURCE_NONE) -> str:
+    with span("blacklist"):
+        bl = check_blacklist(order.ocr_text + " " + order.pickup + " " + order.dropoff)
+    with span("report"):
+        report = build_report(order.platform, order.amount, order.pickup, order.dropoff, dist, dur, bl, source)
+    if ORDER_STORE_ENABLED:
+        get_order_store().record(OrderRecord.build(order.platform, order.amount, order.pickup, order.dropoff,
+                                                   dist, dur, bl, source, get_request_id()))
+    logger.info("[LINE] 成功分析：%s → %s = %skm / %smin（%s）", order.pickup, order.dropoff, dist, dur, source)
+    return report
+
+def analyze_image(image_bytes: BytesLike) -> str:
+    """正常流程：(快取) 分流 → OCR → 抽地址 → 正規化 → 離線預篩 → Maps（失敗用估算）→ 黑名單 → 報告"""
+    if TRIAGE_ENABLED:
+        report, order = triage_order(image_bytes)
+        if report is not None:
+            return report
+    else:
+        order = extract_order(image_bytes)
+    pick_c, drop_c, need_maps = enrich_addresses(order)
+    dist, dur, source = 0.0, 0.0, SOURCE_NONE
+    if need_maps:
+        est, skip = estimate_route(order, pick_c, drop_c)
+        if skip:
+            dist, dur, source = prefiltered(est)
+        else:
+            with span("maps"):
+                dist, dur = get_distance_duration(pick_c, drop_c)
+            dist, dur, source = resolve(dist, dur, est)
+    return finish_report(order, dist, dur, source)
+
+# ───────────────────────────────────────────────
+# 預熱（gunicorn master 於 fork 前呼叫一次）
+# ───────────────────────────────────────────────
+_WARMUP_TEXT = (
+    "Foodpanda\n$85.00\n取餐\n台北市大安區忠孝東路四段100號\n"
+    "送餐資訊\n台北市信義區松仁路100號\n接受"
+)
+
+def _warmup_image() -> bytes:
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("L", (360, 640), 255).save(buf, format="PNG")
+    return buf.getvalue()
+
+def preload(ocr: bool = True) -> Dict[str, float]:
+    """載入唯讀共用狀態（郵遞區號表與道路索引、區中心座標、黑名單自動機、OCR 樣板）並各跑一次合成訂單；
+    回傳各步驟耗時（ms）。只在 master 執行：不寫 orders、不啟動背景執行緒，結束前關閉本行程的 DB 連線。
+    OCR 行程池（OCR_WORKERS > 0）由各 worker 自行建立與預熱，這裡只在同行程辨識時跑一次。"""
+    timings: Dict[str, float] = {}
+
+    def step(name, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.warning("[PRELOAD] %s 失敗：%s", name, e)
+        timings[name] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+    step("extract", lambda: (scan_features(_WARMUP_TEXT), extract_addresses(_WARMUP_TEXT)))
+    pickup, dropoff = extract_addresses(_WARMUP_TEXT)
+    step("zipcodes", lambda: (compose_clean_address(pickup), compose_clean_address(dropoff)))
+    step("estimate", estimate_distance, pickup, dropoff)
+    step("blacklist", get_blacklist_engine().reload, True)
+    step("templates", get_template_registry)
+    step("report", lambda: build_report("Foodpanda", 85.0, pickup, dropoff, 3.2, 12.0,
+                                        check_blacklist(_WARMUP_TEXT), SOURCE_MAPS))
+    if ocr and get_ocr_engine().workers == 0:
+        step("ocr", get_ocr_engine().recognize, _warmup_image())
+    close_databases()
+    logger.info("[PRELOAD] 完成：%s", timings)
+    return timings
+
 # ───────────────────────────────────────────────
 # Routes
 # ───────────────────────────────────────────────
 @app.route("/test", methods=["GET"])
 def test():
-    return jsonify({"ok": True, "msg": "delivery_ai v6.2.1 running"})
+    # 各項統計為回應此請求的 worker 自己的值（多 worker 時以 pid 區分）；跨 worker 的彙總看 /metrics
+    return jsonify({"ok": True, "msg": "delivery_ai v6.3.0 running", "pid": os.getpid(), "queue": JOB_QUEUE.stats(),
+                    "ocr_cache": OCR_CACHE.stats(), "maps_cache": DISTANCE_CACHE.stats(),
+                    "http": get_http_client().stats(), "orders": get_order_store().stats(),
+                    "triage": triage_stats(), "admission": ADMISSION.stats()})
+
+@app.route("/orders/summary", methods=["GET"])
+def orders_summary():
+    """最近 N 小時（?hours=，預設 24）的訂單統計"""
+    hours = request.args.get("hours", default=24.0, type=float)
+    since = time.time() - hours * 3600
+    store = get_order_store()
+    return jsonify({"hours": hours, "by_hour": store.earnings_by_hour(since),
+                    "top_pickups": store.top_pickups(10, since), "blacklist": store.blacklist_hit_rate(since)})
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 # ───────────────────────────────────────────────
 # LINE Webhook
@@ -275,80 +395,116 @@ if LINE_ENABLED:
 
     @app.route("/callback", methods=["POST"])
     def callback():
+        new_request_id()
         signature = request.headers.get("X-Line-Signature", "")
         body = request.get_data(as_text=True)
         handler.handle(body, signature)
         return "OK", 200
 
-    @handler.add(MessageEvent, message=ImageMessageContent)
-    def on_image(event):
-        logger.info(f"[LINE] 收到圖片事件 id={event.message.id}")
-        image_bytes = b""
+    def _send_text(event, text: str, received_at: float) -> None:
+        """優先用 reply；token 可能已過期（排隊過久或 reply 失敗）時改用 push。"""
+        if time.monotonic() - received_at < REPLY_TOKEN_TTL:
+            try:
+                msg_api.reply_message(
+                    ReplyMessageRequest(
+                        reply_token=event.reply_token,
+                        messages=[TextMessage(text=text)]
+                    )
+                )
+                return
+            except Exception as e:
+                logger.warning(f"[LINE] reply 失敗，改用 push：{e}")
+        user_id = getattr(event.source, "user_id", None)
+        if not user_id:
+            logger.error("[LINE] 無 user_id，無法 push 結果")
+            return
+        msg_api.push_message(
+            PushMessageRequest(to=user_id, messages=[TextMessage(text=text)])
+        )
+
+    def _download_image(message_id: str) -> BytesLike:
+        """下載進單一緩衝（見 modules/blob.py）；超過大小上限丟 ImageTooLargeError"""
+        image_bytes: BytesLike = b""
 
         # 通道 A：SDK 嘗試
         try:
-            resp = blob_api.get_message_content(message_id=event.message.id)
-            if hasattr(resp, "content") and resp.content:
-                image_bytes = resp.content
+            resp = blob_api.get_message_content(message_id=message_id)
+            # 已是完整 bytes 的直接沿用（只檢查大小）；只有逐段讀取的才寫進緩衝
+            if isinstance(resp, (bytes, bytearray)):
+                image_bytes = accept_bytes(resp)
+            elif hasattr(resp, "content") and resp.content:
+                image_bytes = accept_bytes(resp.content)
             elif hasattr(resp, "read"):
-                image_bytes = resp.read()
+                image_bytes = accept_bytes(resp.read())
             elif hasattr(resp, "iter_bytes"):
-                for chunk in resp.iter_bytes():
-                    image_bytes += chunk
+                image_bytes = read_chunks(resp.iter_bytes())
             elif hasattr(resp, "iter_content"):
-                for chunk in resp.iter_content(chunk_size=4096):
-                    image_bytes += chunk
+                image_bytes = read_chunks(resp.iter_content(chunk_size=65536))
+        except ImageTooLargeError:
+            raise
         except Exception as e:
             logger.warning(f"SDK 通道錯誤：{e}")
 
         # 通道 B：HTTP API 備援
         if not image_bytes:
             try:
-                url = f"https://api-data.line.me/v2/bot/message/{event.message.id}/content"
+                url = f"https://api-data.line.me/v2/bot/message/{message_id}/content"
                 headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"}
-                with requests.get(url, headers=headers, stream=True, timeout=30) as r:
+                with get_http_client().get(url, headers=headers, stream=True, timeout=LINE_BLOB_TIMEOUT) as r:
                     r.raise_for_status()
-                    for chunk in r.iter_content(chunk_size=8192):
-                        image_bytes += chunk
+                    image_bytes = read_chunks(r.iter_content(chunk_size=65536), content_length(r.headers))
                 logger.info("[LINE] HTTP 通道成功下載圖片")
+            except ImageTooLargeError:
+                raise
             except Exception as e:
                 logger.error(f"HTTP 通道錯誤：{e}")
 
-        logger.info(f"[LINE] 影像 bytes 取得：{len(image_bytes)}")
-        if not image_bytes:
-            msg_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="⚠️ 讀取影像失敗（來源無內容）。請再傳一次。")]
-                )
-            )
-            return
+        return image_bytes
 
-        # 正常流程：OCR → 抽地址 → 正規化 → Maps → 報告
-        ocr_text = ocr_image_bytes(image_bytes)
-        platform = detect_platform(ocr_text)
-        amount = extract_amount(ocr_text)
-        pickup, dropoff = extract_addresses(ocr_text)
+    def process_image_event(event, received_at: float) -> None:
+        """worker 執行：下載 → 分析 → 回覆（request ID 由入列時的 context 帶入）"""
+        with span("total"):
+            try:
+                with span("download"):
+                    image_bytes = _download_image(event.message.id)
+            except ImageTooLargeError as e:
+                logger.warning(f"[LINE] {e}")
+                _send_text(event, TOO_LARGE_TEXT, received_at)
+                return
+            logger.info("[LINE] 影像 bytes 取得：%d", len(image_bytes))
+            if not image_bytes:
+                _send_text(event, "⚠️ 讀取影像失敗（來源無內容）。請再傳一次。", received_at)
+                return
 
-        pick_c = compose_clean_address(pickup) if "辨識中" not in pickup else pickup
-        drop_c = compose_clean_address(dropoff) if "辨識中" not in dropoff else dropoff
+            try:
+                report = analyze_image(image_bytes)
+            except Exception as e:
+                logger.exception(f"[LINE] 分析失敗：{e}")
+                report = FAILED_TEXT
+            with span("reply"):
+                _send_text(event, report, received_at)
 
-        # 若兩者仍判定相同，直接回報並避免發送 0 距離誤導
-        if (isinstance(pick_c, str) and isinstance(drop_c, str) and pick_c == drop_c) or \
-           (isinstance(pick_c, str) and "辨識中" in pick_c) and (isinstance(drop_c, str) and "辨識中" in drop_c):
-            logger.warning("[MAPS] 取餐/送達仍相同或皆未知，跳過距離計算。")
-            dist, dur = 0.0, 0.0
+    @handler.add(MessageEvent, message=ImageMessageContent)
+    def on_image(event):
+        new_request_id()
+        logger.info("[LINE] 收到圖片事件 id=%s", event.message.id)
+        received_at = time.monotonic()
+        verdict = ADMISSION.check(event)
+        if verdict == DUPLICATE:
+            logger.info("[LINE] 重複事件，略過 id=%s", event.message.id)
+            return
+        if verdict == RATE_LIMITED:
+            text = RATE_LIMITED_TEXT
         else:
-            dist, dur = get_distance_duration(pick_c, drop_c)
-
-        bl = check_blacklist(ocr_text + " " + pickup + " " + dropoff)
-        report = build_report(platform, amount, pickup, dropoff, dist, dur, bl)
-
-        logger.info(f"[LINE] 成功分析：{pickup} → {dropoff} = {dist}km / {dur}min")
+            try:
+                JOB_QUEUE.submit_for(getattr(event.source, "user_id", None), process_image_event, event, received_at)
+                return
+            except QueueFullError:
+                text = "⚠️ 目前訂單量過多，請稍候 1 分鐘再傳一次。"
         msg_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[TextMessage(text=report)]
+                messages=[TextMessage(text=text)]
             )
         )
 
@@ -360,6 +516,7 @@ else:
 # ───────────────────────────────────────────────
 # Main
 # ───────────────────────────────────────────────
+# 正式環境：gunicorn -c gunicorn.conf.py app:app（多行程，見 gunicorn.conf.py）
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     logger.info("✅ Flask 啟動 (v6.2.1 Address Picker Fix)")
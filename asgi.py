@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+asgi.py — v6.3.0 ASGI 服務模式（Flask 模式 app.py 照常可用）
+單一行程以 event loop 同時處理大量訂單：
+1. /callback 驗章後立即回 200，每張圖片開一個 task；LINE 內容下載、Distance Matrix、
+   reply / push 都走 httpx.AsyncClient（連線池共用），等待網路時不佔執行緒。
+2. 分流、OCR 與抽取（CPU 密集）交給 executor → OCR 行程池；補全、離線預篩、黑名單、報告沿用 app.py 的函式，
+   連同 Maps 的 SQLite 快取讀寫也都在 executor 執行（同步 I/O 不在 event loop 上跑）。
+3. 同時處理中的訂單數上限 ASGI_MAX_INFLIGHT，超過時直接回覆忙碌訊息。
+4. 入口去重與限流同 app.py（modules.admission）；每位使用者同時最多 ASGI_MAX_PER_USER 張在跑、
+   最多 ASGI_USER_QUEUE 張在等，其餘使用者的訂單不會被單一使用者擠掉。
+
+啟動：uvicorn asgi:application --host 0.0.0.0 --port $PORT
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Optional, Set
+
+import httpx
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, ImageMessageContent
+
+from app import (
+    LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, LINE_ENABLED, LINE_BLOB_TIMEOUT, REPLY_TOKEN_TTL,
+    OCR_CACHE, FAILED_TEXT, TOO_LARGE_TEXT, extract_order, triage_order, enrich_addresses, estimate_route, finish_report,
+)
+from modules.distance_estimate import SOURCE_NONE, prefiltered, resolve
+from modules.order_store import get_store as get_order_store
+from modules.triage import TRIAGE_ENABLED, stats as triage_stats
+from modules.admission import DUPLICATE, RATE_LIMITED, RATE_LIMITED_TEXT, Admission
+from modules.blob import BlobBuffer, BytesLike, ImageTooLargeError, content_length
+from modules import metrics
+from modules.maps import DISTANCE_CACHE, aget_distance_duration
+from modules.metrics import span, new_request_id
+from modules.ocr_engine import OCR_WORKERS
+
+logger = logging.getLogger("app")
+
+ASGI_MAX_INFLIGHT = int(os.getenv("ASGI_MAX_INFLIGHT", "256"))
+ASGI_EXECUTOR_WORKERS = int(os.getenv("ASGI_EXECUTOR_WORKERS", str(max(2, 2 * OCR_WORKERS))))
+ASGI_HTTP_CONNECTIONS = int(os.getenv("ASGI_HTTP_CONNECTIONS", "100"))
+ASGI_MAX_PER_USER = int(os.getenv("ASGI_MAX_PER_USER", "2"))
+ASGI_USER_QUEUE = int(os.getenv("ASGI_USER_QUEUE", os.getenv("JOB_PER_KEY", "8")))
+LINE_API = "https://api.line.me/v2/bot/message"
+LINE_DATA_API = "https://api-data.line.me/v2/bot/message"
+
+BUSY_TEXT = "⚠️ 目前訂單量過多，請稍候 1 分鐘再傳一次。"
+EMPTY_TEXT = "⚠️ 讀取影像失敗（來源無內容）。請再傳一次。"
+
+INFLIGHT_GAUGE = metrics.Gauge("delivery_asgi_inflight", "ASGI 模式處理中的訂單數")
+
+
+class Service:
+    """ASGI 模式的共用資源：HTTP client、executor、處理中的 task"""
+
+    def __init__(self) -> None:
+        self.client: Optional[httpx.AsyncClient] = None
+        self.executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_WORKERS, thread_name_prefix="asgi-cpu")
+        self.parser = WebhookParser(LINE_CHANNEL_SECRET) if LINE_ENABLED else None
+        self.tasks: Set[asyncio.Task] = set()
+        self.admission = Admission()
+        self.user_slots: Dict[str, asyncio.Semaphore] = {}
+        self.user_tasks: Dict[str, int] = {}
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        INFLIGHT_GAUGE.set_function(lambda: len(self.tasks))
+
+    async def startup(self) -> None:
+        limits = httpx.Limits(max_connections=ASGI_HTTP_CONNECTIONS,
+                              max_keepalive_connections=ASGI_HTTP_CONNECTIONS)
+        self.client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(10.0, connect=3.05))
+
+    async def shutdown(self) -> None:
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=30)
+        if self.client is not None:
+            await self.client.aclose()
+        self.executor.shutdown(wait=False)
+        get_order_store().close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self.tasks), "max_inflight": ASGI_MAX_INFLIGHT, "completed": self.completed,
+                "failed": self.failed, "rejected": self.rejected, "users": len(self.user_tasks),
+                "admission": self.admission.stats()}
+
+    # ───────────────────────────────────────────
+    # LINE
+    # ───────────────────────────────────────────
+    def _auth(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"}
+
+    async def _post_line(self, path: str, payload: Dict[str, Any]) -> None:
+        r = await self.client.post(f"{LINE_API}/{path}", headers=self._auth(), json=payload)
+        r.raise_for_status()
+
+    async def send_text(self, event, text: str, received_at: float) -> None:
+        """優先用 reply；token 可能已過期時改用 push。"""
+        messages = [{"type": "text", "text": text}]
+        if time.monotonic() - received_at < REPLY_TOKEN_TTL:
+            try:
+                await self._post_line("reply", {"replyToken": event.reply_token, "messages": messages})
+                return
+            except Exception as e:
+                logger.warning(f"[LINE] reply 失敗，改用 push：{e}")
+        user_id = getattr(event.source, "user_id", None)
+        if not user_id:
+            logger.error("[LINE] 無 user_id，無法 push 結果")
+            return
+        await self._post_line("push", {"to": user_id, "messages": messages})
+
+    async def download_image(self, message_id: str) -> BytesLike:
+        """串流寫進單一緩衝；超過大小上限丟 ImageTooLargeError"""
+        try:
+            async with self.client.stream("GET", f"{LINE_DATA_API}/{message_id}/content",
+                                          headers=self._auth(), timeout=LINE_BLOB_TIMEOUT) as r:
+                r.raise_for_status()
+                buf = BlobBuffer(content_length(r.headers))
+                async for chunk in r.aiter_bytes():
+                    buf.write(chunk)
+                return buf.finish()
+        except ImageTooLargeError:
+            raise
+        except Exception as e:
+            logger.error(f"[LINE] 下載圖片失敗：{e}")
+            return b""
+
+    # ───────────────────────────────────────────
+    # 訂單流程
+    # ───────────────────────────────────────────
+    async def run_cpu(self, fn, *args):
+        """丟到 executor；run_in_executor 不會帶 contextvars，這裡自己複製（request ID）"""
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(ctx.run, fn, *args))
+
+    @contextlib.asynccontextmanager
+    async def user_slot(self, user_id: Optional[str]) -> AsyncIterator[None]:
+        """同一使用者同時最多 ASGI_MAX_PER_USER 張進入處理，其餘在自己的 semaphore 上等"""
+        if not user_id:
+            yield
+            return
+        sem = self.user_slots.get(user_id)
+        if sem is None:
+            sem = self.user_slots[user_id] = asyncio.Semaphore(ASGI_MAX_PER_USER)
+        try:
+            async with sem:
+                yield
+        finally:
+            n = self.user_tasks.get(user_id, 1) - 1
+            if n <= 0:
+                self.user_tasks.pop(user_id, None)
+                self.user_slots.pop(user_id, None)
+            else:
+                self.user_tasks[user_id] = n
+
+    async def process_image_event(self, event, received_at: float) -> None:
+        """在獨立 task 執行（建立時複製 context，沿用入列時的 request ID）"""
+        try:
+            async with self.user_slot(getattr(event.source, "user_id", None)):
+                with span("total"):
+                    try:
+                        with span("download"):
+                            image_bytes = await self.download_image(event.message.id)
+                    except ImageTooLargeError as e:
+                        logger.warning(f"[LINE] {e}")
+                        await self.send_text(event, TOO_LARGE_TEXT, received_at)
+                        return
+                    logger.info("[LINE] 影像 bytes 取得：%d", len(image_bytes))
+                    if not image_bytes:
+                        await self.send_text(event, EMPTY_TEXT, received_at)
+                        return
+
+                    if TRIAGE_ENABLED:
+                        report, order = await self.run_cpu(triage_order, image_bytes)
+                        if report is not None:
+                            with span("reply"):
+                                await self.send_text(event, report, received_at)
+                            self.completed += 1
+                            return
+                    else:
+                        order = await self.run_cpu(extract_order, image_bytes)
+                    pick_c, drop_c, need_maps = await self.run_cpu(enrich_addresses, order)
+                    dist, dur, source = 0.0, 0.0, SOURCE_NONE
+                    if need_maps:
+                        est, skip = await self.run_cpu(estimate_route, order, pick_c, drop_c)
+                        if skip:
+                            dist, dur, source = prefiltered(est)
+                        else:
+                            with span("maps"):
+                                dist, dur = await aget_distance_duration(pick_c, drop_c, self.client,
+                                                                         run=self.run_cpu)
+                            dist, dur, source = resolve(dist, dur, est)
+                    report = await self.run_cpu(finish_report, order, dist, dur, source)
+                    with span("reply"):
+                        await self.send_text(event, report, received_at)
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.exception(f"[LINE] 處理失敗：{e}")
+            try:
+                await self.send_text(event, FAILED_TEXT, received_at)
+            except Exception as e2:
+                logger.error(f"[LINE] 失敗訊息回覆失敗：{e2}")
+
+    async def handle_callback(self, body: bytes, signature: str) -> int:
+        try:
+            events = self.parser.parse(body.decode("utf-8"), signature)
+        except InvalidSignatureError:
+            logger.warning("[LINE] 簽章驗證失敗")
+            return 400
+        for event in events:
+            if not (isinstance(event, MessageEvent) and isinstance(event.message, ImageMessageContent)):
+                continue
+            new_request_id()
+            logger.info("[LINE] 收到圖片事件 id=%s", event.message.id)
+            received_at = time.monotonic()
+            verdict = self.admission.check(event)
+            if verdict == DUPLICATE:
+                logger.info("[LINE] 重複事件，略過 id=%s", event.message.id)
+                continue
+            user_id = getattr(event.source, "user_id", None)
+            text = None
+            if verdict == RATE_LIMITED:
+                text = RATE_LIMITED_TEXT
+            elif len(self.tasks) >= ASGI_MAX_INFLIGHT or \
+                    (user_id and self.user_tasks.get(user_id, 0) >= ASGI_MAX_PER_USER + ASGI_USER_QUEUE):
+                text = BUSY_TEXT
+            if text is not None:
+                self.rejected += 1
+                try:
+                    await self.send_text(event, text, received_at)
+                except Exception as e:
+                    logger.error(f"[LINE] 忙碌訊息回覆失敗：{e}")
+                continue
+            if user_id:
+                self.user_tasks[user_id] = self.user_tasks.get(user_id, 0) + 1
+            task = asyncio.create_task(self.process_image_event(event, received_at))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return 200
+
+
+# ───────────────────────────────────────────────
+# ASGI
+# ───────────────────────────────────────────────
+SERVICE = Service()
+
+async def _read_body(receive) -> bytes:
+    parts = []
+    while True:
+        msg = await receive()
+        parts.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            return b"".join(parts)
+
+async def _respond(send, status: int, body: bytes, content_type: str = "text/plain; charset=utf-8") -> None:
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode("latin-1")),
+                            (b"content-length", str(len(body)).encode("latin-1"))]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await SERVICE.startup()
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await SERVICE.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    if path == "/callback" and method == "POST":
+        body = await _read_body(receive)
+        if SERVICE.parser is None:
+            await _respond(send, 200, "LINE disabled".encode("utf-8"))
+            return
+        headers = dict(scope.get("headers") or [])
+        signature = headers.get(b"x-line-signature", b"").decode("latin-1")
+        status = await SERVICE.handle_callback(body, signature)
+        await _respond(send, status, b"OK" if status == 200 else b"Bad signature")
+    elif path == "/test" and method == "GET":
+        payload = {"ok": True, "msg": "delivery_ai v6.3.0 running (asgi)", "pid": os.getpid(), "asgi": SERVICE.stats(),
+                   "ocr_cache": OCR_CACHE.stats(), "maps_cache": DISTANCE_CACHE.stats(),
+                   "orders": get_order_store().stats(), "triage": triage_stats()}
+        await _respond(send, 200, json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                       "application/json; charset=utf-8")
+    elif path == "/metrics" and method == "GET":
+        await _respond(send, 200, metrics.render().encode("utf-8"), metrics.CONTENT_TYPE)
+    else:
+        await _respond(send, 404, b"Not Found")
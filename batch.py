@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+batch.py — v6.3.0 離線批次分析
+對整個資料夾或 JSONL manifest 的截圖重跑完整流程（OCR → 抽地址 → 補全 → Maps → 報告），
+結果以 JSONL / CSV 串流輸出，並附各階段耗時，供稽核與重新評分。
+Maps 以批次矩陣查詢（modules.maps.get_distance_durations）：每累積 --maps-batch 筆或 OCR 暫時沒有
+新結果時送出一批，maps_ms 為該批耗時。送出前先以離線估算預篩（預估明顯低於門檻的不查），
+Maps 無結果的改用估算；distance_source 欄記錄距離來源。
+加 --record-orders 時成功的結果一併寫入訂單歷史（modules.order_store，背景批次寫入）。
+
+manifest 每行一筆：{"id": "...", "path": "xxx.jpg"}；
+若帶 "ocr_text" 則略過 OCR 直接重算（舊訂單重新評分用）。
+
+用法：
+    python batch.py uploads/ --out results.jsonl
+    python batch.py orders.jsonl --format csv --out results.csv --ocr-workers 8 --maps-concurrency 4 --maps-batch 50
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+from app import extract_addresses, check_blacklist
+from modules.analysis import analyze_order, threshold_for
+from modules.distance_estimate import (
+    Estimate, SOURCE_NONE, estimate as estimate_distance, prefilter_reject, prefiltered, resolve,
+)
+from modules.features import Features, scan as scan_features
+from modules.maps import get_distance_durations
+from modules.ocr_engine import OCREngine, OCR_WORKERS
+from modules.order_store import OrderRecord, OrderStore, get_store as get_order_store
+from modules.postal_lookup import compose_clean_address
+
+logger = logging.getLogger("batch")
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+CSV_FIELDS = [
+    "id", "path", "platform", "amount", "pickup", "dropoff", "pickup_clean", "dropoff_clean",
+    "km", "mins", "distance_source", "blacklist", "earning_per_km", "error",
+    "read_ms", "ocr_ms", "extract_ms", "enrich_ms", "maps_ms", "analyze_ms", "total_ms",
+]
+
+
+# ───────────────────────────────────────────────
+# 輸入
+# ───────────────────────────────────────────────
+def iter_items(src: str) -> Iterator[Dict[str, Any]]:
+    if os.path.isdir(src):
+        for name in sorted(os.listdir(src)):
+            if name.lower().endswith(IMAGE_EXTS):
+                yield {"id": os.path.splitext(name)[0], "path": os.path.join(src, name)}
+        return
+    base = os.path.dirname(os.path.abspath(src))
+    with open(src, "r", encoding="utf-8") as f:
+        for n, ln in enumerate(f, 1):
+            ln = ln.strip()
+            if not ln:
+                continue
+            item = json.loads(ln)
+            path = item.get("path")
+            if path and not os.path.isabs(path):
+                item["path"] = os.path.join(base, path)
+            item.setdefault("id", str(item.get("path") or n))
+            yield item
+
+
+# ───────────────────────────────────────────────
+# 輸出
+# ───────────────────────────────────────────────
+class ResultWriter:
+    def __init__(self, fp: TextIO, fmt: str):
+        self.fp = fp
+        self.fmt = fmt
+        self._csv = csv.DictWriter(fp, fieldnames=CSV_FIELDS, extrasaction="ignore") if fmt == "csv" else None
+        if self._csv:
+            self._csv.writeheader()
+
+    def write(self, row: Dict[str, Any]) -> None:
+        if self._csv:
+            flat = dict(row)
+            flat.update(row.get("timings", {}))
+            self._csv.writerow(flat)
+        else:
+            self.fp.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.fp.flush()
+
+
+# ───────────────────────────────────────────────
+# 各階段
+# ───────────────────────────────────────────────
+def _ms(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000.0, 1)
+
+def _extract_stage(row: Dict[str, Any], ocr_text: str) -> Features:
+    t0 = time.perf_counter()
+    feats = scan_features(ocr_text)
+    row["platform"], row["amount"] = feats.platform, feats.amount
+    row["pickup"], row["dropoff"] = extract_addresses(ocr_text)
+    row["timings"]["extract_ms"] = _ms(t0)
+    return feats
+
+Pending = Tuple[Dict[str, Any], str, Features]
+
+def _enrich(row: Dict[str, Any]) -> bool:
+    """補全地址；回傳是否需要查 Maps"""
+    t0 = time.perf_counter()
+    pickup, dropoff = row["pickup"], row["dropoff"]
+    pick_c = compose_clean_address(pickup) if "辨識中" not in pickup else pickup
+    drop_c = compose_clean_address(dropoff) if "辨識中" not in dropoff else dropoff
+    row["pickup_clean"], row["dropoff_clean"] = pick_c, drop_c
+    row["km"], row["mins"], row["distance_source"] = 0.0, 0.0, SOURCE_NONE
+    row["timings"]["enrich_ms"] = _ms(t0)
+    return not (pick_c == drop_c or ("辨識中" in pick_c and "辨識中" in drop_c))
+
+def _analyze(row: Dict[str, Any], ocr_text: str, feats: Features) -> None:
+    t0 = time.perf_counter()
+    km, mins = row["km"], row["mins"]
+    row["blacklist"] = check_blacklist(ocr_text + " " + row["pickup"] + " " + row["dropoff"])
+    row["report"] = analyze_order(ocr_text, km, mins, row["pickup"], row["dropoff"], row["blacklist"],
+                                  features=feats, distance_source=row["distance_source"])
+    row["earning_per_km"] = round(row["amount"] / km, 2) if km > 0 else 0.0
+    row["timings"]["analyze_ms"] = _ms(t0)
+
+def _route_batch(items: List[Pending]) -> None:
+    """在 thread pool 內執行：逐筆補全與離線預篩 → 整批 Maps 矩陣查詢（無結果用估算）→ 逐筆黑名單與報告；
+    單筆失敗只標記該筆"""
+    need: List[Tuple[Dict[str, Any], Optional[Estimate]]] = []
+    for row, _, _ in items:
+        try:
+            if not _enrich(row):
+                continue
+            est = estimate_distance(row["pickup_clean"], row["dropoff_clean"])
+            if prefilter_reject(row["amount"], est, threshold_for(row["platform"])):
+                row["km"], row["mins"], row["distance_source"] = prefiltered(est)
+            else:
+                need.append((row, est))
+        except Exception as e:
+            row["error"] = f"enrich: {e}"
+
+    t0 = time.perf_counter()
+    if need:
+        routes = get_distance_durations([(r["pickup_clean"], r["dropoff_clean"]) for r, _ in need])
+        for (row, est), (km, mins) in zip(need, routes):
+            row["km"], row["mins"], row["distance_source"] = resolve(km, mins, est)
+    maps_ms = _ms(t0)
+    need_ids = {id(r) for r, _ in need}
+
+    for row, ocr_text, feats in items:
+        row["timings"]["maps_ms"] = maps_ms if id(row) in need_ids else 0.0
+        if row.get("error"):
+            continue
+        try:
+            _analyze(row, ocr_text, feats)
+        except Exception as e:
+            row["error"] = f"analyze: {e}"
+
+
+# ───────────────────────────────────────────────
+# 主流程
+# ───────────────────────────────────────────────
+def run(items: Iterator[Dict[str, Any]], writer: ResultWriter, ocr_workers: int = OCR_WORKERS,
+        maps_concurrency: int = 4, window: Optional[int] = None, maps_batch: int = 25,
+        store: Optional[OrderStore] = None) -> Dict[str, int]:
+    """OCR 走行程池、Maps 走執行緒池（批次矩陣查詢）；兩者同時進行，完成一批寫一批"""
+    engine = OCREngine(workers=ocr_workers)
+    maps_pool = ThreadPoolExecutor(max_workers=max(1, maps_concurrency), thread_name_prefix="maps")
+    window = window or max(2, 2 * max(1, ocr_workers), maps_batch)
+    ocr_futs: Dict[Future, Dict[str, Any]] = {}
+    route_futs: Dict[Future, List[Pending]] = {}
+    pending: List[Pending] = []
+    counts = {"done": 0, "failed": 0}
+    it = iter(items)
+    exhausted = False
+
+    def finish(row: Dict[str, Any]) -> None:
+        row["timings"]["total_ms"] = _ms(row.pop("_t0"))
+        writer.write(row)
+        counts["failed" if row.get("error") else "done"] += 1
+        if store is not None and not row.get("error"):
+            store.record(OrderRecord.build(row["platform"], row["amount"], row["pickup"], row["dropoff"],
+                                           row["km"], row["mins"], row["blacklist"], row["distance_source"],
+                                           str(row["id"])))
+
+    def start_route(row: Dict[str, Any], ocr_text: str) -> None:
+        try:
+            feats = _extract_stage(row, ocr_text)
+        except Exception as e:
+            row["error"] = f"extract: {e}"
+            finish(row)
+            return
+        pending.append((row, ocr_text, feats))
+        if len(pending) >= maps_batch:
+            flush()
+
+    def flush() -> None:
+        nonlocal pending
+        if pending:
+            route_futs[maps_pool.submit(_route_batch, pending)] = pending
+            pending = []
+
+    def feed() -> None:
+        nonlocal exhausted
+        # Maps 跟不上時暫停餵 OCR，避免待處理結果無限堆積
+        while not exhausted and len(ocr_futs) < window and len(route_futs) * maps_batch < 2 * window:
+            item = next(it, None)
+            if item is None:
+                exhausted = True
+                return
+            row = {"id": item.get("id"), "path": item.get("path"), "error": "",
+                   "timings": {}, "_t0": time.perf_counter()}
+            if item.get("ocr_text") is not None:
+                row["timings"]["ocr_ms"] = 0.0
+                start_route(row, item["ocr_text"])
+                continue
+            t0 = time.perf_counter()
+            try:
+                with open(item["path"], "rb") as f:
+                    data = f.read()
+            except Exception as e:
+                row["error"] = f"read: {e}"
+                finish(row)
+                continue
+            row["timings"]["read_ms"] = _ms(t0)
+            ocr_futs[engine.submit(data)] = row
+
+    try:
+        feed()
+        if not ocr_futs:
+            flush()
+        while ocr_futs or route_futs:
+            done, _ = wait(list(ocr_futs) + list(route_futs), return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut in ocr_futs:
+                    row = ocr_futs.pop(fut)
+                    try:
+                        text, secs = fut.result()
+                    except Exception as e:
+                        row["error"] = f"ocr: {e}"
+                        finish(row)
+                        continue
+                    row["timings"]["ocr_ms"] = round(secs * 1000.0, 1)
+                    row["ocr_chars"] = len(text)
+                    start_route(row, text)
+                else:
+                    batch = route_futs.pop(fut)
+                    try:
+                        fut.result()
+                    except Exception as e:
+                        for row, _, _ in batch:
+                            row["error"] = row.get("error") or f"route: {e}"
+                    for row, _, _ in batch:
+                        finish(row)
+            feed()
+            # OCR 暫時沒有在跑（或都已送出）就不再等湊滿一批
+            if not ocr_futs:
+                flush()
+    finally:
+        maps_pool.shutdown(wait=True)
+        engine.shutdown()
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="delivery_ai 離線批次分析")
+    ap.add_argument("input", help="截圖資料夾或 JSONL manifest")
+    ap.add_argument("--out", default="-", help="輸出檔（預設 stdout）")
+    ap.add_argument("--format", choices=("jsonl", "csv"), default=None, help="預設依 --out 副檔名判斷")
+    ap.add_argument("--ocr-workers", type=int, default=OCR_WORKERS)
+    ap.add_argument("--maps-concurrency", type=int, default=4)
+    ap.add_argument("--maps-batch", type=int, default=25, help="每次矩陣查詢最多帶幾筆訂單")
+    ap.add_argument("--record-orders", action="store_true", help="成功的結果寫入訂單歷史")
+    args = ap.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.out.lower().endswith(".csv") else "jsonl")
+    fp = sys.stdout if args.out == "-" else open(args.out, "w", encoding="utf-8", newline="")
+    store = get_order_store() if args.record_orders else None
+    t0 = time.perf_counter()
+    try:
+        counts = run(iter_items(args.input), ResultWriter(fp, fmt),
+                     ocr_workers=args.ocr_workers, maps_concurrency=args.maps_concurrency,
+                     maps_batch=max(1, args.maps_batch), store=store)
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+        if store is not None:
+            store.close()
+    elapsed = time.perf_counter() - t0
+    total = counts["done"] + counts["failed"]
+    print(f"完成 {counts['done']} 筆、失敗 {counts['failed']} 筆，耗時 {elapsed:.1f}s"
+          f"（{total / elapsed if elapsed else 0:.2f} 筆/秒）", file=sys.stderr)
+    return 0 if counts["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+bench/bench_extract.py
+地址抽取基準：舊版（bench/legacy_extract.py）vs modules/address_extract.py
+1. 逐筆比對 (pickup, dropoff) 必須完全相同，否則以非 0 結束。
+   例外：帶 expected 的樣本是刻意與舊版不同的行為（legacy_diff 說明原因，例如「取餐地點」錨點），
+   改比 expected，並列為 diverged。
+2. 各自重複跑 --repeat 次，輸出每筆平均耗時與加速倍數。
+
+用法：python -m bench.bench_extract [--corpus bench/corpus/ocr_texts.jsonl] [--repeat 200]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from typing import Callable, Dict, List, Tuple
+
+from bench.legacy_extract import extract_addresses as legacy_extract
+from modules.address_extract import extract
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "corpus", "ocr_texts.jsonl")
+
+
+def load_corpus(path: str) -> List[Dict[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(ln) for ln in f if ln.strip()]
+
+def _time_per_item(fn: Callable[[str], Tuple[str, str]], texts: List[str], repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for t in texts:
+            fn(t)
+    return (time.perf_counter() - t0) / (repeat * len(texts))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="地址抽取基準")
+    ap.add_argument("--corpus", default=DEFAULT_CORPUS)
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args(argv)
+
+    # 兩邊都會逐行打 log，計時時關掉
+    logging.disable(logging.CRITICAL)
+    corpus = load_corpus(args.corpus)
+    texts = [row["text"] for row in corpus]
+
+    mismatches = diverged = 0
+    for row in corpus:
+        old = legacy_extract(row["text"])
+        new = extract(row["text"]).pair
+        want = row.get("expected")
+        if want is not None:
+            want = (want["pickup"], want["dropoff"])
+            if new != want:
+                mismatches += 1
+                print(f"[MISMATCH] {row.get('id')}: expected={want} new={new}", file=sys.stderr)
+            elif old != new:
+                diverged += 1
+                print(f"[DIVERGED] {row.get('id')}（{row.get('legacy_diff', '')}）: legacy={old} new={new}")
+        elif old != new:
+            mismatches += 1
+            print(f"[MISMATCH] {row.get('id')}: legacy={old} new={new}", file=sys.stderr)
+
+    old_s = _time_per_item(legacy_extract, texts, args.repeat)
+    new_s = _time_per_item(lambda t: extract(t).pair, texts, args.repeat)
+    print(f"corpus={len(texts)} repeat={args.repeat}")
+    print(f"legacy  {old_s * 1e6:8.1f} µs/筆")
+    print(f"single  {new_s * 1e6:8.1f} µs/筆  ({old_s / new_s if new_s else 0:.1f}x)")
+    print(f"mismatch {mismatches}  diverged {diverged}（刻意與舊版不同）")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+bench/fake_maps.py
+本機假 Distance Matrix 伺服器（基準測試用，不打 Google）：
+- 回應格式與 /maps/api/distancematrix/json 相同。
+- 距離由 origins/destinations 字串雜湊決定（同一組地址每次結果一樣），可加固定延遲模擬網路。
+- 地址含 "FAIL" 時回 ZERO_RESULTS，方便測負向快取。
+
+用法：
+    with FakeMapsServer(latency_ms=20) as srv:
+        os.environ["MAPS_API_URL"] = srv.url
+"""
+
+import json
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_route(origin: str, destination: str) -> Tuple[int, int]:
+    """回傳 (公尺, 秒)"""
+    h = int(hashlib.md5(f"{origin}|{destination}".encode("utf-8")).hexdigest()[:8], 16)
+    meters = 300 + h % 12000
+    return meters, int(meters / 7.5) + 60
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        q = parse_qs(urlparse(self.path).query)
+        origins = q.get("origins", [""])[0].split("|")
+        dests = q.get("destinations", [""])[0].split("|")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        rows = []
+        for o in origins:
+            elements = []
+            for d in dests:
+                if "FAIL" in o or "FAIL" in d:
+                    elements.append({"status": "ZERO_RESULTS"})
+                    continue
+                meters, secs = fake_route(o, d)
+                elements.append({
+                    "status": "OK",
+                    "distance": {"text": f"{meters / 1000:.1f} 公里", "value": meters},
+                    "duration": {"text": f"{secs // 60} 分鐘", "value": secs},
+                })
+            rows.append({"elements": elements})
+        body = json.dumps({"status": "OK", "origin_addresses": origins,
+                           "destination_addresses": dests, "rows": rows}, ensure_ascii=False).encode("utf-8")
+        with self.server.lock:
+            self.server.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class FakeMapsServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0.0):
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency_ms / 1000.0
+        self.httpd.requests = 0
+        self.httpd.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-maps", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/maps/api/distancematrix/json"
+
+    @property
+    def requests(self) -> int:
+        return self.httpd.requests
+
+    def start(self) -> "FakeMapsServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FakeMapsServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="假 Distance Matrix 伺服器")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    args = ap.parse_args()
+    srv = FakeMapsServer(port=args.port, latency_ms=args.latency_ms)
+    print(f"MAPS_API_URL={srv.url}")
+    try:
+        srv.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+bench/legacy_extract.py
+app.py v6.2.1 的地址抽取（多次掃描版），原樣保留作為 bench/bench_extract.py 的比對基準。
+"""
+
+import re
+import logging
+from typing import List, Optional, Tuple
+
+from modules.postal_lookup import normalize_address
+
+logger = logging.getLogger("bench.legacy")
+
+
+_TW_CITY = r"(台北市|新北市|桃園市|台中市|台南市|高雄市|基隆市|新竹市|嘉義市|新竹縣|苗栗縣|彰化縣|南投縣|雲林縣|嘉義縣|屏東縣|宜蘭縣|花蓮縣|台東縣|澎湖縣|連江縣|金門縣)"
+_TW_ROAD = r"[^\s\d]+(?:路|街|大道|巷|弄)[^,\s]*"
+_ADDR_LIKE = re.compile(rf"{_TW_CITY}|{_TW_ROAD}|(\d+號)")
+
+def _is_addr_like(s: str) -> bool:
+    s2 = normalize_address(s)
+    return bool(_ADDR_LIKE.search(s2))
+
+def _cleanup_line(s: str) -> str:
+    s = s.strip()
+    s = s.replace("：", ":").replace("公司:", "")  # 去掉常見干擾前綴
+    s = re.sub(r"\s+", " ", s)
+    return s
+
+def _pick_best_addr(cands: List[str]) -> Optional[str]:
+    """在候選行中挑最像地址的一行；若無則 None"""
+    scored = []
+    for c in cands:
+        s = normalize_address(_cleanup_line(c))
+        score = 0
+        if re.search(_TW_CITY, s): score += 3
+        if re.search(_TW_ROAD, s): score += 3
+        if re.search(r"\d+號", s): score += 2
+        if re.search(r"\d{3,6}", s): score += 1  # 郵遞區或門牌數字
+        scored.append((score, s))
+    scored.sort(reverse=True)
+    return scored[0][1] if scored and scored[0][0] >= 3 else None
+
+def _are_same_addr(a: str, b: str) -> bool:
+    sa = re.sub(r"[^一-龥a-zA-Z0-9]", "", normalize_address(a))
+    sb = re.sub(r"[^一-龥a-zA-Z0-9]", "", normalize_address(b))
+    return bool(sa) and sa == sb
+
+def extract_addresses(ocr_text: str) -> Tuple[str, str]:
+    """
+    改良版：明確以「送餐資訊」區塊抽 dropoff；
+    取餐地址優先用 (O) 行與其後 1-3 行；若缺，再用「送餐資訊」之前最後一個地址樣式行。
+    若兩者相同，啟動候補策略避免重複。
+    """
+    if not ocr_text:
+        return "辨識中/無法擷取", "辨識中/無法擷取"
+
+    raw_lines = [ln for ln in ocr_text.splitlines()]
+    lines = [ln for ln in (l.strip() for l in raw_lines) if ln.strip()]
+    logger.info(f"[ADDR] OCR 行數：{len(lines)}")
+    logger.info(f"[ADDR] 片段預覽：{lines[:8]}")
+
+    # 1) 找送餐資訊區塊作為 dropoff
+    idx_drop_hdr = -1
+    for i, ln in enumerate(lines):
+        if "送餐資訊" in ln.replace(" ", ""):
+            idx_drop_hdr = i
+            break
+
+    drop = None
+    if idx_drop_hdr >= 0:
+        cand = lines[idx_drop_hdr + 1 : idx_drop_hdr + 5]
+        logger.info(f"[ADDR] 送餐資訊候選：{cand}")
+        drop = _pick_best_addr(cand)
+
+        # 若 pick_best 失敗，合併看看
+        if not drop:
+            merged = normalize_address(_cleanup_line("".join(cand)))
+            if _is_addr_like(merged):
+                drop = merged
+
+    # 2) 取餐地址：優先 (O) 起始行之後 1-3 行
+    pick = None
+    idx_o = -1
+    for i, ln in enumerate(lines):
+        if ln.strip().startswith("(O)") or ln.strip().startswith("O)"):
+            idx_o = i
+            break
+    if idx_o >= 0:
+        cand = lines[idx_o + 1 : idx_o + 4]
+        logger.info(f"[ADDR] 取餐(O)候選：{cand}")
+        pick = _pick_best_addr(cand)
+        if not pick:
+            # (O) 行本身有時包含地址
+            if _is_addr_like(lines[idx_o]):
+                pick = normalize_address(_cleanup_line(lines[idx_o]))
+
+    # 3) 若還沒有 pick，用「送餐資訊之前」最後一個像地址的行
+    if not pick and idx_drop_hdr > 0:
+        back = [ln for ln in lines[:idx_drop_hdr] if _is_addr_like(ln)]
+        if back:
+            pick = normalize_address(_cleanup_line(back[-1]))
+            logger.info(f"[ADDR] 取餐回溯候選：{back[-3:]} -> {pick}")
+
+    # 4) 若還沒有 drop，從「送餐資訊之後」挑第一個像地址的行
+    if not drop:
+        fwd = [ln for ln in lines[idx_drop_hdr + 1 :]] if idx_drop_hdr >= 0 else lines
+        fwd = [ln for ln in fwd if _is_addr_like(ln)]
+        if fwd:
+            drop = normalize_address(_cleanup_line(fwd[0]))
+            logger.info(f"[ADDR] 送達回溯候選：{fwd[:3]} -> {drop}")
+
+    # 5) 最終保底
+    if not pick:
+        pick = "辨識中/無法擷取"
+    if not drop:
+        drop = "辨識中/無法擷取"
+
+    # 6) 去重複策略：若相同，嘗試替換另一候補
+    if _are_same_addr(pick, drop):
+        logger.warning(f"[ADDR] 取餐/送達相同，啟動去重複策略：{pick}")
+        # 嘗試：送達改用送餐資訊塊中的次佳
+        if idx_drop_hdr >= 0:
+            cand = lines[idx_drop_hdr + 1 : idx_drop_hdr + 6]
+            # 去掉與 pick 相同者
+            alt = [c for c in cand if not _are_same_addr(c, pick)]
+            drop2 = _pick_best_addr(alt)
+            if drop2 and not _are_same_addr(drop2, pick):
+                drop = drop2
+        # 若仍相同，嘗試取餐用 (O) 前一個地址行
+        if _are_same_addr(pick, drop):
+            left = [ln for ln in lines[: max(idx_o, 0)] if _is_addr_like(ln)]
+            if left:
+                pick2 = normalize_address(_cleanup_line(left[-1]))
+                if not _are_same_addr(pick2, drop):
+                    pick = pick2
+
+        # 仍相同就只保留送達，取餐標記
+        if _are_same_addr(pick, drop):
+            pick = "辨識中/無法擷取(疑同送達)"
+
+    logger.info(f"[ADDR] 最終取餐：{pick}")
+    logger.info(f"[ADDR] 最終送達：{drop}")
+    return pick, drop
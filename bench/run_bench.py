@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+bench/run_bench.py
+訂單流程黃金語料基準 + 回歸檢查：
+1. 語料：bench/corpus/golden.jsonl，每筆含 ocr_text 與 expected（platform / amount / pickup / dropoff），
+   可帶 image（repo 內的三張截圖都在語料中）；加 --ocr 時另外實跑 OCR 並計算 OCR 後的準確率。
+2. 分階段量測 p50 / p99 與吞吐：ocr、extract（平台/金額/地址）、compose（補全）、blacklist、maps、report。
+   Maps 打本機假伺服器（bench/fake_maps.py），走真正的 HTTP client 與回應解析，但不經快取。
+3. 回歸：與 --baseline 比較；準確率下降或任一階段 p50/p99 變慢超過門檻即以非 0 結束。
+   基準檔（機器相關，不進版控）不存在時直接失敗；--save-baseline 建立新基準，
+   --no-baseline 明確表示只檢查 --min-accuracy。
+4. 沒跑到的階段（未加 --ocr、缺郵遞區號表、沒有可查 Maps 的地址）列在 skipped 並印出；
+   基準有量測、這次卻略過的階段視為回歸。
+5. 版面：帶 ocr_data（image_to_data 的 DICT 輸出與影像寬高）的語料以 modules.layout 建版面，
+   同一份輸入分別用版面抽取與逐行文字抽取，layout_accuracy / layout_text_accuracy 並列比較（OCR_LAYOUT 預設關閉的依據）。
+   ocr_data.source：hand（依 repo 截圖手動標出的行與座標）、synthetic（依 ocr_text 排成手機直式版面）、
+   tesseract（--record-ocr-data 以 tesseract 對語料中的截圖重新錄製並寫回語料檔）。
+   目前結果（10 筆：hand 3、synthetic 7，40 欄位）：layout 0.8500 / 逐行文字 0.9000；
+   版面差在 panda_same_dedupe（取餐/送達同地址時沒有逐行文字的去重複回溯）。
+
+用法：
+    python -m bench.run_bench [--repeat 50] [--ocr] [--baseline bench/baseline.json] [--save-baseline | --no-baseline]
+    python -m bench.run_bench --record-ocr-data
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+from typing import Any, Callable, Dict, List, Optional
+
+from bench.fake_maps import FakeMapsServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_CORPUS = os.path.join(BENCH_DIR, "corpus", "golden.jsonl")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+FIELDS = ("platform", "amount", "pickup", "dropoff")
+STAGES = ("ocr", "extract", "layout", "compose", "blacklist", "maps", "report")
+
+
+# ───────────────────────────────────────────────
+# 量測
+# ───────────────────────────────────────────────
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(pct / 100.0 * (len(s) - 1))))]
+
+class StageTimer:
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[float]] = {}
+
+    def run(self, stage: str, fn: Callable, *args, **kwargs) -> Any:
+        t0 = time.perf_counter()
+        out = fn(*args, **kwargs)
+        self.samples.setdefault(stage, []).append((time.perf_counter() - t0) * 1000.0)
+        return out
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        out = {}
+        for stage, ms in self.samples.items():
+            total = sum(ms)
+            out[stage] = {
+                "n": len(ms),
+                "p50_ms": round(_percentile(ms, 50), 4),
+                "p99_ms": round(_percentile(ms, 99), 4),
+                "per_sec": round(len(ms) / (total / 1000.0), 1) if total else 0.0,
+            }
+        return out
+
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(ln) for ln in f if ln.strip()]
+
+def record_ocr_data(path: str, corpus: List[Dict[str, Any]]) -> int:
+    """對帶 image 的語料實跑 image_to_data（與 recognize_layout 相同的前處理），寫回 ocr_data"""
+    from modules.ocr_engine import OCR_LANG, OCR_TARGET_DPI, _image_to_data, _prepare
+    n = 0
+    for row in corpus:
+        if not row.get("image"):
+            continue
+        with open(os.path.join(ROOT_DIR, row["image"]), "rb") as f:
+            prepared = _prepare(f.read())
+        data = _image_to_data(prepared, lang=OCR_LANG, config=f"--dpi {OCR_TARGET_DPI}")
+        w, h = prepared.size
+        row["ocr_data"] = {"width": w, "height": h, "data": {k: list(v) for k, v in data.items()},
+                           "source": "tesseract"}
+        n += 1
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for row in corpus:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return n
+
+def _same(field: str, got: Any, want: Any) -> bool:
+    if field == "amount":
+        return abs(float(got) - float(want)) < 0.005
+    return got == want
+
+def _score(results: List[Dict[str, Any]], corpus: List[Dict[str, Any]]) -> Dict[str, Any]:
+    hits, total, misses = 0, 0, []
+    for got, row in zip(results, corpus):
+        for field in FIELDS:
+            want = row["expected"][field]
+            total += 1
+            if _same(field, got[field], want):
+                hits += 1
+            else:
+                misses.append({"id": row["id"], "field": field, "got": got[field], "want": want})
+    return {"accuracy": round(hits / total, 4) if total else 1.0, "fields": total, "misses": misses}
+
+
+# ───────────────────────────────────────────────
+# 主流程
+# ───────────────────────────────────────────────
+def run(corpus: List[Dict[str, Any]], repeat: int, use_ocr: bool, maps_latency_ms: float) -> Dict[str, Any]:
+    # 模組在 import 時讀環境變數，必須先設好
+    tmp = tempfile.mkdtemp(prefix="delivery_bench_")
+    os.environ.setdefault("MAPS_CACHE_DB", os.path.join(tmp, "bench.db"))
+    os.environ.setdefault("OCR_CACHE_DB", os.path.join(tmp, "bench.db"))
+    srv = FakeMapsServer(latency_ms=maps_latency_ms).start()
+    os.environ["MAPS_API_URL"] = srv.url
+
+    from modules.address_extract import extract
+    from modules.analysis import analyze_order
+    from modules.blacklist import BlacklistEngine
+    from modules.features import scan
+    from modules.layout import extract as extract_layout, from_data as layout_from_data
+    from modules.maps import _query_distance_matrix
+    from modules.postal_lookup import compose_clean_address
+
+    timer = StageTimer()
+    blacklist = BlacklistEngine(db_path=os.path.join(tmp, "none.db"), data_dir=os.path.join(BENCH_DIR, "corpus"))
+    blacklist.reload(force=True)
+    notes: List[str] = []
+    skipped: Dict[str, str] = {}
+    compose_ok = True
+    report: Dict[str, Any] = {}
+
+    def extract_stage(text: str) -> Dict[str, Any]:
+        feats = scan(text)
+        pickup, dropoff = extract(text).pair
+        return {"platform": feats.platform, "amount": feats.amount, "pickup": pickup,
+                "dropoff": dropoff, "_features": feats}
+
+    def layout_stage(ocr_data: Dict[str, Any]) -> Dict[str, Any]:
+        layout = layout_from_data(ocr_data["data"], ocr_data["width"], ocr_data["height"])
+        feats = scan(layout.text)
+        pickup, dropoff = extract_layout(layout).pair
+        return {"platform": feats.platform, "amount": feats.amount, "pickup": pickup, "dropoff": dropoff,
+                "_text": layout.text}
+
+    try:
+        # OCR（選用；需要 tesseract）
+        if not use_ocr:
+            skipped["ocr"] = "未加 --ocr"
+        else:
+            from modules.ocr_engine import OCREngine
+            engine = OCREngine(workers=1)
+            try:
+                engine.warmup()
+                ocr_results = []
+                for row in corpus:
+                    if not row.get("image"):
+                        continue
+                    with open(os.path.join(ROOT_DIR, row["image"]), "rb") as f:
+                        data = f.read()
+                    text = timer.run("ocr", engine.recognize, data)
+                    ocr_results.append((row, extract_stage(text)))
+                if ocr_results:
+                    report["ocr_accuracy"] = _score([g for _, g in ocr_results], [r for r, _ in ocr_results])
+            finally:
+                engine.shutdown()
+
+        # 版面 vs 逐行文字（同一份 image_to_data 輸入）
+        layout_rows = [row for row in corpus if row.get("ocr_data")]
+        if layout_rows:
+            by_layout, by_text = [], []
+            for i in range(repeat):
+                for row in layout_rows:
+                    got = timer.run("layout", layout_stage, row["ocr_data"])
+                    if i == 0:
+                        by_layout.append(got)
+                        by_text.append(extract_stage(got["_text"]))
+            report["layout_accuracy"] = _score(by_layout, layout_rows)
+            report["layout_text_accuracy"] = _score(by_text, layout_rows)
+            sources: Dict[str, int] = {}
+            for row in layout_rows:
+                src = row["ocr_data"].get("source", "tesseract")
+                sources[src] = sources.get(src, 0) + 1
+            report["layout_sources"] = sources
+
+        results: List[Dict[str, Any]] = []
+        for i in range(repeat):
+            for row in corpus:
+                text = row["ocr_text"]
+                got = timer.run("extract", extract_stage, text)
+                if i == 0:
+                    results.append(got)
+                pickup, dropoff = got["pickup"], got["dropoff"]
+
+                pick_c, drop_c = pickup, dropoff
+                if compose_ok:
+                    try:
+                        pick_c = timer.run("compose", compose_clean_address, pickup)
+                        drop_c = timer.run("compose", compose_clean_address, dropoff)
+                    except Exception as e:
+                        compose_ok = False
+                        skipped["compose"] = f"補全失敗（缺郵遞區號表？）：{e}"
+
+                bl = timer.run("blacklist", blacklist.match, text + " " + pickup + " " + dropoff)
+                bl_text = "、".join(bl) if bl else "未命中"
+
+                if "辨識中" in pickup or "辨識中" in dropoff:
+                    km, mins = 0.0, 0.0
+                else:
+                    km, mins, _ = timer.run("maps", _query_distance_matrix, pick_c, drop_c, "driving", "bench")
+
+                timer.run("report", analyze_order, text, km, mins, pickup, dropoff, bl_text,
+                          features=got["_features"])
+
+        report.update(_score(results, corpus))
+        report["stages"] = timer.summary()
+        for stage in STAGES:
+            if stage not in report["stages"]:
+                skipped.setdefault(stage, "沒有可量測的輸入")
+        for stage in skipped:
+            report["stages"].pop(stage, None)       # 中途失敗的階段只有部分樣本，不拿來比較
+        report["skipped"] = skipped
+        report["maps_requests"] = srv.requests
+        report["notes"] = notes
+        return report
+    finally:
+        srv.stop()
+
+
+def check_regression(result: Dict[str, Any], baseline: Optional[Dict[str, Any]], min_accuracy: float,
+                     latency_tol: float, accuracy_tol: float) -> List[str]:
+    """baseline=None 表示以 --no-baseline 明確略過基準比較"""
+    failures = []
+    if baseline is None:
+        if result["accuracy"] < min_accuracy:
+            failures.append(f"accuracy {result['accuracy']:.4f} < {min_accuracy:.4f}")
+        return failures
+
+    base_acc = baseline.get("accuracy")
+    if base_acc is not None and result["accuracy"] < base_acc - accuracy_tol:
+        failures.append(f"accuracy {result['accuracy']:.4f} < 基準 {base_acc:.4f}")
+    base_ocr = (baseline.get("ocr_accuracy") or {}).get("accuracy")
+    cur_ocr = (result.get("ocr_accuracy") or {}).get("accuracy")
+    if base_ocr is not None and cur_ocr is not None and cur_ocr < base_ocr - accuracy_tol:
+        failures.append(f"ocr_accuracy {cur_ocr:.4f} < 基準 {base_ocr:.4f}")
+    base_layout = (baseline.get("layout_accuracy") or {}).get("accuracy")
+    cur_layout = (result.get("layout_accuracy") or {}).get("accuracy")
+    if base_layout is not None and cur_layout is not None and cur_layout < base_layout - accuracy_tol:
+        failures.append(f"layout_accuracy {cur_layout:.4f} < 基準 {base_layout:.4f}")
+
+    for stage in baseline.get("stages", {}):
+        if stage not in result["stages"]:
+            reason = result.get("skipped", {}).get(stage, "未量測")
+            failures.append(f"{stage} 略過（{reason}），基準有量測")
+    for stage, cur in result["stages"].items():
+        base = baseline.get("stages", {}).get(stage)
+        if not base:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            limit = base[key] * (1.0 + latency_tol)
+            if cur[key] > limit:
+                failures.append(f"{stage} {key} {cur[key]:.3f}ms > 基準 {base[key]:.3f}ms × {1.0 + latency_tol:.2f}")
+    return failures
+
+
+def _print(result: Dict[str, Any]) -> None:
+    print(f"{'stage':<10}{'n':>7}{'p50 ms':>11}{'p99 ms':>11}{'/s':>11}")
+    for stage, s in result["stages"].items():
+        print(f"{stage:<10}{s['n']:>7}{s['p50_ms']:>11.3f}{s['p99_ms']:>11.3f}{s['per_sec']:>11.1f}")
+    print(f"accuracy {result['accuracy']:.4f}（{result['fields']} 欄位）")
+    if result.get("ocr_accuracy"):
+        print(f"ocr_accuracy {result['ocr_accuracy']['accuracy']:.4f}")
+    if result.get("layout_accuracy"):
+        print(f"layout_accuracy {result['layout_accuracy']['accuracy']:.4f}"
+              f"（同輸入逐行文字 {result['layout_text_accuracy']['accuracy']:.4f}，"
+              f"{result['layout_accuracy']['fields']} 欄位，ocr_data 來源 {result.get('layout_sources', {})}）")
+        for name, tag in (("layout_accuracy", "layout"), ("layout_text_accuracy", "text")):
+            for m in result[name]["misses"]:
+                print(f"  [MISS:{tag}] {m['id']}.{m['field']}: got={m['got']!r} want={m['want']!r}")
+    for m in result["misses"]:
+        print(f"  [MISS] {m['id']}.{m['field']}: got={m['got']!r} want={m['want']!r}")
+    for stage, reason in result.get("skipped", {}).items():
+        print(f"  [SKIP] {stage}: {reason}")
+    for n in result["notes"]:
+        print(f"  [NOTE] {n}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="訂單流程基準與回歸檢查")
+    ap.add_argument("--corpus", default=DEFAULT_CORPUS)
+    ap.add_argument("--repeat", type=int, default=50)
+    ap.add_argument("--ocr", action="store_true", help="對帶 image 的語料實跑 OCR（需要 tesseract）")
+    ap.add_argument("--maps-latency-ms", type=float, default=0.0)
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE)
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--no-baseline", action="store_true", help="不與基準比較，只檢查 --min-accuracy")
+    ap.add_argument("--min-accuracy", type=float, default=0.85, help="--no-baseline 時的準確率下限")
+    ap.add_argument("--accuracy-tolerance", type=float, default=0.0)
+    ap.add_argument("--latency-tolerance", type=float, default=0.5, help="p50/p99 可接受的變慢比例")
+    ap.add_argument("--json", default=None, help="另存完整結果")
+    ap.add_argument("--record-ocr-data", action="store_true", help="以 tesseract 重新錄製語料的 ocr_data 後結束")
+    args = ap.parse_args(argv)
+
+    if args.record_ocr_data:
+        n = record_ocr_data(args.corpus, load_corpus(args.corpus))
+        print(f"已錄製 {n} 筆 ocr_data：{args.corpus}")
+        return 0
+
+    logging.disable(logging.CRITICAL)
+    result = run(load_corpus(args.corpus), max(1, args.repeat), args.ocr, args.maps_latency_ms)
+    _print(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({k: result[k] for k in ("accuracy", "stages", "ocr_accuracy", "layout_accuracy") if k in result},
+                      f, ensure_ascii=False, indent=2)
+        print(f"已寫入基準 {args.baseline}")
+        return 0
+
+    baseline = None
+    if not args.no_baseline:
+        if not os.path.exists(args.baseline):
+            print(f"[ERROR] 找不到基準檔 {args.baseline}：先以 --save-baseline 建立，"
+                  f"或加 --no-baseline 只檢查準確率", file=sys.stderr)
+            return 2
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    failures = check_regression(result, baseline, args.min_accuracy, args.latency_tolerance,
+                                args.accuracy_tolerance)
+    for msg in failures:
+        print(f"[REGRESSION] {msg}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,35 @@
 # coding: utf-8
+"""
+modules/blacklist.py — v6.3.0
+單一黑名單引擎：
+1. 關鍵字來源：delivery_ai.db 的 blacklist 表 + data/blacklist.txt / blacklist.csv。
+2. 建成 Aho–Corasick 自動機，一次掃過文字找出所有命中（不分大小寫）。
+3. 每隔數秒檢查來源是否變動，有變動才重建，建好後整組原子替換；請求路徑上不再連 DB。
+   檔案看 mtime 與大小；DB 看 blacklist 表本身（筆數、最大 rowid、字數總和，走 modules.db 的常駐連線），
+   同一個 DB 檔的快取或訂單寫入不會再觸發重建。
+"""
 import os
 import csv
-from typing import Iterable
+import time
+import logging
+import sqlite3
+import threading
+from typing import List, NamedTuple, Optional, Tuple
 
+from modules.aho import Automaton
+from modules.db import get_db
 
-def _load_words() -> set:
-    base = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+logger = logging.getLogger(__name__)
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+_FILE_NAMES = ("blacklist.txt", "blacklist.csv")
+BLACKLIST_DB = os.getenv("BLACKLIST_DB", "delivery_ai.db")
+BLACKLIST_CHECK_INTERVAL = float(os.getenv("BLACKLIST_CHECK_INTERVAL", "5"))
+
+
+def _load_words(base: str = _DATA_DIR) -> set:
     words = set()
-    for name in ("blacklist.txt", "blacklist.csv"):
+    for name in _FILE_NAMES:
         path = os.path.join(base, name)
         if os.path.exists(path):
             if name.endswith(".txt"):
@@ -26,7 +48,124 @@ def _load_words() -> set:
     return words
 
 
-BL_WORDS = _load_words()
+def _load_db_words(db_path: str) -> List[str]:
+    if not os.path.exists(db_path):
+        return []
+    try:
+        rows = get_db(db_path).query("SELECT keyword FROM blacklist")
+    except sqlite3.OperationalError as e:
+        # DB 檔可能只有快取表（尚未建 blacklist 表）；只用 data/ 的字詞
+        logger.warning(f"[BL] 讀取黑名單表失敗，僅使用檔案字詞：{e}")
+        return []
+    return [kw.strip() for (kw,) in rows if kw and kw.strip()]
+
+def _db_signature(db_path: str) -> Tuple:
+    """DB 不存在回 (None, None)；否則以表內容摘要判斷是否變動"""
+    if not os.path.exists(db_path):
+        return (db_path, None, None)
+    try:
+        row = get_db(db_path).query_one(
+            "SELECT COUNT(*), MAX(rowid), TOTAL(LENGTH(keyword)) FROM blacklist")
+    except sqlite3.Error as e:
+        logger.error(f"[BL] 讀取黑名單表失敗：{e}")
+        return (db_path, "error", None)
+    return (db_path, row[0], row[1:])
+
+
+class _Snapshot(NamedTuple):
+    automaton: Automaton
+    version: int
+    signature: Tuple
+
+
+class BlacklistEngine:
+    def __init__(self, db_path: str = BLACKLIST_DB, data_dir: str = _DATA_DIR,
+                 check_interval: float = BLACKLIST_CHECK_INTERVAL):
+        self.db_path = db_path
+        self.data_dir = data_dir
+        self.check_interval = check_interval
+        self._snap: Optional[_Snapshot] = None
+        self._checked_at = 0.0
+        self._version = 0
+        self._lock = threading.Lock()
+
+    # ───────────────────────────────────────────
+    # 來源與重建
+    # ───────────────────────────────────────────
+    def _paths(self) -> List[str]:
+        return [os.path.join(self.data_dir, n) for n in _FILE_NAMES]
+
+    def _signature(self) -> Tuple:
+        sig = [_db_signature(self.db_path)]
+        for p in self._paths():
+            try:
+                st = os.stat(p)
+                sig.append((p, st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append((p, None, None))
+        return tuple(sig)
+
+    def has_sources(self) -> bool:
+        return any(mtime is not None for _, mtime, _ in self._snapshot().signature)
+
+    def _build(self, signature: Tuple) -> _Snapshot:
+        words = dict.fromkeys(_load_db_words(self.db_path))
+        words.update(dict.fromkeys(sorted(_load_words(self.data_dir))))
+        ac = Automaton()
+        for w in words:
+            ac.add(w.lower(), w)
+        ac.build()
+        self._version += 1
+        logger.info(f"[BL] 黑名單重建 v{self._version}：{len(ac)} 個關鍵字")
+        return _Snapshot(ac, self._version, signature)
+
+    def reload(self, force: bool = False) -> None:
+        """檢查來源是否變動，有變動（或 force）才重建；失敗時保留舊版本"""
+        with self._lock:
+            sig = self._signature()
+            self._checked_at = time.monotonic()
+            if not force and self._snap is not None and self._snap.signature == sig:
+                return
+            try:
+                self._snap = self._build(sig)
+            except Exception as e:
+                logger.error(f"[BL] 黑名單重建失敗：{e}")
+                if self._snap is None:
+                    raise
+
+    def _snapshot(self) -> _Snapshot:
+        snap = self._snap
+        if snap is None or time.monotonic() - self._checked_at >= self.check_interval:
+            self.reload()
+            snap = self._snap
+        return snap
+
+    @property
+    def version(self) -> int:
+        return self._snapshot().version
+
+    # ───────────────────────────────────────────
+    # 比對
+    # ───────────────────────────────────────────
+    def match(self, text: str) -> List[str]:
+        """回傳命中的關鍵字（原始寫法，依出現順序、不重複）"""
+        if not text:
+            return []
+        seen = {}
+        for m in self._snapshot().automaton.iter(text.lower()):
+            seen.setdefault(m.value, None)
+        return list(seen)
+
+
+_ENGINE: Optional[BlacklistEngine] = None
+_ENGINE_LOCK = threading.Lock()
+
+def get_engine() -> BlacklistEngine:
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = BlacklistEngine()
+        return _ENGINE
 
 
 def check(pickup_text: str, dropoff_text: str) -> str:
@@ -34,9 +173,7 @@ def check(pickup_text: str, dropoff_text: str) -> str:
     簡單關鍵字黑名單。任一地址命中即回 '命中'，否則 '無'。
     """
     text = " ".join([(pickup_text or ""), (dropoff_text or "")])
-    if not text:
+    if not text.strip():
         return "無"
-    for w in BL_WORDS:
-        if w and w in text:
-            return "命中"
-    return "無"
+    return "命中" if get_engine().match(text) else "無"
+
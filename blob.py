@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+modules/blob.py — v6.3.0
+圖片下載緩衝與零複製讀取：
+1. BlobBuffer：有 Content-Length 時一次配置好，否則 bytearray 攤銷成長；不再 bytes += chunk（O(n²)）。
+   超過 DOWNLOAD_MAX_BYTES 直接丟 ImageTooLargeError（有 Content-Length 時連下載都不做）。
+2. finish() 回傳裁好長度的 bytearray（可直接 pickle 給 OCR 行程池、可直接 hashlib）。
+   SDK 已回傳完整 bytes 時以 accept_bytes() 只檢查大小、原物件直接沿用，不再複製進緩衝。
+3. open_image()：以 MemoryReader 包 memoryview 交給 PIL，不再複製進 io.BytesIO。
+整張圖從網路到解碼器只複製一次（寫進緩衝）。
+"""
+
+import io
+import os
+import time
+import logging
+from typing import Iterable, Optional, Union
+
+from PIL import Image
+
+from modules.metrics import DOWNLOAD_BYTES, DOWNLOAD_REJECTED
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+class BlobBuffer:
+    def __init__(self, expected: Optional[int] = None, max_bytes: int = DOWNLOAD_MAX_BYTES):
+        self.max_bytes = max_bytes
+        if expected is not None and expected > max_bytes:
+            DOWNLOAD_REJECTED.inc()
+            raise ImageTooLargeError(f"Content-Length {expected} 超過上限 {max_bytes}")
+        self._buf = bytearray(expected or 0)
+        self._len = 0
+        self._t0 = time.perf_counter()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def write(self, chunk: BytesLike) -> None:
+        n = len(chunk)
+        end = self._len + n
+        if end > self.max_bytes:
+            DOWNLOAD_REJECTED.inc()
+            raise ImageTooLargeError(f"下載超過上限 {self.max_bytes} bytes")
+        if end <= len(self._buf):
+            self._buf[self._len:end] = chunk
+        else:
+            # 先把預先配置的空間補滿，其餘 append（bytearray 攤銷成長）
+            room = len(self._buf) - self._len
+            if room:
+                view = memoryview(chunk)
+                self._buf[self._len:] = view[:room]
+                self._buf += view[room:]
+            else:
+                self._buf += chunk
+        self._len = end
+
+    def finish(self) -> bytearray:
+        """裁掉多配置的尾端並記錄大小與耗時；之後不可再 write"""
+        if len(self._buf) > self._len:
+            del self._buf[self._len:]
+        DOWNLOAD_BYTES.observe(self._len)
+        logger.info("[DL] %d bytes / %.1fms", self._len, (time.perf_counter() - self._t0) * 1000.0)
+        return self._buf
+
+
+def read_chunks(chunks: Iterable[BytesLike], expected: Optional[int] = None,
+                max_bytes: int = DOWNLOAD_MAX_BYTES) -> bytearray:
+    buf = BlobBuffer(expected, max_bytes)
+    for chunk in chunks:
+        if chunk:
+            buf.write(chunk)
+    return buf.finish()
+
+def accept_bytes(data: BytesLike, max_bytes: int = DOWNLOAD_MAX_BYTES) -> BytesLike:
+    """已完整下載的內容：檢查大小並記錄，回傳同一個物件"""
+    if len(data) > max_bytes:
+        DOWNLOAD_REJECTED.inc()
+        raise ImageTooLargeError(f"下載超過上限 {max_bytes} bytes")
+    DOWNLOAD_BYTES.observe(len(data))
+    return data
+
+def content_length(headers) -> Optional[int]:
+    try:
+        v = headers.get("content-length") or headers.get("Content-Length")
+        return int(v) if v else None
+    except (TypeError, ValueError):
+        return None
+
+
+class MemoryReader(io.RawIOBase):
+    """唯讀、可 seek 的檔案物件，直接讀 memoryview（不複製整份資料）"""
+
+    def __init__(self, data: BytesLike):
+        super().__init__()
+        self._view = memoryview(data).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), len(self._view) - self._pos)
+        if n <= 0:
+            return 0
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        if pos < 0:
+            raise ValueError("negative seek position")
+        self._pos = pos
+        return pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def open_image(data: BytesLike) -> Image.Image:
+    return Image.open(MemoryReader(data))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+modules/db.py — v6.3.0
+delivery_ai.db 資料存取層（黑名單、Maps / OCR 快取、訂單歷史共用）：
+1. 每條執行緒一條連線（threading.local，fork 後依 pid 重建），不再每次 connect/close，
+   也不必為了跨執行緒共用連線而加鎖。
+2. 連線建立時設定 WAL、synchronous=NORMAL、mmap_size、busy_timeout、temp_store=MEMORY；
+   sqlite3 的 prepared statement 快取放大到 DB_STATEMENT_CACHE，同一句 SQL 不重新編譯。
+3. 結構遷移：MIGRATIONS 依版本號排序，以 PRAGMA user_version 記錄已套用的版本；
+   每個檔案每個行程只在第一條連線檢查一次，套用時取 BEGIN IMMEDIATE 避免多 worker 同時遷移。
+   舊版 DB（user_version=0、表已存在）因為全部是 IF NOT EXISTS，可直接升級。
+"""
+
+import os
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("DELIVERY_DB", "delivery_ai.db")
+DB_MMAP_SIZE = int(float(os.getenv("DB_MMAP_MB", "64")) * 1024 * 1024)
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "8192"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")) / 1000.0
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+# ───────────────────────────────────────────────
+# 結構遷移（只能往後加；已發佈的版本不可修改）
+# ───────────────────────────────────────────────
+MIGRATIONS: List[Tuple[int, str, Tuple[str, ...]]] = [
+    (1, "blacklist", (
+        "CREATE TABLE IF NOT EXISTS blacklist (keyword TEXT PRIMARY KEY)",
+    )),
+    (2, "distance_cache", (
+        """CREATE TABLE IF NOT EXISTS distance_cache (
+            cache_key   TEXT PRIMARY KEY,
+            origin      TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            mode        TEXT NOT NULL,
+            km          REAL NOT NULL,
+            mins        REAL NOT NULL,
+            ok          INTEGER NOT NULL,
+            expires_at  REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_distance_cache_exp ON distance_cache(expires_at)",
+    )),
+    (3, "ocr_cache", (
+        """CREATE TABLE IF NOT EXISTS ocr_cache (
+            sha256      TEXT PRIMARY KEY,
+            phash       TEXT,
+            b0 INTEGER, b1 INTEGER, b2 INTEGER, b3 INTEGER,
+            b4 INTEGER, b5 INTEGER, b6 INTEGER, b7 INTEGER,
+            ocr_text    TEXT NOT NULL,
+            platform    TEXT,
+            amount      REAL,
+            pickup      TEXT,
+            dropoff     TEXT,
+            created_at  REAL NOT NULL,
+            last_hit_at REAL NOT NULL,
+            hits        INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_ocr_cache_lru ON ocr_cache(last_hit_at)",
+    ) + tuple(f"CREATE INDEX IF NOT EXISTS idx_ocr_cache_b{i} ON ocr_cache(b{i})" for i in range(8))),
+    (4, "orders", (
+        """CREATE TABLE IF NOT EXISTS orders (
+            id              INTEGER PRIMARY KEY,
+            created_at      REAL NOT NULL,
+            hour_of_day     INTEGER NOT NULL,
+            request_id      TEXT,
+            platform        TEXT NOT NULL,
+            amount          REAL NOT NULL,
+            km              REAL NOT NULL,
+            mins            REAL NOT NULL,
+            earning_per_km  REAL NOT NULL,
+            distance_source TEXT,
+            pickup          TEXT,
+            dropoff         TEXT,
+            pickup_key      TEXT,
+            dropoff_key     TEXT,
+            blacklist       TEXT,
+            blacklist_hit   INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_orders_time"
+        " ON orders(created_at, platform, hour_of_day, amount, km, blacklist_hit)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_platform_time"
+        " ON orders(platform, created_at, hour_of_day, amount, km)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_pickup ON orders(pickup_key, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_dropoff ON orders(dropoff_key, created_at)",
+    )),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """套用尚未套用的遷移，回傳目前版本"""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    if current >= SCHEMA_VERSION:
+        return current
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 取得寫鎖後再讀一次，別的行程可能剛遷移完
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, name, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            logger.info(f"[DB] 套用遷移 v{version}（{name}）")
+            current = version
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return current
+
+
+class Database:
+    """單一 SQLite 檔；conn() 回傳目前執行緒專用的連線"""
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._migrated_pid = None
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_pid = None
+        self._opened = 0
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        pid = os.getpid()
+        with self._lock:
+            if self._migrated_pid != pid:
+                migrate(conn)
+                self._migrated_pid = pid
+            if self._conns_pid != pid:
+                # fork 前的連線屬於父行程，不可在子行程使用或關閉
+                self._conns, self._conns_pid = [], pid
+            self._conns.append(conn)
+            self._opened += 1
+        return conn
+
+    def conn(self) -> sqlite3.Connection:
+        local = self._local
+        conn = getattr(local, "conn", None)
+        if conn is None or local.pid != os.getpid():
+            conn = self._open()
+            local.conn, local.pid = conn, os.getpid()
+        return conn
+
+    # ───────────────────────────────────────────
+    # 便利方法
+    # ───────────────────────────────────────────
+    def query(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return self.conn().execute(sql, params).fetchall()
+
+    def query_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        return self.conn().execute(sql, params).fetchone()
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """單句寫入並 commit，回傳影響筆數"""
+        conn = self.conn()
+        with conn:
+            return conn.execute(sql, params).rowcount
+
+    def executemany(self, sql: str, rows: Sequence[Sequence[Any]]) -> int:
+        conn = self.conn()
+        with conn:
+            return conn.executemany(sql, rows).rowcount
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """多句寫入包成一個交易；例外時 rollback"""
+        conn = self.conn()
+        with conn:
+            yield conn
+
+    def close_all(self) -> None:
+        """關閉本行程開過的連線（關機 / 測試用）；之後 conn() 會重新開"""
+        with self._lock:
+            conns = self._conns if self._conns_pid == os.getpid() else []
+            self._conns = []
+        for c in conns:
+            try:
+                c.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"path": self.path, "connections": len(self._conns), "opened": self._opened,
+                    "schema_version": SCHEMA_VERSION}
+
+
+_DATABASES: Dict[str, Database] = {}
+_DATABASES_LOCK = threading.Lock()
+
+def get_db(path: Optional[str] = None) -> Database:
+    """同一個檔案共用一個 Database（各模組可用各自的環境變數指到不同檔案）"""
+    key = os.path.abspath(path or DB_PATH)
+    with _DATABASES_LOCK:
+        db = _DATABASES.get(key)
+        if db is None:
+            db = _DATABASES[key] = Database(path or DB_PATH)
+        return db
+
+def close_all() -> None:
+    """關閉所有 Database 在本行程開的連線（prefork master 於 fork 前呼叫，子行程不會繼承開著的連線）"""
+    with _DATABASES_LOCK:
+        dbs = list(_DATABASES.values())
+    for db in dbs:
+        db.close_all()
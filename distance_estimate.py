@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+modules/distance_estimate.py — v6.3.0
+離線距離/時間估算（不打 Maps）：
+1. 地址 → 區中心座標：城市取地址字首，缺城市時由郵遞區號表的道路索引補；
+   區中心讀 data/district_centroids.csv（city,district,lat,lon,radius_km），沒有該區時退回內建的縣市中心。
+   radius_km 為區內任一點到區中心的最大距離（保守取等面積圓半徑的 2 倍）。
+2. 直線距離（haversine）× 道路迂迴係數 = 估計公里；同一區中心時以 ESTIMATE_SAME_AREA_KM 計。
+   另算最短可能距離 min_km = 直線距離 − 兩區半徑（不乘迂迴係數，下限 0）：跨區界的短程
+   （例如中正區汀州路 → 文山區羅斯福路五段，實際約 2 km，估計 9.35 km）也不會被高估。
+3. 時間 = 市區段（前 ESTIMATE_URBAN_KM 公里）÷ 兩端縣市平均車速 + 其餘 ÷ 幹道車速 + 固定起停時間。
+用途：Maps 查詢前的預篩（以 min_km 計仍低於門檻的單才不查）、Maps 失敗或缺 API key 時的備援；
+報告會標明距離來源。
+"""
+
+import os
+import re
+import csv
+import math
+import logging
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from modules.metrics import DISTANCE_SOURCE
+from modules.postal_lookup import lookup_road, normalize_address
+
+logger = logging.getLogger(__name__)
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+CENTROIDS_PATH = os.getenv("DISTANCE_CENTROIDS_PATH", os.path.join(_DATA_DIR, "district_centroids.csv"))
+CIRCUITY = float(os.getenv("ESTIMATE_CIRCUITY", "1.35"))
+SAME_AREA_KM = float(os.getenv("ESTIMATE_SAME_AREA_KM", "1.5"))
+OVERHEAD_MIN = float(os.getenv("ESTIMATE_OVERHEAD_MIN", "1.0"))
+DEFAULT_SPEED_KMH = float(os.getenv("ESTIMATE_DEFAULT_SPEED_KMH", "30"))
+# 超過 URBAN_KM 的部分視為跨區幹道/快速道路
+URBAN_KM = float(os.getenv("ESTIMATE_URBAN_KM", "10"))
+ARTERIAL_SPEED_KMH = float(os.getenv("ESTIMATE_ARTERIAL_SPEED_KMH", "45"))
+# 以最短可能距離計算的每公里收益仍低於門檻時直接判定不划算、略過 Maps
+PREFILTER = os.getenv("ESTIMATE_PREFILTER", "1") == "1"
+# centroids 檔沒有 radius_km 欄時的區半徑
+DEFAULT_RADIUS_KM = float(os.getenv("ESTIMATE_DEFAULT_RADIUS_KM", "5"))
+
+# 距離來源（metrics label 用代碼，報告顯示 SOURCE_LABELS）
+SOURCE_MAPS = "maps"
+SOURCE_PREFILTER = "prefilter"
+SOURCE_FALLBACK = "fallback"
+SOURCE_NONE = "none"
+SOURCE_TRIAGE = "triage"
+SOURCE_LABELS = {
+    SOURCE_MAPS: "Google Maps",
+    SOURCE_PREFILTER: "離線估算（預估明顯低於門檻，未查 Maps）",
+    SOURCE_FALLBACK: "離線估算（Maps 無結果）",
+    SOURCE_NONE: "無",
+    SOURCE_TRIAGE: "分流（最短可能距離仍低於門檻，未完整辨識、未查 Maps）",
+}
+
+# 縣市中心（縣市政府附近），區中心缺資料時使用
+_CITY_CENTROIDS: Dict[str, Tuple[float, float]] = {
+    "台北市": (25.0375, 121.5637), "新北市": (25.0120, 121.4657), "桃園市": (24.9936, 121.3010),
+    "台中市": (24.1618, 120.6469), "台南市": (22.9921, 120.1851), "高雄市": (22.6207, 120.3120),
+    "基隆市": (25.1316, 121.7445), "新竹市": (24.8066, 120.9686), "嘉義市": (23.4813, 120.4538),
+    "新竹縣": (24.8270, 121.0130), "苗栗縣": (24.5651, 120.8205), "彰化縣": (24.0756, 120.5446),
+    "南投縣": (23.9026, 120.6906), "雲林縣": (23.6991, 120.5264), "嘉義縣": (23.4584, 120.2929),
+    "屏東縣": (22.6727, 120.4881), "宜蘭縣": (24.7302, 121.7631), "花蓮縣": (23.9912, 121.6200),
+    "台東縣": (22.7558, 121.1505), "澎湖縣": (23.5711, 119.5793), "金門縣": (24.4368, 118.3186),
+    "連江縣": (26.1574, 119.9514),
+}
+
+# 市區平均車速（km/h，機車/汽車外送混合的保守值）
+_CITY_SPEED_KMH: Dict[str, float] = {
+    "台北市": 18.0, "新北市": 22.0, "桃園市": 25.0, "台中市": 25.0, "台南市": 26.0, "高雄市": 25.0,
+    "基隆市": 22.0, "新竹市": 24.0, "嘉義市": 24.0,
+}
+
+_CITY_RE = re.compile("(" + "|".join(_CITY_CENTROIDS) + ")")
+_DISTRICT_RE = re.compile(r"^(.{1,3}?[區鄉鎮市])")
+
+
+class Location(NamedTuple):
+    city: str
+    district: str
+    lat: float
+    lon: float
+    level: str              # "district" / "city"
+    radius: float = 0.0     # 區內任一點到中心的最大距離（km）；縣市精度時不使用
+
+
+class Estimate(NamedTuple):
+    km: float
+    mins: float
+    level: str              # 兩端中較粗的精度
+    min_km: float = 0.0     # 最短可能距離（區精度才有意義）
+
+
+_CENTROIDS: Optional[Dict[Tuple[str, str], Tuple[float, float, float]]] = None
+_LOCK = threading.Lock()
+
+def _centroids() -> Dict[Tuple[str, str], Tuple[float, float, float]]:
+    global _CENTROIDS
+    if _CENTROIDS is None:
+        with _LOCK:
+            if _CENTROIDS is None:
+                table: Dict[Tuple[str, str], Tuple[float, float, float]] = {}
+                if os.path.exists(CENTROIDS_PATH):
+                    with open(CENTROIDS_PATH, "r", encoding="utf-8") as f:
+                        for row in csv.DictReader(f):
+                            try:
+                                city = normalize_address(row["city"])
+                                radius = float(row.get("radius_km") or DEFAULT_RADIUS_KM)
+                                table[(city, row["district"].strip())] = (float(row["lat"]), float(row["lon"]), radius)
+                            except (KeyError, TypeError, ValueError):
+                                continue
+                logger.info(f"區中心座標載入：{len(table)} 區")
+                _CENTROIDS = table
+    return _CENTROIDS
+
+
+# ───────────────────────────────────────────────
+# 地理編碼 / 距離
+# ───────────────────────────────────────────────
+def geocode(addr: str) -> Optional[Location]:
+    a = normalize_address(addr)
+    if not a or "辨識中" in a:
+        return None
+    m = _CITY_RE.search(a)
+    if m:
+        city, rest = m.group(1), a[m.end():]
+    else:
+        try:
+            hit = lookup_road(a)
+        except Exception:
+            hit = None
+        if not hit or hit.city not in _CITY_CENTROIDS:
+            return None
+        city, rest = hit.city, a
+    d = _DISTRICT_RE.match(rest)
+    district = d.group(1) if d else ""
+    pos = _centroids().get((city, district)) if district else None
+    if pos:
+        return Location(city, district, pos[0], pos[1], "district", pos[2])
+    lat, lon = _CITY_CENTROIDS[city]
+    return Location(city, "", lat, lon, "city")
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    r = 6371.0088
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    h = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * r * math.asin(math.sqrt(h))
+
+def estimate(origin: str, destination: str) -> Optional[Estimate]:
+    """兩端都能定位才回傳；同縣市但只到縣市精度時無法估（回 None）"""
+    a, b = geocode(origin), geocode(destination)
+    if a is None or b is None:
+        return None
+    level = "district" if a.level == b.level == "district" else "city"
+    if level == "city" and a.city == b.city:
+        return None
+    if (a.lat, a.lon) == (b.lat, b.lon):
+        km, min_km = SAME_AREA_KM, 0.0
+    else:
+        straight = haversine_km(a.lat, a.lon, b.lat, b.lon)
+        km = straight * CIRCUITY
+        min_km = max(0.0, straight - a.radius - b.radius) if level == "district" else 0.0
+    speed = (_CITY_SPEED_KMH.get(a.city, DEFAULT_SPEED_KMH) + _CITY_SPEED_KMH.get(b.city, DEFAULT_SPEED_KMH)) / 2
+    urban = min(km, URBAN_KM)
+    mins = (urban / speed + (km - urban) / ARTERIAL_SPEED_KMH) * 60.0 + OVERHEAD_MIN
+    return Estimate(round(km, 2), round(mins, 1), level, round(min_km, 2))
+
+def prefilter_reject(amount: float, est: Optional[Estimate], threshold: float) -> bool:
+    """區精度下，以最短可能距離計的每公里收益仍低於門檻 → 不必再查 Maps"""
+    if not PREFILTER or est is None or est.level != "district" or amount <= 0 or est.min_km <= 0:
+        return False
+    return amount / est.min_km < threshold
+
+def resolve(dist: float, dur: float, est: Optional[Estimate]) -> Tuple[float, float, str]:
+    """Maps 有結果用 Maps，否則退回離線估算；回傳 (公里, 分鐘, 來源)"""
+    if dist > 0 and dur > 0:
+        source = SOURCE_MAPS
+    elif est is not None:
+        dist, dur, source = est.km, est.mins, SOURCE_FALLBACK
+    else:
+        source = SOURCE_NONE
+    DISTANCE_SOURCE.inc(source=source)
+    return dist, dur, source
+
+def prefiltered(est: Estimate) -> Tuple[float, float, str]:
+    DISTANCE_SOURCE.inc(source=SOURCE_PREFILTER)
+    return est.km, est.mins, SOURCE_PREFILTER
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+modules/features.py — v6.3.0
+OCR 文字特徵單次掃描（app.py / analysis.py / batch.py 共用）：
+1. 一個合併的預編譯樣式走過全文一次，收集數字 token（含 $ 前綴、小數位、緊接的單位）、
+   平台樣態字詞與其位置、(xx 公里) / (xx 分鐘) 括號。
+2. 金額、平台判斷都從這份紀錄推導，規則沿用 analysis.py v6.2.3：
+   - 金額：第一個 $ 金額 → 無 $ 小數 → 無 $ 2-3 位整數；後兩者排除距離/時間語境，須落在 lo-hi。
+     數字以完整 token 判斷，不再把 "5.99" 的 "99" 當成整數金額。
+   - 平台：Uber / Foodpanda 強特徵，另加上文字中直接出現的品牌名。
+3. scan() 回傳 Features，下游直接讀欄位，不必再各自跑 regex。
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+AMOUNT_LO = 20.0
+AMOUNT_HI = 300.0
+
+_NEG_CONTEXT = re.compile(r"(公里|km|分鐘|min|小時|hr|秒|sec|公 里|分 鐘)", re.IGNORECASE)
+_NEG_WINDOW = 24
+_UNIT = re.compile(r"\s*(公里|km|分鐘|min|小時|hr)")
+_KM_UNITS = ("公里", "km")
+_MIN_UNITS = ("分鐘", "min")
+
+_UBER_MARKERS = ("現金付款", "接受", "外送(")
+_PANDA_MARKERS = ("拒絕", "上線中", "送餐資訊", "取餐地點")
+
+# 全文（已轉小寫）只掃這一次
+_SCANNER = re.compile(
+    r"(?P<kmp>\((?=\s*\d+(?:\.\d+)?\s*(?:公里|km)\s*\)))"
+    r"|(?P<minp>\((?=\s*\d+\s*(?:分鐘|min)\s*\)))"
+    r"|(?P<dollar>\$\s*)?(?P<num>\d+(?:\.\d+)?)"
+    r"|(?P<uber>uber\s*eats)"
+    r"|(?P<panda>foodpanda)"
+    r"|(?P<mark>現金付款|接受|外送(?=\()|拒絕|上線中|送餐資訊|取餐地點)"
+)
+
+
+def _is_word(ch: str) -> bool:
+    """與 re 的 \\w 一致（中文字也算）"""
+    return ch.isalnum() or ch == "_"
+
+
+@dataclass
+class NumberToken:
+    text: str                 # 數字本身（不含 $）
+    start: int
+    end: int
+    dollar: bool              # 前面緊接 $
+    bounded: bool             # 前後都不是文字（\b...\b），且不是小數的一段
+    unit: str = ""            # 緊接的 公里/km/分鐘/min/小時/hr
+
+    @property
+    def int_part(self) -> str:
+        return self.text.split(".", 1)[0]
+
+    @property
+    def decimals(self) -> int:
+        return len(self.text) - len(self.int_part) - 1 if "." in self.text else 0
+
+    @property
+    def value(self) -> float:
+        return float(self.text)
+
+
+@dataclass
+class Features:
+    platform: str = "未知平台"
+    platform_features: List[str] = field(default_factory=list)
+    amount: float = 0.0
+    numbers: List[NumberToken] = field(default_factory=list)
+    markers: Dict[str, int] = field(default_factory=dict)   # 字詞 → 第一次出現位置
+    km_paren: bool = False
+    min_paren: bool = False
+    distances_km: List[float] = field(default_factory=list)
+    durations_min: List[float] = field(default_factory=list)
+
+    def anchor(self, word: str) -> int:
+        return self.markers.get(word, -1)
+
+
+# ───────────────────────────────────────────────
+# 金額
+# ───────────────────────────────────────────────
+def _bounded_after(tok: NumberToken, text: str) -> bool:
+    return tok.end >= len(text) or not _is_word(text[tok.end])
+
+def _dollar_value(tok: NumberToken, text: str) -> Optional[float]:
+    """等同 \\$\\s*(\\d+(?:\\.\\d{2})?)\\b 的取值；不成立時回 None"""
+    after_ok = _bounded_after(tok, text)
+    if tok.decimals == 2 and after_ok:
+        return tok.value
+    if tok.decimals:
+        return float(tok.int_part)
+    return tok.value if after_ok else None
+
+def _neg_context(tok: NumberToken, text: str) -> bool:
+    return bool(_NEG_CONTEXT.search(text, tok.end, tok.end + _NEG_WINDOW))
+
+def pick_amount(feats: Features, text: str, lo: float = AMOUNT_LO, hi: float = AMOUNT_HI) -> float:
+    nums = feats.numbers
+
+    # 1) 第一個 $xx.xx 或 $xx
+    v = next((v for v in (_dollar_value(t, text) for t in nums if t.dollar) if v is not None), None)
+    if v is not None and lo <= v <= hi:
+        return v
+
+    # 2) 無 $ 的候補小數
+    for tok in nums:
+        if tok.bounded and 1 <= tok.decimals <= 2 and lo <= tok.value <= hi and not _neg_context(tok, text):
+            return tok.value
+
+    # 3) 無 $ 的候補整數
+    for tok in nums:
+        if tok.bounded and not tok.decimals and 2 <= len(tok.text) <= 3 \
+                and lo <= tok.value <= hi and not _neg_context(tok, text):
+            return tok.value
+
+    return 0.0
+
+
+# ───────────────────────────────────────────────
+# 平台
+# ───────────────────────────────────────────────
+def _platform(feats: Features, text: str) -> Tuple[str, List[str]]:
+    feats_list: List[str] = []
+    platform = "未知平台"
+    dollars = [t for t in feats.numbers if t.dollar]
+    has_dollar_two_dec = any(t.decimals == 2 and _bounded_after(t, text) for t in dollars)
+    has_dollar_int = any(2 <= len(t.int_part) <= 3 and (t.decimals or _bounded_after(t, text))
+                         for t in dollars)
+    marks = feats.markers
+
+    if feats.km_paren or feats.min_paren or any(m in marks for m in _UBER_MARKERS) or "uber eats" in marks:
+        feats_list.append("Uber 強特徵")
+        platform = "Uber Eats"
+
+    if any(m in marks for m in _PANDA_MARKERS) or "foodpanda" in marks or has_dollar_two_dec:
+        feats_list.append("Panda 強特徵")
+        platform = "Foodpanda"
+
+    # 若仍未知但為整數金額 → 傾向 Uber
+    if platform == "未知平台" and has_dollar_int and not has_dollar_two_dec:
+        feats_list.append("金額整數（無小數）")
+        platform = "Uber Eats"
+
+    return platform, feats_list
+
+
+# ───────────────────────────────────────────────
+# 掃描
+# ───────────────────────────────────────────────
+def _scan_tokens(text: str) -> Features:
+    feats = Features()
+    n = len(text)
+    for m in _SCANNER.finditer(text):
+        kind = m.lastgroup
+        if kind == "num":
+            start, end = m.span("num")
+            tok = NumberToken(
+                text=m.group("num"), start=start, end=end,
+                dollar=m.group("dollar") is not None,
+                bounded=(start == 0 or not (_is_word(text[start - 1]) or text[start - 1] == "."))
+                        and (end >= n or not _is_word(text[end])),
+            )
+            u = _UNIT.match(text, end)
+            if u:
+                tok.unit = u.group(1)
+                if tok.unit in _KM_UNITS:
+                    feats.distances_km.append(tok.value)
+                elif tok.unit in _MIN_UNITS:
+                    feats.durations_min.append(tok.value)
+            feats.numbers.append(tok)
+        elif kind == "kmp":
+            feats.km_paren = True
+        elif kind == "minp":
+            feats.min_paren = True
+        else:
+            word = "uber eats" if kind == "uber" else "外送(" if m.group(0) == "外送" else m.group(0)
+            feats.markers.setdefault(word, m.start())
+    return feats
+
+def scan(ocr_text: str, lo: float = AMOUNT_LO, hi: float = AMOUNT_HI) -> Features:
+    text = (ocr_text or "").lower()
+    feats = _scan_tokens(text)
+    feats.amount = pick_amount(feats, text, lo, hi)
+    feats.platform, feats.platform_features = _platform(feats, text)
+    return feats
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn.conf.py — v6.3.0 正式環境多行程設定
+啟動：gunicorn -c gunicorn.conf.py app:app
+
+1. preload_app：master 先 import app，再於 when_ready 呼叫 app.preload() 載入郵遞區號表與道路索引、
+   區中心座標、黑名單自動機，並跑一張合成訂單（抽取 → 補全 → 估算 → 報告，OCR_WORKERS=0 時含 OCR）。
+2. gc：設定檔載入時先 gc.disable()（preload 期間不在物件頁面之間留下回收後的空洞），
+   每次 fork 前 gc.freeze() 把既有物件移出 GC 追蹤，worker 的 GC 不會寫到共用頁面；worker 啟動後再 gc.enable()。
+3. worker 數預設為 CPU 核心數（WEB_CONCURRENCY 可覆寫），每個 worker 以 gthread 處理 GUNICORN_THREADS 個連線。
+   OCR 預設在 worker 內直接辨識（OCR_WORKERS=0），避免每個 worker 再各開一組 OCR 行程池（核心數²個行程）。
+4. DB 連線、背景工作佇列、訂單寫入執行緒、HTTP client 都依 pid 於 worker 內延遲建立；log 每個 worker 各寫
+   delivery_ai.<pid>.log（LOG_FILE 可覆寫），避免多行程同時輪替同一檔案。
+5. /metrics：預設 METRICS_MULTIPROC_DIR=/tmp/delivery_ai_metrics，when_ready 清空目錄，worker 啟動後定期寫出
+   自己的快照、結束前再寫一次，任一 worker 回應 /metrics 時合併全部行程。
+   /test 的統計、triage 略過率、入列上限（admission）仍是各 worker 自己的值，回應內附 pid 以便辨識。
+6. OCR 並行上限：ocr_engine 的 OCR_HOST_SLOTS（預設核心數）是 master import 時建立的跨行程號誌，
+   fork 後所有 worker 共用；worker 內直接辨識（OCR_WORKERS=0）或另開行程池（號誌以 OCR_MP_CONTEXT 建立，
+   可傳給 spawn 子行程）都受同一個上限，此 master 底下同時執行的 tesseract 不超過此數
+   （而非 核心數 × JOB_WORKERS × worker 數）。同一台主機上另外啟動的服務不在此上限內。
+"""
+
+import gc
+import os
+
+# 必須在 preload（import app）前設定：各模組於 import 時讀取
+os.environ.setdefault("OCR_WORKERS", "0")
+os.environ.setdefault("LOG_FILE", "delivery_ai.{pid}.log")
+os.environ.setdefault("METRICS_MULTIPROC_DIR", "/tmp/delivery_ai_metrics")
+
+gc.disable()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+preload_app = True
+
+
+def when_ready(server):
+    import app
+    from modules import metrics
+    metrics.reset_dir()
+    timings = app.preload()
+    gc.collect()
+    server.log.info(f"preload 完成：{timings}（{workers} workers × {threads} threads）")
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    from modules import metrics
+    metrics.start_flusher()
+
+
+def worker_exit(server, worker):
+    # 佇列內尚未寫入的訂單
+    from modules.order_store import get_store
+    get_store().close()
+    from modules import metrics
+    metrics.stop_flusher()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+modules/http_client.py — v6.3.0
+共用 HTTP 連線層（Maps、LINE blob 下載共用）：
+1. requests.Session + HTTPAdapter：keep-alive 連線池，每個 host 的連線數上限可調。
+2. 5xx / 429 / 連線錯誤 / 逾時：指數退避 + full jitter 重試。
+3. 每個 host 一個 circuit breaker：連續失敗達門檻即斷路，冷卻期間直接丟 CircuitOpenError，
+   冷卻後放行一個試探請求（half-open），成功才恢復。
+4. 逾時改由環境變數設定（connect / read 分開）。
+5. arequest()：ASGI 模式的 httpx.AsyncClient 走同一套重試/退避，並與同步請求共用各 host 的 circuit breaker。
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "8"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "16"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.25"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "4"))
+BREAKER_THRESHOLD = int(os.getenv("HTTP_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("HTTP_BREAKER_COOLDOWN", "30"))
+
+_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class CircuitOpenError(requests.RequestException):
+    """上游處於斷路狀態，請求未送出。"""
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN      # 放行一個試探請求
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def _backoff(attempt: int) -> float:
+    """full jitter：uniform(0, min(max, base * 2^attempt))"""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+class HttpClient:
+    def __init__(self, pool_hosts: int = HTTP_POOL_HOSTS, pool_per_host: int = HTTP_POOL_PER_HOST):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_per_host,
+                              max_retries=0, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0}
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            b = self._breakers.get(host)
+            if b is None:
+                b = self._breakers[host] = CircuitBreaker()
+            return b
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def request(self, method: str, url: str, *, timeout: Optional[Timeout] = None,
+                retries: Optional[int] = None, **kwargs: Any) -> requests.Response:
+        """送出請求；可重試錯誤依退避重試，斷路時直接丟 CircuitOpenError。
+        串流回應（stream=True）由呼叫端負責關閉。"""
+        host = urlsplit(url).netloc
+        breaker = self.breaker(host)
+        if timeout is None:
+            timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        elif not isinstance(timeout, tuple):
+            timeout = (min(HTTP_CONNECT_TIMEOUT, timeout), timeout)
+        retries = HTTP_RETRIES if retries is None else retries
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self._count("short_circuited")
+                raise CircuitOpenError(f"circuit open for {host}")
+            self._count("requests")
+            try:
+                resp = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.record_failure()
+                if attempt >= retries:
+                    self._count("failures")
+                    raise
+                logger.warning(f"[http] {host} {type(e).__name__}，第 {attempt + 1} 次重試")
+            except Exception:
+                breaker.record_failure()
+                self._count("failures")
+                raise
+            else:
+                # 429 代表上游仍在運作，只重試不計入斷路
+                if resp.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if resp.status_code not in _RETRY_STATUS:
+                    return resp
+                if attempt >= retries:
+                    self._count("failures")
+                    return resp
+                logger.warning(f"[http] {host} HTTP {resp.status_code}，第 {attempt + 1} 次重試")
+                resp.close()
+            self._count("retries")
+            time.sleep(_backoff(attempt))
+            attempt += 1
+
+    async def arequest(self, aclient: Any, method: str, url: str, *, timeout: Optional[float] = None,
+                       retries: Optional[int] = None, **kwargs: Any) -> Any:
+        """同 request()，但以 httpx.AsyncClient 送出、await 退避；回傳 httpx.Response"""
+        import httpx
+
+        host = urlsplit(url).netloc
+        breaker = self.breaker(host)
+        if timeout is None:
+            timeout = httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        retries = HTTP_RETRIES if retries is None else retries
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self._count("short_circuited")
+                raise CircuitOpenError(f"circuit open for {host}")
+            self._count("requests")
+            try:
+                resp = await aclient.request(method, url, timeout=timeout, **kwargs)
+            except httpx.TransportError as e:
+                breaker.record_failure()
+                if attempt >= retries:
+                    self._count("failures")
+                    raise
+                logger.warning(f"[http] {host} {type(e).__name__}，第 {attempt + 1} 次重試")
+            except Exception:
+                breaker.record_failure()
+                self._count("failures")
+                raise
+            else:
+                if resp.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if resp.status_code not in _RETRY_STATUS:
+                    return resp
+                if attempt >= retries:
+                    self._count("failures")
+                    return resp
+                logger.warning(f"[http] {host} HTTP {resp.status_code}，第 {attempt + 1} 次重試")
+            self._count("retries")
+            await asyncio.sleep(_backoff(attempt))
+            attempt += 1
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s: Dict[str, Any] = dict(self._stats)
+            s["breakers"] = {h: b.state for h, b in self._breakers.items()}
+        return s
+
+
+_CLIENT: Optional[HttpClient] = None
+_CLIENT_PID = None
+_CLIENT_LOCK = threading.Lock()
+
+def get_client() -> HttpClient:
+    """行程內共用 client；fork 後重建，避免共用父行程的 socket。"""
+    global _CLIENT, _CLIENT_PID
+    with _CLIENT_LOCK:
+        if _CLIENT is None or _CLIENT_PID != os.getpid():
+            _CLIENT = HttpClient()
+            _CLIENT_PID = os.getpid()
+        return _CLIENT
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+modules/jobs.py — v6.3.0
+LINE webhook 非同步工作佇列：
+1. 有界佇列 + 固定數量 worker 執行緒，webhook 驗章、入列後立即回 200。
+2. 佇列已滿時 submit() 丟出 QueueFullError（backpressure），由呼叫端決定如何回覆。
+3. stats() 提供佇列深度、等待/執行延遲（p50/p95/max）與完成/失敗/拒收計數。
+4. worker 於第一次 submit 才啟動；fork 後偵測 pid 改變會自動重建執行緒。
+5. 入列時複製 contextvars（例如 request ID），worker 在同一個 context 下執行。
+6. 公平排程：submit_for(key, ...) 依 key（LINE user）分開排隊，worker 輪流從各 key 取工作；
+   單一 key 最多 JOB_PER_KEY 筆排隊，洗版的使用者只會排在自己的隊伍後面，不會餓死其他人。
+7. 單一 key 同時最多 JOB_RUNNING_PER_KEY 筆在執行（預設同 ASGI_MAX_PER_USER），已達上限的 key 輪到時略過，
+   worker 改取下一個 key；洗版的使用者不會同時佔滿所有 worker。key 為 None（submit()）不受此限。
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 延遲樣本只保留最近 N 筆，用來估 p50/p95
+_SAMPLE_SIZE = 512
+
+
+class QueueFullError(Exception):
+    """佇列已滿，工作未被接受。"""
+
+
+class FairQueue:
+    """依 key 分開的 FIFO，get() 以 round-robin 輪流取各 key 的下一筆。
+    maxsize 為總量上限、per_key 為單一 key 排隊上限、running_per_key 為單一 key 同時執行上限（0 = 不限）；
+    get() 取走的工作做完後須呼叫 done(key)。停止訊號排在所有工作之後。"""
+
+    def __init__(self, maxsize: int, per_key: int = 0, running_per_key: int = 0):
+        self.maxsize = maxsize
+        self.per_key = per_key
+        self.running_per_key = running_per_key
+        self._queues: "OrderedDict[Any, deque]" = OrderedDict()    # 有工作的 key，依輪到的順序
+        self._running: Dict[Any, int] = {}
+        self._size = 0
+        self._stops = 0
+        self._cond = threading.Condition()
+
+    def put_nowait(self, item: Any, key: Any = None) -> None:
+        with self._cond:
+            if self._size >= self.maxsize:
+                raise queue.Full
+            q = self._queues.get(key)
+            if q is None:
+                q = self._queues[key] = deque()
+            elif self.per_key and len(q) >= self.per_key:
+                raise queue.Full
+            q.append(item)
+            self._size += 1
+            self._cond.notify()
+
+    def put_stop(self) -> None:
+        with self._cond:
+            self._stops += 1
+            self._cond.notify()
+
+    def _next_key(self) -> Tuple[bool, Any]:
+        """輪到的第一個未達執行上限的 key"""
+        for key in self._queues:
+            if key is None or not self.running_per_key or self._running.get(key, 0) < self.running_per_key:
+                return True, key
+        return False, None
+
+    def get(self) -> Any:
+        """取下一筆；佇列清空後才回傳停止訊號 None"""
+        with self._cond:
+            while True:
+                found, key = self._next_key()
+                if found:
+                    break
+                if not self._size and self._stops:
+                    self._stops -= 1
+                    return None
+                self._cond.wait()
+            q = self._queues[key]
+            item = q.popleft()
+            self._size -= 1
+            if q:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            self._running[key] = self._running.get(key, 0) + 1
+            return item
+
+    def done(self, key: Any) -> None:
+        """get() 取走的工作結束，釋出該 key 的執行名額"""
+        with self._cond:
+            n = self._running.get(key, 0) - 1
+            if n > 0:
+                self._running[key] = n
+            else:
+                self._running.pop(key, None)
+            self._cond.notify()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def keys(self) -> int:
+        return len(self._queues)
+
+
+@dataclass
+class Job:
+    fn: Callable[..., Any]
+    args: tuple = ()
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    name: str = ""
+    key: Any = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    ctx: contextvars.Context = field(default_factory=contextvars.copy_context)
+
+
+def _percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    k = min(len(s) - 1, max(0, int(round(p / 100.0 * (len(s) - 1)))))
+    return s[k]
+
+
+class JobQueue:
+    """有界工作佇列 + worker 池。"""
+
+    def __init__(self, workers: Optional[int] = None, maxsize: Optional[int] = None, name: str = "jobs",
+                 per_key: Optional[int] = None, running_per_key: Optional[int] = None):
+        self.name = name
+        self.workers = max(1, int(workers or os.getenv("JOB_WORKERS", "4")))
+        self.maxsize = max(1, int(maxsize or os.getenv("JOB_QUEUE_SIZE", "64")))
+        self.per_key = max(0, int(per_key if per_key is not None else os.getenv("JOB_PER_KEY", "8")))
+        self.running_per_key = max(0, int(running_per_key if running_per_key is not None else
+                                          os.getenv("JOB_RUNNING_PER_KEY", os.getenv("ASGI_MAX_PER_USER", "2"))))
+        self._q = FairQueue(self.maxsize, self.per_key, self.running_per_key)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._busy = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._wait_ms: deque = deque(maxlen=_SAMPLE_SIZE)
+        self._run_ms: deque = deque(maxlen=_SAMPLE_SIZE)
+
+    # ───────────────────────────────────────────
+    # 生命週期
+    # ───────────────────────────────────────────
+    def start(self) -> None:
+        """啟動 worker（可重複呼叫）。fork 後的子行程會重建佇列與執行緒。"""
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid and self._threads:
+                return
+            if self._pid is not None and self._pid != pid:
+                # 父行程的執行緒不會跟著 fork 過來，佇列內容也不屬於本行程
+                self._q = FairQueue(self.maxsize, self.per_key, self.running_per_key)
+                self._busy = 0
+            self._pid = pid
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            logger.info(f"[JOBS] {self.name} 啟動 {self.workers} 個 worker，佇列上限 {self.maxsize}")
+
+    def shutdown(self, wait: bool = True, timeout: Optional[float] = None) -> None:
+        """送出停止訊號；wait=True 時等待佇列內工作做完。"""
+        threads = list(self._threads)
+        for _ in threads:
+            self._q.put_stop()
+        if wait:
+            for t in threads:
+                t.join(timeout)
+        with self._lock:
+            self._threads = []
+
+    # ───────────────────────────────────────────
+    # 入列
+    # ───────────────────────────────────────────
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> None:
+        """非阻塞入列；佇列滿時丟出 QueueFullError。"""
+        self.submit_for(None, fn, *args, **kwargs)
+
+    def submit_for(self, key: Any, fn: Callable[..., Any], *args, **kwargs) -> None:
+        """同 submit，但排進 key 自己的隊伍（公平排程）；該 key 已排滿 per_key 筆也丟 QueueFullError。
+        同一 key 同時最多 running_per_key 筆在執行，其餘在隊伍中等。"""
+        self.start()
+        job = Job(fn=fn, args=args, kwargs=kwargs, name=getattr(fn, "__name__", "job"), key=key)
+        try:
+            self._q.put_nowait(job, key)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            logger.warning("[JOBS] %s 佇列已滿（總量 %d / 每人 %d），拒收 %s", self.name, self.maxsize,
+                           self.per_key, job.name)
+            raise QueueFullError(f"{self.name} queue full ({self.maxsize})")
+        with self._lock:
+            self._submitted += 1
+
+    # ───────────────────────────────────────────
+    # Worker
+    # ───────────────────────────────────────────
+    def _worker(self) -> None:
+        while True:
+            job = self._q.get()
+            if job is None:
+                return
+            started = time.monotonic()
+            with self._lock:
+                self._busy += 1
+                self._wait_ms.append((started - job.enqueued_at) * 1000.0)
+            ok = True
+            try:
+                job.ctx.run(job.fn, *job.args, **job.kwargs)
+            except Exception as e:
+                ok = False
+                logger.exception(f"[JOBS] {job.name} 執行失敗：{e}")
+            finally:
+                self._q.done(job.key)
+                elapsed = (time.monotonic() - started) * 1000.0
+                with self._lock:
+                    self._busy -= 1
+                    self._run_ms.append(elapsed)
+                    if ok:
+                        self._completed += 1
+                    else:
+                        self._failed += 1
+
+    # ───────────────────────────────────────────
+    # 統計
+    # ───────────────────────────────────────────
+    def depth(self) -> int:
+        return self._q.qsize()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            wait = list(self._wait_ms)
+            run = list(self._run_ms)
+            return {
+                "name": self.name,
+                "workers": self.workers,
+                "busy": self._busy,
+                "depth": self._q.qsize(),
+                "maxsize": self.maxsize,
+                "per_key": self.per_key,
+                "running_per_key": self.running_per_key,
+                "keys": self._q.keys(),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "wait_ms_p50": round(_percentile(wait, 50), 1),
+                "wait_ms_p95": round(_percentile(wait, 95), 1),
+                "wait_ms_max": round(max(wait), 1) if wait else 0.0,
+                "run_ms_p50": round(_percentile(run, 50), 1),
+                "run_ms_p95": round(_percentile(run, 95), 1),
+                "run_ms_max": round(max(run), 1) if run else 0.0,
+            }
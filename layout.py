@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+modules/layout.py — v6.3.0
+OCR 版面（image_to_data 一次取得字詞、座標、信心值）與依位置抽地址：
+1. from_data()：信心值低於 LAYOUT_MIN_CONF 的字詞在建行前就丟掉；依 tesseract 的 block/par/line 組成行，
+   記錄每行的外框與平均信心值，行依 top 排序。
+2. Layout.text 為逐行文字（平台、金額、黑名單、快取沿用既有的文字流程）。
+3. extract()：以錨點的位置切出區域，只對區域內的行評分：
+   送達  「送餐資訊」下方、同一欄、直到區塊間距（LAYOUT_BLOCK_GAP 倍行高）或 LAYOUT_DROP_SPAN 行高為止；
+   取餐  (O)/(△) 行起到「送餐資訊」上方；沒有取餐錨點時取「送餐資訊」上方 LAYOUT_PICK_SPAN 行高內。
+   兩區互不重疊，不需要 address_extract 的回溯與去重複；換行的地址合併相鄰兩行一起評分。
+   找不到「送餐資訊」錨點時才退回 address_extract.extract(text)（同一份文字，不重新辨識）。
+"""
+
+import os
+import logging
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from modules.address_extract import (
+    UNKNOWN, UNKNOWN_SAME, AddressResult, cleanup_line, extract as extract_from_text, same_key, score_address,
+)
+from modules.postal_lookup import normalize_address
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_MIN_CONF = float(os.getenv("LAYOUT_MIN_CONF", "30"))
+LAYOUT_BLOCK_GAP = float(os.getenv("LAYOUT_BLOCK_GAP", "1.5"))
+LAYOUT_DROP_SPAN = float(os.getenv("LAYOUT_DROP_SPAN", "6"))
+LAYOUT_PICK_SPAN = float(os.getenv("LAYOUT_PICK_SPAN", "6"))
+
+_DROP_ANCHOR = "送餐資訊"
+_PICK_ANCHORS = ("(O)", "O)", "(△)", "(Δ)")
+_MIN_SCORE = 3
+
+
+class Word(NamedTuple):
+    text: str
+    left: int
+    top: int
+    width: int
+    height: int
+    conf: float
+
+
+@dataclass
+class Line:
+    text: str
+    left: int
+    top: int
+    right: int
+    bottom: int
+    conf: float = -1.0                                  # 平均信心值；-1 = 不是由字詞組成（例如低解析度掃描行）
+    words: List[Word] = field(default_factory=list, repr=False)
+
+    @property
+    def height(self) -> int:
+        return self.bottom - self.top
+
+    @property
+    def compact(self) -> str:
+        return self.text.replace(" ", "")
+
+
+@dataclass
+class Layout:
+    lines: List[Line]
+    width: int
+    height: int
+    dropped: int = 0                                    # 低信心而丟棄的字詞數
+
+    @property
+    def text(self) -> str:
+        return "\n".join(l.text for l in self.lines)
+
+    def line_height(self) -> float:
+        hs = sorted(l.height for l in self.lines if l.words and l.height > 0)
+        return float(hs[len(hs) // 2]) if hs else 1.0
+
+    def find(self, pred) -> int:
+        return next((i for i, l in enumerate(self.lines) if pred(l)), -1)
+
+
+# ───────────────────────────────────────────────
+# 建立版面
+# ───────────────────────────────────────────────
+def from_data(data: Dict[str, Sequence[Any]], width: int, height: int, y_offset: int = 0,
+              extra: Sequence[Tuple[int, int, str]] = (), min_conf: float = LAYOUT_MIN_CONF) -> Layout:
+    """pytesseract.image_to_data(output_type=DICT) → Layout；extra 為辨識區域外沿用的 (top, bottom, text) 行"""
+    groups: Dict[Tuple[int, int, int], List[Word]] = {}
+    dropped = 0
+    for i, raw in enumerate(data["text"]):
+        text = (raw or "").strip()
+        if not text:
+            continue
+        conf = float(data["conf"][i])
+        if conf < min_conf:
+            dropped += 1
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        groups.setdefault(key, []).append(Word(
+            text.replace("臺", "台"), int(data["left"][i]), int(data["top"][i]) + y_offset,
+            int(data["width"][i]), int(data["height"][i]), conf,
+        ))
+
+    lines: List[Line] = []
+    for words in groups.values():
+        words.sort(key=lambda w: w.left)
+        lines.append(Line(
+            " ".join(w.text for w in words),
+            min(w.left for w in words), min(w.top for w in words),
+            max(w.left + w.width for w in words), max(w.top + w.height for w in words),
+            round(sum(w.conf for w in words) / len(words), 1), words,
+        ))
+    for top, bottom, text in extra:
+        if text.strip():
+            lines.append(Line(text.strip(), 0, top, width, bottom))
+    lines.sort(key=lambda l: (l.top, l.left))
+    if dropped:
+        logger.debug("[LAYOUT] 丟棄低信心字詞 %d 個（< %s）", dropped, min_conf)
+    return Layout(lines, width, height, dropped)
+
+
+# ───────────────────────────────────────────────
+# 依位置抽地址
+# ───────────────────────────────────────────────
+def _candidates(lines: Sequence[Line]) -> List[Tuple[int, bool, str]]:
+    """區域內每一行與相鄰兩行合併（換行的地址）→ [(分數, 是否單行, 清理後地址)]；
+    合併後分數沒有比較高時以單行為準"""
+    out = []
+    for i, l in enumerate(lines):
+        s = normalize_address(cleanup_line(l.text))
+        out.append((score_address(s), True, s))
+        if i + 1 < len(lines):
+            s2 = normalize_address(cleanup_line(l.text + lines[i + 1].text))
+            out.append((score_address(s2), False, s2))
+    return [c for c in out if c[0] >= _MIN_SCORE]
+
+def _best(lines: Sequence[Line]) -> Tuple[Optional[str], List[str]]:
+    ranked = sorted(_candidates(lines), key=lambda c: (c[0], c[1], len(c[2])), reverse=True)
+    if not ranked:
+        return None, []
+    best = ranked[0][2]
+    key = same_key(best)
+    # 同一地址的片段或加上前後雜訊的版本都不算替代地址
+    alts = []
+    for _, _, s in ranked[1:]:
+        k = same_key(s)
+        if k and k not in key and key not in k and s not in alts:
+            alts.append(s)
+    return best, alts
+
+def _same_column(line: Line, anchor: Line) -> bool:
+    # 地址縮排對齊錨點文字；完全在錨點左側的（地圖標籤、圖示）不算
+    return line.right > anchor.left
+
+def _region_below(layout: Layout, start: int, anchor: Line, span: float, gap: float) -> List[Line]:
+    lh = layout.line_height()
+    limit = anchor.bottom + span * lh
+    out: List[Line] = []
+    prev_bottom = anchor.bottom
+    for l in layout.lines[start:]:
+        if l.top > limit or l.top - prev_bottom > gap * lh:
+            break
+        if _same_column(l, anchor):
+            out.append(l)
+            prev_bottom = l.bottom
+    return out
+
+def extract(layout: Layout) -> AddressResult:
+    lines = layout.lines
+    h = layout.find(lambda l: _DROP_ANCHOR in l.compact)
+    if h < 0:
+        logger.info("[LAYOUT] 無送餐資訊錨點，改用逐行文字抽取")
+        return extract_from_text(layout.text)
+    anchor = lines[h]
+    lh = layout.line_height()
+
+    # 送達：錨點下方同一欄，直到區塊結束
+    drop_lines = _region_below(layout, h + 1, anchor, LAYOUT_DROP_SPAN, LAYOUT_BLOCK_GAP)
+    drop, drop_alt = _best(drop_lines)
+
+    # 取餐：(O)/(△) 行到送餐資訊之間；沒有錨點時取送餐資訊正上方一段
+    o = layout.find(lambda l: l.compact.startswith(_PICK_ANCHORS) and l.top < anchor.top)
+    if o >= 0:
+        pick_lines = [l for l in lines[o:h] if _same_column(l, lines[o])]
+    else:
+        tops = [l.top for l in lines]
+        lo = bisect_left(tops, anchor.top - LAYOUT_PICK_SPAN * lh)
+        pick_lines = [l for l in lines[lo:h] if _same_column(l, anchor)]
+    pick, pick_alt = _best(pick_lines)
+
+    pick = pick or UNKNOWN
+    drop = drop or UNKNOWN
+    if pick != UNKNOWN and same_key(pick) == same_key(drop):
+        pick = UNKNOWN_SAME
+    logger.info("[ADDR] 版面取餐：%s（%d 行）／送達：%s（%d 行）", pick, len(pick_lines), drop, len(drop_lines))
+    return AddressResult(pick, drop, pickup_alternates=pick_alt, dropoff_alternates=drop_alt)
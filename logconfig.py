@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+modules/logconfig.py — v6.3.0
+全行程共用的 log 管線（取代 app.py / maps.py 各自掛的同步 FileHandler）：
+1. root 只掛一個非阻塞 QueueHandler；請求執行緒只補 request_id、丟進佇列，
+   字串格式化、JSON 序列化、寫檔都在 QueueListener 執行緒做。佇列滿時丟棄並計數，不卡請求。
+2. 檔案輪替：LOG_ROTATE=size（LOG_MAX_MB × LOG_BACKUPS）或 time（LOG_ROTATE_WHEN，預設每日午夜）。
+3. 檔案為 JSON lines（LOG_FORMAT=text 可改回純文字）；主控台維持單行文字。
+4. 各模組等級：LOG_LEVELS="modules.address_extract=WARNING,modules.maps=DEBUG"。
+5. 取樣：LOG_SAMPLE="[ADDR]=0.05" —— 訊息開頭符合的 INFO/DEBUG 依 request_id 取樣
+   （同一請求的診斷行全留或全丟），WARNING 以上一律保留。
+6. fork 後子行程自動重建佇列、listener 執行緒與 handler（重新開檔，不沿用父行程的檔案物件）。
+   多行程共用同一檔案時輪替可能互相干擾；LOG_FILE 可含 {pid}（例如 logs/delivery_ai.{pid}.log）各寫各的。
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from typing import Dict, List, Optional, Tuple
+
+from modules.metrics import Counter, get_request_id
+
+LOG_FILE = os.getenv("LOG_FILE", "delivery_ai.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "1") == "1"
+LOG_ROTATE = os.getenv("LOG_ROTATE", "size")
+LOG_MAX_BYTES = int(float(os.getenv("LOG_MAX_MB", "20")) * 1024 * 1024)
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "[ADDR]=0.1")
+
+LOG_DROPPED = Counter("delivery_log_dropped_total", "log 佇列已滿而丟棄的筆數")
+LOG_SAMPLED_OUT = Counter("delivery_log_sampled_out_total", "取樣略過的診斷 log 筆數")
+
+_CONSOLE_FORMAT = "[%(levelname)s] [%(request_id)s] %(message)s"
+_TEXT_FORMAT = "%(asctime)s - %(levelname)s - [%(name)s] [%(request_id)s] %(message)s"
+
+
+def _parse_pairs(spec: str) -> List[Tuple[str, str]]:
+    out = []
+    for part in spec.split(","):
+        key, sep, value = part.strip().rpartition("=")
+        if sep and key:
+            out.append((key.strip(), value.strip()))
+    return out
+
+
+# ───────────────────────────────────────────────
+# Filter / Formatter / Handler
+# ───────────────────────────────────────────────
+class SamplingFilter(logging.Filter):
+    """前綴符合的 INFO/DEBUG 依 request_id 取樣；沒有 request_id 的逐筆輪流取樣"""
+
+    def __init__(self, rules: List[Tuple[str, float]]):
+        super().__init__()
+        self.rules = rules
+        self._n = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not isinstance(record.msg, str):
+            return True
+        for prefix, rate in self.rules:
+            if record.msg.startswith(prefix):
+                if rate >= 1.0:
+                    return True
+                rid = getattr(record, "request_id", "-")
+                if rid and rid != "-":
+                    keep = zlib.crc32(rid.encode("utf-8")) % 10000 < rate * 10000
+                else:
+                    self._n += 1
+                    keep = rate > 0 and self._n % max(1, round(1 / rate)) == 0
+                if not keep:
+                    LOG_SAMPLED_OUT.inc()
+                return keep
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False)
+
+
+class _RequestIdFilter(logging.Filter):
+    """在呼叫端執行緒補上 request_id（contextvar 到了 listener 執行緒就讀不到）"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = get_request_id()
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """不在呼叫端格式化訊息（stdlib 的 prepare() 會先做 getMessage）；佇列滿直接丟棄。
+    %-參數在 listener 執行緒才展開，傳入後不應再被修改。"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+# ───────────────────────────────────────────────
+# 設定
+# ───────────────────────────────────────────────
+_LOCK = threading.Lock()
+_STATE: Dict[str, object] = {}
+
+def _file_handler() -> Optional[logging.Handler]:
+    if not LOG_FILE:
+        return None
+    path = LOG_FILE.replace("{pid}", str(os.getpid()))
+    if LOG_ROTATE == "time":
+        fh = logging.handlers.TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN,
+                                                       backupCount=LOG_BACKUPS, encoding="utf-8")
+    else:
+        fh = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES,
+                                                  backupCount=LOG_BACKUPS, encoding="utf-8")
+    fh.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(_TEXT_FORMAT))
+    return fh
+
+def _build_handlers() -> List[logging.Handler]:
+    handlers: List[logging.Handler] = []
+    fh = _file_handler()
+    if fh is not None:
+        handlers.append(fh)
+    if LOG_CONSOLE:
+        sh = logging.StreamHandler(sys.stderr)
+        sh.setFormatter(logging.Formatter(_CONSOLE_FORMAT))
+        handlers.append(sh)
+    return handlers
+
+def _start_listener(handlers: List[logging.Handler]) -> None:
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    _STATE["queue_handler"].queue = q
+    _STATE["listener"] = listener
+    _STATE["pid"] = os.getpid()
+
+def _after_fork() -> None:
+    # listener 執行緒不會跟著 fork 過來；佇列與檔案物件的內部鎖可能停在父行程持有的狀態，整組換新
+    # （父行程的物件直接丟棄，不可 close：會 flush 到一半的緩衝）
+    if "listener" in _STATE:
+        _STATE["handlers"] = _build_handlers()
+        _start_listener(_STATE["handlers"])
+
+def setup_logging(force: bool = False) -> None:
+    """可重複呼叫；同一行程只設定一次（force=True 先關掉既有的 listener 再重建）"""
+    with _LOCK:
+        if "queue_handler" in _STATE:
+            if not force:
+                return
+            shutdown_logging()
+
+        handlers = _build_handlers()
+        qh = LazyQueueHandler(queue.Queue())
+        qh.addFilter(_RequestIdFilter())
+        rules = []
+        for prefix, rate in _parse_pairs(LOG_SAMPLE):
+            try:
+                rules.append((prefix, float(rate)))
+            except ValueError:
+                pass
+        if rules:
+            qh.addFilter(SamplingFilter(rules))
+
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            if isinstance(h, logging.handlers.QueueHandler):
+                root.removeHandler(h)
+        root.addHandler(qh)
+        root.setLevel(LOG_LEVEL.upper())
+        for name, level in _parse_pairs(LOG_LEVELS):
+            logging.getLogger(name).setLevel(level.upper())
+
+        _STATE["queue_handler"] = qh
+        _STATE["handlers"] = handlers
+        _start_listener(handlers)
+        if not _STATE.get("hooks"):
+            os.register_at_fork(after_in_child=_after_fork)
+            atexit.register(shutdown_logging)
+            _STATE["hooks"] = True
+
+def shutdown_logging() -> None:
+    """停止 listener（會先把佇列內的紀錄寫完）並關閉檔案"""
+    listener = _STATE.pop("listener", None)
+    if listener is not None and _STATE.get("pid") == os.getpid():
+        listener.stop()
+    for h in _STATE.get("handlers", []):
+        h.close()
+    qh = _STATE.pop("queue_handler", None)
+    if qh is not None:
+        logging.getLogger().removeHandler(qh)
+    _STATE.pop("handlers", None)
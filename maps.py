@@ -2,23 +2,43 @@
 """
 modules/maps.py — v6.2.1-revA
 回到 v6.2.1 的 Distance Matrix 取距離/時間邏輯；僅做極簡清理與詳細 log。
+v6.3.0：查詢前先看兩層快取（行程內 LRU + SQLite），失敗結果短期負向快取；
+        HTTP 改走共用連線池（重試 + 斷路器）；API 呼叫計時與各 status 計數。
+        log 不再自掛 FileHandler，統一由 modules.logconfig 輸出。
+        另有 aget_distance_duration()，供 ASGI 模式以 async HTTP client 查詢（共用快取與回應解析，
+        重試/退避/斷路器同 http_client；SQLite 快取讀寫丟到 executor，不卡 event loop）。
+        get_distance_durations()：多組 (取餐, 送達) 先去重、查快取，未命中者只有共用起點或終點時
+        才打包成多起點 × 多終點的矩陣請求（多出來沒人要的元素不超過 MAPS_MAX_WASTE，
+        遵守 25 / 25 / 100 元素與網址長度上限），其餘各自 1 × 1，並行送出。
 """
 
 import os
 import re
+import asyncio
 import logging
-from typing import Tuple
-from urllib.parse import urlencode
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote, urlencode
 
-import requests
+from modules.maps_cache import DistanceCache
+from modules.http_client import get_client
+from modules.metrics import MAPS_REQUESTS, span
 
 logger = logging.getLogger(__name__)
-if not logger.handlers:
-    logger.setLevel(logging.INFO)
-    fh = logging.FileHandler("delivery_ai.log", encoding="utf-8")
-    fmt = logging.Formatter("%(asctime)s - %(levelname)s - [%(name)s] %(message)s")
-    fh.setFormatter(fmt)
-    logger.addHandler(fh)
+
+MAPS_TIMEOUT = float(os.getenv("MAPS_TIMEOUT", "5"))
+# 可改指向本機假伺服器（bench/fake_maps.py）
+MAPS_API_URL = os.getenv("MAPS_API_URL", "https://maps.googleapis.com/maps/api/distancematrix/json")
+# Distance Matrix 單次請求上限
+MAPS_MAX_ORIGINS = 25
+MAPS_MAX_DESTINATIONS = 25
+MAPS_MAX_ELEMENTS = int(os.getenv("MAPS_MAX_ELEMENTS", "100"))
+MAPS_MAX_URL = int(os.getenv("MAPS_MAX_URL", "8000"))
+MAPS_BATCH_CONCURRENCY = int(os.getenv("MAPS_BATCH_CONCURRENCY", "4"))
+# 矩陣中沒有對應需求（白付費）的元素比例上限
+MAPS_MAX_WASTE = float(os.getenv("MAPS_MAX_WASTE", "0.1"))
 
 _FULL2HALF = str.maketrans({"，": ",", "：": ":", "；": ";", "（": "(", "）": ")", "　": " "})
 _MULTI_COMMA = re.compile(r"\s*,\s*")
@@ -29,7 +49,9 @@ def normalize_address(addr: str) -> str:
     s = re.sub(r"\s+", " ", s).strip(", ").strip()
     return s
 
-def get_distance_duration(origin: str, destination: str) -> Tuple[float, float]:
+DISTANCE_CACHE = DistanceCache()
+
+def get_distance_duration(origin: str, destination: str, mode: str = "driving") -> Tuple[float, float]:
     api_key = os.getenv("GOOGLE_MAPS_API_KEY", "")
     if not api_key:
         logger.error("[maps] ❌ 缺少 GOOGLE_MAPS_API_KEY")
@@ -37,40 +59,224 @@ def get_distance_duration(origin: str, destination: str) -> Tuple[float, float]:
 
     o = normalize_address(origin)
     d = normalize_address(destination)
-    logger.info(f"[maps] 📍 查詢距離：{o} → {d}")
 
+    cached = DISTANCE_CACHE.get(o, d, mode)
+    if cached:
+        logger.info("[maps] 快取命中：%s → %s = %s 公里 / %s 分鐘%s", o, d, cached.km, cached.mins,
+                    "" if cached.ok else "（負向快取）")
+        return cached.km, cached.mins
+
+    km, mins, ok = _query_distance_matrix(o, d, mode, api_key)
+    if ok is not None:
+        DISTANCE_CACHE.put(o, d, km, mins, mode=mode, ok=ok)
+    return km, mins
+
+def _distance_url(o: str, d: str, mode: str, api_key: str) -> str:
     params = {
         "origins": o,
         "destinations": d,
-        "mode": "driving",
+        "mode": mode,
         "language": "zh-TW",
         "units": "metric",
         "key": api_key,
     }
-    url = "https://maps.googleapis.com/maps/api/distancematrix/json?" + urlencode(params)
-
-    try:
-        r = requests.get(url, timeout=12)
-        data = r.json()
-    except Exception as e:
-        logger.error(f"[maps] REQUEST_FAIL: {e}")
-        return 0.0, 0.0
+    return MAPS_API_URL + "?" + urlencode(params)
 
+def _parse_distance(data: dict, o: str, d: str) -> Tuple[float, float, bool]:
     if data.get("status") != "OK":
         logger.error(f"[maps] API_STATUS: {data.get('status')}")
-        return 0.0, 0.0
+        MAPS_REQUESTS.inc(status=str(data.get("status")))
+        return 0.0, 0.0, False
 
     rows = data.get("rows", [])
     if not rows or not rows[0].get("elements"):
         logger.error("[maps] EMPTY_ELEMENTS")
-        return 0.0, 0.0
+        MAPS_REQUESTS.inc(status="EMPTY_ELEMENTS")
+        return 0.0, 0.0, False
 
     el = rows[0]["elements"][0]
     if el.get("status") != "OK":
         logger.error(f"[maps] ELEMENT_STATUS: {el.get('status')}")
-        return 0.0, 0.0
+        MAPS_REQUESTS.inc(status=f"ELEMENT_{el.get('status')}")
+        return 0.0, 0.0, False
+
+    MAPS_REQUESTS.inc(status="OK")
 
     km = round(el["distance"]["value"] / 1000.0, 2)
     mins = round(el["duration"]["value"] / 60.0, 1)
-    logger.info(f"[maps] ✅ 成功：{o} → {d} = {km} 公里 / {mins} 分鐘")
+    logger.info("[maps] ✅ 成功：%s → %s = %s 公里 / %s 分鐘", o, d, km, mins)
+    return km, mins, True
+
+def _query_distance_matrix(o: str, d: str, mode: str, api_key: str) -> Tuple[float, float, Optional[bool]]:
+    """實際呼叫 Distance Matrix；回傳 (km, mins, ok)。ok=None 表示連線層失敗（不做負向快取）"""
+    logger.info("[maps] 📍 查詢距離：%s → %s", o, d)
+    url = _distance_url(o, d, mode, api_key)
+
+    try:
+        with span("maps_api"):
+            r = get_client().get(url, timeout=MAPS_TIMEOUT)
+            data = r.json()
+    except Exception as e:
+        logger.error(f"[maps] REQUEST_FAIL: {e}")
+        MAPS_REQUESTS.inc(status="REQUEST_FAIL")
+        return 0.0, 0.0, None
+    return _parse_distance(data, o, d)
+
+# ───────────────────────────────────────────────
+# 批次（矩陣）查詢
+# ───────────────────────────────────────────────
+Pair = Tuple[str, str]
+
+def _url_cost(addr: str) -> int:
+    return len(quote(addr, safe="")) + 3    # 加上 "|" 編碼
+
+def _pack(pairs: Sequence[Pair], max_waste: float = MAPS_MAX_WASTE) -> List[Tuple[List[str], List[str]]]:
+    """
+    Distance Matrix 依元素（起點 × 終點）計費，互不相干的組合放進同一個矩陣只有對角線有用。
+    先依起點分列（1 × k，沒有浪費；超過上限的列切開），再把列合併成 |O| × |D|：
+    合併後沒有對應需求的元素佔比不超過 max_waste 才合併（共用終點的列可併成 k × 1），否則各自送出。
+    """
+    rows: Dict[str, List[str]] = {}
+    for o, d in dict.fromkeys(pairs):
+        rows.setdefault(o, []).append(d)
+
+    pieces: List[Tuple[str, List[str]]] = []
+    max_d = min(MAPS_MAX_DESTINATIONS, MAPS_MAX_ELEMENTS)
+    for o, dests in rows.items():
+        chunk: List[str] = []
+        url_len = _url_cost(o)
+        for d in dests:
+            if chunk and (len(chunk) >= max_d or url_len + _url_cost(d) > MAPS_MAX_URL):
+                pieces.append((o, chunk))
+                chunk, url_len = [], _url_cost(o)
+            chunk.append(d)
+            url_len += _url_cost(d)
+        pieces.append((o, chunk))
+    # 終點多的列先放，終點相同的列相鄰
+    pieces.sort(key=lambda p: (-len(p[1]), p[1], p[0]))
+
+    batches: List[Tuple[List[str], List[str], int, int]] = []     # (起點, 終點, 需要的元素數, 網址長度)
+    for o, dests in pieces:
+        add_len = _url_cost(o) + sum(_url_cost(d) for d in dests)
+        for i, (bo, bd, wanted, url_len) in enumerate(batches):
+            if o in bo:
+                continue
+            new_d = [d for d in dests if d not in bd]
+            n_o, n_d = len(bo) + 1, len(bd) + len(new_d)
+            cells = n_o * n_d
+            new_len = url_len + _url_cost(o) + sum(_url_cost(d) for d in new_d)
+            if (n_o <= MAPS_MAX_ORIGINS and n_d <= MAPS_MAX_DESTINATIONS and cells <= MAPS_MAX_ELEMENTS
+                    and new_len <= MAPS_MAX_URL and cells - wanted - len(dests) <= max_waste * cells):
+                batches[i] = (bo + [o], bd + new_d, wanted + len(dests), new_len)
+                break
+        else:
+            batches.append(([o], list(dests), len(dests), add_len))
+    return [(bo, bd) for bo, bd, _, _ in batches]
+
+def _query_matrix(origins: List[str], dests: List[str], mode: str,
+                  api_key: str) -> Dict[Pair, Tuple[float, float, Optional[bool]]]:
+    """一次矩陣請求；回傳每個 (o, d) 的 (km, mins, ok)，ok=None 表示連線層失敗"""
+    logger.info("[maps] 📍 矩陣查詢：%d 起點 × %d 終點", len(origins), len(dests))
+    url = _distance_url("|".join(origins), "|".join(dests), mode, api_key)
+    try:
+        with span("maps_api"):
+            r = get_client().get(url, timeout=MAPS_TIMEOUT)
+            data = r.json()
+    except Exception as e:
+        logger.error(f"[maps] REQUEST_FAIL: {e}")
+        MAPS_REQUESTS.inc(status="REQUEST_FAIL")
+        return {(o, d): (0.0, 0.0, None) for o in origins for d in dests}
+
+    if data.get("status") != "OK":
+        logger.error(f"[maps] API_STATUS: {data.get('status')}")
+        MAPS_REQUESTS.inc(status=str(data.get("status")))
+        return {(o, d): (0.0, 0.0, False) for o in origins for d in dests}
+
+    MAPS_REQUESTS.inc(status="OK")
+    out: Dict[Pair, Tuple[float, float, Optional[bool]]] = {}
+    rows = data.get("rows", [])
+    for i, o in enumerate(origins):
+        elements = rows[i].get("elements", []) if i < len(rows) else []
+        for j, d in enumerate(dests):
+            el = elements[j] if j < len(elements) else {}
+            if el.get("status") != "OK":
+                out[(o, d)] = (0.0, 0.0, False)
+                continue
+            out[(o, d)] = (round(el["distance"]["value"] / 1000.0, 2), round(el["duration"]["value"] / 60.0, 1), True)
+    return out
+
+def get_distance_durations(pairs: Sequence[Pair], mode: str = "driving",
+                           concurrency: int = MAPS_BATCH_CONCURRENCY) -> List[Tuple[float, float]]:
+    """多組 (origin, destination) → 與輸入同順序的 (km, mins)；失敗者為 (0, 0)"""
+    api_key = os.getenv("GOOGLE_MAPS_API_KEY", "")
+    if not api_key:
+        logger.error("[maps] ❌ 缺少 GOOGLE_MAPS_API_KEY")
+        return [(0.0, 0.0)] * len(pairs)
+
+    # "|" 是多地址分隔字元，地址內不可出現
+    norm = [(normalize_address(o).replace("|", " "), normalize_address(d).replace("|", " ")) for o, d in pairs]
+    results: Dict[Pair, Tuple[float, float]] = {}
+    misses: List[Pair] = []
+    for key in dict.fromkeys(norm):
+        cached = DISTANCE_CACHE.get(key[0], key[1], mode)
+        if cached:
+            results[key] = (cached.km, cached.mins)
+        else:
+            misses.append(key)
+
+    batches = _pack(misses)
+    logger.info("[maps] 批次：%d 組（去重後 %d，快取命中 %d）→ %d 個請求",
+                len(pairs), len(results) + len(misses), len(results), len(batches))
+    if batches:
+        workers = max(1, min(concurrency, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="maps-batch") as pool:
+            # 每批各自複製 context，log 帶同一個 request ID
+            futs = [pool.submit(contextvars.copy_context().run, _query_matrix, o, d, mode, api_key)
+                    for o, d in batches]
+            wanted = set(misses)
+            for answer in (f.result() for f in futs):
+                for (o, d), (km, mins, ok) in answer.items():
+                    # 矩陣中順帶算到、沒人要的組合不寫入快取
+                    if (o, d) not in wanted:
+                        continue
+                    if ok is not None:
+                        DISTANCE_CACHE.put(o, d, km, mins, mode=mode, ok=ok)
+                    results.setdefault((o, d), (km, mins))
+    return [results.get(key, (0.0, 0.0)) for key in norm]
+
+# ───────────────────────────────────────────────
+# 非同步版本（ASGI 模式用；client 為 httpx.AsyncClient 或相容物件）
+# ───────────────────────────────────────────────
+async def aget_distance_duration(origin: str, destination: str, client, mode: str = "driving",
+                                 run=None) -> Tuple[float, float]:
+    """run(fn, *args) 為執行同步函式的 awaitable（ASGI 傳入 Service.run_cpu）；預設 asyncio.to_thread"""
+    run = run or asyncio.to_thread
+    api_key = os.getenv("GOOGLE_MAPS_API_KEY", "")
+    if not api_key:
+        logger.error("[maps] ❌ 缺少 GOOGLE_MAPS_API_KEY")
+        return 0.0, 0.0
+
+    o = normalize_address(origin)
+    d = normalize_address(destination)
+
+    cached = await run(DISTANCE_CACHE.get, o, d, mode)
+    if cached:
+        logger.info("[maps] 快取命中：%s → %s = %s 公里 / %s 分鐘%s", o, d, cached.km, cached.mins,
+                    "" if cached.ok else "（負向快取）")
+        return cached.km, cached.mins
+
+    logger.info("[maps] 📍 查詢距離：%s → %s", o, d)
+    try:
+        with span("maps_api"):
+            r = await get_client().arequest(client, "GET", _distance_url(o, d, mode, api_key),
+                                            timeout=MAPS_TIMEOUT)
+            r.raise_for_status()
+            data = r.json()
+    except Exception as e:
+        logger.error(f"[maps] REQUEST_FAIL: {e}")
+        MAPS_REQUESTS.inc(status="REQUEST_FAIL")
+        return 0.0, 0.0
+
+    km, mins, ok = _parse_distance(data, o, d)
+    await run(functools.partial(DISTANCE_CACHE.put, o, d, km, mins, mode=mode, ok=ok))
     return km, mins
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+modules/maps_cache.py — v6.3.0
+Distance Matrix 結果兩層快取：
+1. L1：行程內 LRU（OrderedDict）。
+2. L2：SQLite（預設 delivery_ai.db 的 distance_cache 表，經 modules.db 的每執行緒連線），跨重啟與多 worker 共用。
+   鎖只保護 L1；L2 讀寫不佔鎖。
+3. 鍵：正規化後的 (origin, destination, mode)。
+4. 成功結果 TTL（預設 7 天）；失敗查詢做短 TTL 負向快取（預設 10 分鐘）。
+"""
+
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from modules.db import get_db
+from modules.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+MAPS_CACHE_DB = os.getenv("MAPS_CACHE_DB", "delivery_ai.db")
+MAPS_CACHE_L1_SIZE = int(os.getenv("MAPS_CACHE_L1_SIZE", "2048"))
+MAPS_CACHE_TTL = float(os.getenv("MAPS_CACHE_TTL_HOURS", "168")) * 3600
+MAPS_CACHE_NEG_TTL = float(os.getenv("MAPS_CACHE_NEG_TTL_MIN", "10")) * 60
+
+
+_KEY_STRIP = re.compile(r"[\s,，:：()（）]+")
+
+
+@dataclass
+class CachedRoute:
+    km: float
+    mins: float
+    ok: bool                 # False = 負向快取（先前查詢失敗）
+    expires_at: float
+
+
+def cache_key(origin: str, destination: str, mode: str = "driving") -> str:
+    """(origin, destination, mode) → 正規化鍵；忽略空白、標點與臺/台差異"""
+    def norm(s: str) -> str:
+        return _KEY_STRIP.sub("", (s or "").replace("臺", "台")).lower()
+    return f"{mode}|{norm(origin)}|{norm(destination)}"
+
+
+class DistanceCache:
+    def __init__(self, db_path: str = MAPS_CACHE_DB, l1_size: int = MAPS_CACHE_L1_SIZE,
+                 ttl: float = MAPS_CACHE_TTL, neg_ttl: float = MAPS_CACHE_NEG_TTL):
+        self.db_path = db_path
+        self.l1_size = l1_size
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self._l1: "OrderedDict[str, CachedRoute]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"l1_hits": 0, "l2_hits": 0, "negative_hits": 0, "misses": 0, "stores": 0}
+
+    def _db(self) -> sqlite3.Connection:
+        return get_db(self.db_path).conn()
+
+    def _l1_put(self, key: str, route: CachedRoute) -> None:
+        self._l1[key] = route
+        self._l1.move_to_end(key)
+        while len(self._l1) > self.l1_size:
+            self._l1.popitem(last=False)
+
+    def get(self, origin: str, destination: str, mode: str = "driving") -> Optional[CachedRoute]:
+        key = cache_key(origin, destination, mode)
+        now = time.time()
+        with self._lock:
+            route = self._l1.get(key)
+            if route and route.expires_at > now:
+                self._l1.move_to_end(key)
+                self._stats["l1_hits"] += 1
+                CACHE_LOOKUPS.inc(cache="maps", result="hit_l1")
+                if not route.ok:
+                    self._stats["negative_hits"] += 1
+                return route
+            if route:
+                del self._l1[key]
+        try:
+            row = self._db().execute(
+                "SELECT km, mins, ok, expires_at FROM distance_cache WHERE cache_key=? AND expires_at>?",
+                (key, now),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"[maps_cache] 讀取失敗：{e}")
+            row = None
+        with self._lock:
+            if row is None:
+                self._stats["misses"] += 1
+                CACHE_LOOKUPS.inc(cache="maps", result="miss")
+                return None
+            route = CachedRoute(km=row[0], mins=row[1], ok=bool(row[2]), expires_at=row[3])
+            if key not in self._l1:      # 讀 L2 期間別的執行緒可能剛 put 了較新的結果
+                self._l1_put(key, route)
+            self._stats["l2_hits"] += 1
+            CACHE_LOOKUPS.inc(cache="maps", result="hit_l2")
+            if not route.ok:
+                self._stats["negative_hits"] += 1
+            return route
+
+    def put(self, origin: str, destination: str, km: float, mins: float,
+            mode: str = "driving", ok: bool = True) -> None:
+        key = cache_key(origin, destination, mode)
+        expires_at = time.time() + (self.ttl if ok else self.neg_ttl)
+        route = CachedRoute(km=km, mins=mins, ok=ok, expires_at=expires_at)
+        with self._lock:
+            self._l1_put(key, route)
+            self._stats["stores"] += 1
+        try:
+            with self._db() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO distance_cache"
+                    " (cache_key, origin, destination, mode, km, mins, ok, expires_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, origin, destination, mode, km, mins, int(ok), expires_at),
+                )
+        except sqlite3.Error as e:
+            logger.error(f"[maps_cache] 寫入失敗：{e}")
+
+    def purge_expired(self) -> int:
+        try:
+            return get_db(self.db_path).execute("DELETE FROM distance_cache WHERE expires_at<=?", (time.time(),))
+        except sqlite3.Error as e:
+            logger.error(f"[maps_cache] 清除失敗：{e}")
+            return 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+            s["l1_size"] = len(self._l1)
+        lookups = s["l1_hits"] + s["l2_hits"] + s["misses"]
+        s["hit_rate"] = round((s["l1_hits"] + s["l2_hits"]) / lookups, 3) if lookups else 0.0
+        return s
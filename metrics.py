@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+modules/metrics.py — v6.3.0
+輕量指標與追蹤（不依賴 prometheus_client）：
+1. Counter / Gauge / Histogram，支援 label；render() 輸出 Prometheus text format 給 /metrics。
+2. span("ocr")：量測各階段耗時，寫入 delivery_stage_seconds{stage=...}。
+3. request ID：contextvars 保存，RequestIdFilter 讓每行 log 帶上 %(request_id)s；
+   JobQueue 入列時複製 context，worker 執行緒內沿用同一個 ID。
+4. 多行程（gunicorn）：設定 METRICS_MULTIPROC_DIR 後，各行程每 METRICS_FLUSH_SEC 秒把自己的值寫成
+   <dir>/<pid>.json（start_flusher()，worker 結束時再寫一次）；render() 合併目錄內所有檔案：
+   counter / histogram 加總（已結束的 worker 也算），gauge 只取仍存活的行程並加上 pid label。
+   沒設定時只輸出本行程的值。
+"""
+
+import os
+import abc
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+METRICS_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")
+METRICS_FLUSH_SEC = float(os.getenv("METRICS_FLUSH_SEC", "5"))
+
+# ───────────────────────────────────────────────
+# Request ID
+# ───────────────────────────────────────────────
+_request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default="-")
+
+def new_request_id(rid: Optional[str] = None) -> str:
+    rid = rid or uuid.uuid4().hex[:12]
+    _request_id.set(rid)
+    return rid
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+class RequestIdFilter(logging.Filter):
+    """掛在 handler 上，為每筆 record 補 request_id 屬性"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = _request_id.get()
+        return True
+
+
+# ───────────────────────────────────────────────
+# 指標
+# ───────────────────────────────────────────────
+LabelKey = Tuple[str, ...]
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self, items: Optional[List[Tuple[LabelKey, Any]]] = None,
+               labelnames: Optional[Sequence[str]] = None) -> List[str]:
+        """items 為 snapshot() 格式（例如多行程合併後的值）；省略時輸出本行程的值"""
+        items = self.snapshot() if items is None else items
+        return ([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+                + self._samples(items, tuple(labelnames or self.labelnames)))
+
+    @abc.abstractmethod
+    def snapshot(self) -> List[Tuple[LabelKey, Any]]:
+        """目前的值，依 label 排序"""
+
+    @abc.abstractmethod
+    def _samples(self, items: List[Tuple[LabelKey, Any]], labelnames: Tuple[str, ...]) -> List[str]:
+        ...
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def snapshot(self) -> List[Tuple[LabelKey, float]]:
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _samples(self, items, labelnames) -> List[str]:
+        return [f"{self.name}{_fmt_labels(labelnames, k)} {_fmt_num(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+        self._funcs: Dict[LabelKey, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], float], **labels: str) -> None:
+        """render 時才呼叫 fn 取值（例如佇列深度）"""
+        with self._lock:
+            self._funcs[self._key(labels)] = fn
+
+    def snapshot(self) -> List[Tuple[LabelKey, float]]:
+        with self._lock:
+            values = dict(self._values)
+            funcs = dict(self._funcs)
+        for k, fn in funcs.items():
+            try:
+                values[k] = float(fn())
+            except Exception:
+                continue
+        return sorted(values.items())
+
+    def _samples(self, items, labelnames) -> List[str]:
+        return [f"{self.name}{_fmt_labels(labelnames, k)} {_fmt_num(v)}" for k, v in items]
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key → [各 bucket 計數..., sum, count]
+        self._values: Dict[LabelKey, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def snapshot(self) -> List[Tuple[LabelKey, List[float]]]:
+        with self._lock:
+            return sorted((k, list(v)) for k, v in self._values.items())
+
+    def _samples(self, items, labelnames) -> List[str]:
+        out = []
+        for key, row in items:
+            acc = 0.0
+            for i, b in enumerate(self.buckets):
+                acc += row[i]
+                le = f'le="{_fmt_num(b)}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(labelnames, key, le)} {_fmt_num(acc)}")
+            out.append(f"{self.name}_sum{_fmt_labels(labelnames, key)} {_fmt_num(row[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(labelnames, key)} {_fmt_num(row[-1])}")
+        return out
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+
+    def metrics(self) -> List[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self) -> Dict[str, List[Tuple[LabelKey, Any]]]:
+        return {m.name: m.snapshot() for m in self.metrics()}
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self.metrics():
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+    def render_merged(self, snapshots: Dict[int, Dict[str, list]]) -> str:
+        """snapshots：pid → snapshot()（JSON 讀回，label 為 list）"""
+        alive = {pid for pid in snapshots if _alive(pid)}
+        lines: List[str] = []
+        for m in self.metrics():
+            if m.kind == "gauge":
+                items = sorted((tuple(k) + (str(pid),), v) for pid, snap in snapshots.items() if pid in alive
+                               for k, v in snap.get(m.name, []))
+                lines.extend(m.render(items, m.labelnames + ("pid",)))
+                continue
+            acc: Dict[LabelKey, Any] = {}
+            for snap in snapshots.values():
+                for k, v in snap.get(m.name, []):
+                    k = tuple(k)
+                    if m.kind == "counter":
+                        acc[k] = acc.get(k, 0.0) + v
+                    else:
+                        row = acc.setdefault(k, [0.0] * len(v))
+                        for i, x in enumerate(v):
+                            row[i] += x
+            lines.extend(m.render(sorted(acc.items())))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def render() -> str:
+    """多行程目錄有設定時合併所有行程，否則只有本行程"""
+    if not METRICS_DIR:
+        return REGISTRY.render()
+    write_snapshot()
+    return REGISTRY.render_merged(read_snapshots())
+
+
+# ───────────────────────────────────────────────
+# 多行程彙總
+# ───────────────────────────────────────────────
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def write_snapshot(directory: str = METRICS_DIR) -> None:
+    if not directory:
+        return
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(REGISTRY.snapshot(), f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.getLogger(__name__).warning("[METRICS] 寫入 %s 失敗：%s", path, e)
+
+def read_snapshots(directory: str = METRICS_DIR) -> Dict[int, Dict[str, list]]:
+    out: Dict[int, Dict[str, list]] = {}
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return out
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        if ext != ".json" or not stem.isdigit():
+            continue
+        try:
+            with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                out[int(stem)] = json.load(f)
+        except (OSError, ValueError):
+            continue
+    return out
+
+def reset_dir(directory: str = METRICS_DIR) -> None:
+    """master 啟動時清掉上一輪留下的檔案"""
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith((".json", ".tmp")):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+_FLUSHER: Dict[str, Any] = {}
+
+def start_flusher(interval: float = METRICS_FLUSH_SEC) -> None:
+    """本行程定期寫出快照（fork 後的 worker 各呼叫一次）"""
+    if not METRICS_DIR or _FLUSHER.get("pid") == os.getpid():
+        return
+    stop = threading.Event()
+
+    def loop() -> None:
+        while not stop.wait(interval):
+            write_snapshot()
+
+    t = threading.Thread(target=loop, name="metrics-flush", daemon=True)
+    t.start()
+    _FLUSHER.update(pid=os.getpid(), stop=stop, thread=t)
+
+def stop_flusher() -> None:
+    stop = _FLUSHER.pop("stop", None)
+    if stop is not None:
+        stop.set()
+    write_snapshot()
+
+
+# ───────────────────────────────────────────────
+# 共用指標
+# ───────────────────────────────────────────────
+STAGE_SECONDS = Histogram("delivery_stage_seconds", "各處理階段耗時（秒）", ["stage"])
+STAGE_ERRORS = Counter("delivery_stage_errors_total", "各處理階段例外次數", ["stage"])
+CACHE_LOOKUPS = Counter("delivery_cache_lookups_total", "快取查詢結果", ["cache", "result"])
+OCR_CHARS = Histogram("delivery_ocr_chars", "OCR 擷取字數", buckets=(0, 50, 100, 200, 400, 800, 1600))
+MAPS_REQUESTS = Counter("delivery_maps_requests_total", "Distance Matrix 呼叫結果（status）", ["status"])
+DOWNLOAD_BYTES = Histogram("delivery_download_bytes", "下載圖片大小（bytes）",
+                           buckets=(64 << 10, 256 << 10, 512 << 10, 1 << 20, 2 << 20, 4 << 20, 8 << 20, 16 << 20))
+DOWNLOAD_REJECTED = Counter("delivery_download_rejected_total", "超過大小上限而拒收的圖片")
+DISTANCE_SOURCE = Counter("delivery_distance_source_total", "報告距離來源（maps / prefilter / fallback / triage / none）", ["source"])
+
+_log = logging.getLogger(__name__)
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """量測一段處理耗時；例外會計數後照常往外丟"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        _log.debug("[SPAN] %s %.1fms", stage, elapsed * 1000.0)
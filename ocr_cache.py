@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+modules/ocr_cache.py — v6.3.0
+OCR 結果快取（與 delivery_ai.db 同一個 SQLite 檔，連線與表結構由 modules.db 管理）：
+1. 鍵：影像內容 sha256（完全相同）+ 256-bit dHash（重新壓縮、近似重傳）。
+2. 值：OCR 文字與抽取結果（平台、金額、取餐、送達）。只有 sha256 完全相同才直接沿用、略過 Tesseract；
+   dHash 近似命中（同平台、同店家的不同訂單版面與地圖幾乎一樣）必須通過呼叫端的 verify()
+   （例如低解析度掃描的金額一致）才沿用，沒給 verify 就不查近似。
+3. dHash 切成 8 段 32-bit 建索引；漢明距離 ≤ 7 必有一段完全相同，只比對這些候選。
+4. LRU（last_hit_at）上限 + TTL（created_at）淘汰；提供命中率計數。
+"""
+
+import os
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+from PIL import Image
+
+from modules.blob import open_image
+from modules.db import get_db
+from modules.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+OCR_CACHE_DB = os.getenv("OCR_CACHE_DB", "delivery_ai.db")
+OCR_CACHE_MAX = int(os.getenv("OCR_CACHE_MAX", "5000"))
+OCR_CACHE_TTL = float(os.getenv("OCR_CACHE_TTL_DAYS", "30")) * 86400
+# 近似重傳的漢明距離上限（256 bits 中）
+OCR_CACHE_MAX_DIST = int(os.getenv("OCR_CACHE_MAX_DIST", "6"))
+
+_HASH_W, _HASH_H = 17, 16        # dHash：16x16 個水平梯度 = 256 bits
+_BANDS = 8                       # 8 段 × 32 bits
+_EVICT_EVERY = 50                # 每寫入 N 筆檢查一次淘汰
+
+
+@dataclass
+class ImageKeys:
+    sha256: str
+    phash: Optional[int] = None          # 256-bit 整數；影像無法解碼時為 None
+
+
+@dataclass
+class OCRResult:
+    ocr_text: str
+    platform: str = ""
+    amount: float = 0.0
+    pickup: str = ""
+    dropoff: str = ""
+
+
+def dhash(image_bytes: bytes) -> Optional[int]:
+    """256-bit difference hash；解碼失敗回傳 None"""
+    try:
+        img = open_image(image_bytes)
+        img.draft("L", (_HASH_W * 8, _HASH_H * 8))   # JPEG 直接以縮小比例解碼
+        small = img.convert("L").resize((_HASH_W, _HASH_H), Image.BILINEAR)
+    except Exception as e:
+        logger.warning(f"[OCR_CACHE] dHash 失敗：{e}")
+        return None
+    px = list(small.getdata())
+    bits = 0
+    for y in range(_HASH_H):
+        row = px[y * _HASH_W:(y + 1) * _HASH_W]
+        for x in range(_HASH_W - 1):
+            bits = (bits << 1) | (1 if row[x] > row[x + 1] else 0)
+    return bits
+
+def _to_result(row) -> OCRResult:
+    return OCRResult(ocr_text=row[1], platform=row[2] or "", amount=row[3] or 0.0,
+                     pickup=row[4] or "", dropoff=row[5] or "")
+
+def _bands(h: int):
+    return [(h >> (32 * i)) & 0xFFFFFFFF for i in range(_BANDS)]
+
+
+class OCRCache:
+    def __init__(self, db_path: str = OCR_CACHE_DB, max_entries: int = OCR_CACHE_MAX,
+                 ttl: float = OCR_CACHE_TTL, max_dist: int = OCR_CACHE_MAX_DIST):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_dist = max_dist
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {"hits_exact": 0, "hits_near": 0, "near_rejected": 0, "misses": 0, "stores": 0,
+                       "evictions": 0}
+
+    def _db(self) -> sqlite3.Connection:
+        return get_db(self.db_path).conn()
+
+    # ───────────────────────────────────────────
+    # 查詢 / 寫入
+    # ───────────────────────────────────────────
+    def keys_for(self, image_bytes: bytes) -> ImageKeys:
+        return ImageKeys(sha256=hashlib.sha256(image_bytes).hexdigest(), phash=dhash(image_bytes))
+
+    def get(self, keys: ImageKeys, verify: Optional[Callable[[OCRResult], bool]] = None) -> Optional[OCRResult]:
+        """sha256 完全相同直接回傳；否則 dHash 最接近的候選通過 verify(候選) 才回傳"""
+        now = time.time()
+        min_created = now - self.ttl
+        cols = "sha256, ocr_text, platform, amount, pickup, dropoff"
+        try:
+            with self._lock:
+                db = self._db()
+                row = db.execute(
+                    f"SELECT {cols} FROM ocr_cache WHERE sha256=? AND created_at>=?",
+                    (keys.sha256, min_created),
+                ).fetchone()
+                kind = "hits_exact"
+                if row is None and verify is not None and keys.phash is not None:
+                    row = self._near(db, keys.phash, min_created, cols)
+                    kind = "hits_near"
+            result = _to_result(row) if row is not None else None
+            if result is not None and kind == "hits_near" and not verify(result):
+                logger.info("[OCR_CACHE] 近似候選 %s 未通過驗證，不沿用", row[0][:12])
+                kind, result = "near_rejected", None
+            with self._lock:
+                if result is None:
+                    if kind == "near_rejected":
+                        self._stats["near_rejected"] += 1
+                    self._stats["misses"] += 1
+                    CACHE_LOOKUPS.inc(cache="ocr", result="miss")
+                    return None
+                db = self._db()
+                db.execute("UPDATE ocr_cache SET last_hit_at=?, hits=hits+1 WHERE sha256=?", (now, row[0]))
+                db.commit()
+                self._stats[kind] += 1
+                CACHE_LOOKUPS.inc(cache="ocr", result=kind)
+        except sqlite3.Error as e:
+            logger.error(f"[OCR_CACHE] 查詢失敗：{e}")
+            return None
+        logger.info("[OCR_CACHE] 命中（%s）%s", kind, row[0][:12])
+        return result
+
+    def _near(self, db: sqlite3.Connection, phash: int, min_created: float, cols: str):
+        bands = _bands(phash)
+        where = " OR ".join(f"b{i}=?" for i in range(_BANDS))
+        best, best_d = None, self.max_dist + 1
+        for row in db.execute(
+            f"SELECT phash, {cols} FROM ocr_cache WHERE ({where}) AND created_at>=?",
+            (*bands, min_created),
+        ):
+            if not row[0]:
+                continue
+            d = bin(int(row[0], 16) ^ phash).count("1")
+            if d < best_d:
+                best, best_d = row[1:], d
+        return best
+
+    def put(self, keys: ImageKeys, result: OCRResult) -> None:
+        if not result.ocr_text:
+            return
+        now = time.time()
+        bands = _bands(keys.phash) if keys.phash is not None else [None] * _BANDS
+        phash = f"{keys.phash:064x}" if keys.phash is not None else None
+        try:
+            with self._lock:
+                db = self._db()
+                db.execute(
+                    "INSERT OR REPLACE INTO ocr_cache (sha256, phash, b0, b1, b2, b3, b4, b5, b6, b7,"
+                    " ocr_text, platform, amount, pickup, dropoff, created_at, last_hit_at, hits)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                    (keys.sha256, phash, *bands, result.ocr_text, result.platform, result.amount,
+                     result.pickup, result.dropoff, now, now),
+                )
+                self._stats["stores"] += 1
+                self._writes += 1
+                if self._writes % _EVICT_EVERY == 0:
+                    self._evict(db, now)
+                db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"[OCR_CACHE] 寫入失敗：{e}")
+
+    def _evict(self, db: sqlite3.Connection, now: float) -> None:
+        n = db.execute("DELETE FROM ocr_cache WHERE created_at<?", (now - self.ttl,)).rowcount
+        n += db.execute(
+            "DELETE FROM ocr_cache WHERE sha256 IN ("
+            " SELECT sha256 FROM ocr_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        if n:
+            self._stats["evictions"] += n
+            logger.info(f"[OCR_CACHE] 淘汰 {n} 筆")
+
+    # ───────────────────────────────────────────
+    # 統計
+    # ───────────────────────────────────────────
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        lookups = s["hits_exact"] + s["hits_near"] + s["misses"]
+        s["hit_rate"] = round((s["hits_exact"] + s["hits_near"]) / lookups, 3) if lookups else 0.0
+        return s
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+modules/ocr_engine.py — v6.3.0
+專用 OCR 引擎：
+1. ProcessPoolExecutor（預設 = CPU 核心數），worker 啟動時預熱 Tesseract
+   （載入 chi_tra+eng 語言資料），OCR 不再佔用 Flask/worker 執行緒的 GIL。
+2. 前處理：灰階 → 依目標 DPI 縮圖 → Otsu 二值化。
+3. ROI：先以低解析度快速掃描定位「送餐資訊」/「(O)」錨點，
+   再只對錨點所在的地址區塊做目標解析度辨識；找不到錨點時整張辨識。
+4. 提供 recognize()（單張）、recognize_batch()（批次）與 submit()（非阻塞，附耗時）。
+5. scan()：只做第 3 點的低解析度掃描，回傳行座標與文字（modules.triage 用來先判斷金額/平台）；
+   結果可再傳給 recognize(lines=...)，目標解析度辨識時不重掃。
+   read_amount()：以目標解析度只辨識掃描到的金額行（eng、單行、數字白名單），分流拒單前確認金額。
+6. recognize_layout()：同樣的前處理與 ROI，但以 image_to_data 一次取得字詞座標與信心值，
+   回傳 modules.layout.Layout（低信心字詞已濾掉），地址依錨點位置抽取。
+   app 只在 OCR_LAYOUT=1 時使用（預設關閉：bench 黃金語料的 ocr_data 上準確率尚未勝過逐行文字抽取）。
+7. recognize_template()：低解析度掃描的行符合平台樣板（modules.ocr_templates）時，只裁出金額/地址等小區域，
+   各區域以各自的語言與 psm 同時辨識（tesseract 是子行程，執行緒即可平行）；不符合回 None。
+   recognize_order()：app 的單張訂單入口，一次 worker 呼叫內 前處理 → （掃描）→ 樣板比對、裁切、解析，
+   樣板不符或欄位不完整時在同一張前處理後的圖上改做版面或整頁辨識；影像只傳送、前處理各一次。
+8. 同時執行的 tesseract 數以 OCR_HOST_SLOTS 為上限（預設 CPU 核心數）：號誌於 import 時以 OCR_MP_CONTEXT
+   的 context 建立（fork context 的號誌傳不進 spawn 行程池），行程池子行程由 initializer 傳入；
+   gunicorn preload 後 fork 的 worker 繼承同一個，所以上限涵蓋同一個 master 底下的所有 worker 與其行程池。
+   各自啟動的服務（另一個 gunicorn master、uvicorn）各有自己的號誌，彼此不共用。
+   每個 tesseract 各自載入語言資料，上限同時限制了 CPU 與記憶體。
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from PIL import Image
+import pytesseract
+
+from modules.blob import open_image
+from modules.layout import Layout, from_data as layout_from_data
+from modules.ocr_templates import (
+    AMOUNT_WHITELIST, TemplateResult, get_registry as get_template_registry, parse as parse_template_fields,
+)
+
+logger = logging.getLogger(__name__)
+
+# ───────────────────────────────────────────────
+# 參數（環境變數可覆寫）
+# ───────────────────────────────────────────────
+OCR_LANG = os.getenv("OCR_LANG", "chi_tra+eng")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300"))
+# 手機截圖多半沒有 DPI 資訊；iPhone @3x 約 460 ppi
+OCR_ASSUME_DPI = int(os.getenv("OCR_ASSUME_DPI", "460"))
+OCR_ROI = os.getenv("OCR_ROI", "1") == "1"
+OCR_MP_CONTEXT = os.getenv("OCR_MP_CONTEXT", "spawn")
+OCR_LAYOUT = os.getenv("OCR_LAYOUT", "0") == "1"
+OCR_HOST_SLOTS = int(os.getenv("OCR_HOST_SLOTS", str(os.cpu_count() or 1)))
+
+# ROI 掃描用的縮小比例與上下留白（以掃描圖行高為單位）
+_SCAN_SCALE = 0.5
+_ROI_PAD_ABOVE = 1.5
+_ROI_PAD_BELOW = 6.0
+
+_DROP_ANCHOR = "送餐資訊"
+_PICK_ANCHORS = ("(O)", "O)")
+
+# 必須與行程池同一個 context，否則傳給 spawn 子行程時 RuntimeError
+_SLOTS = (multiprocessing.get_context(OCR_MP_CONTEXT).BoundedSemaphore(OCR_HOST_SLOTS)
+          if OCR_HOST_SLOTS > 0 else None)
+
+
+@contextmanager
+def _slot():
+    """佔用一個主機層級的 tesseract 名額；等待超過 OCR_TIMEOUT 丟 TimeoutError"""
+    if _SLOTS is None:
+        yield
+        return
+    if not _SLOTS.acquire(timeout=OCR_TIMEOUT):
+        raise TimeoutError(f"等待 OCR 名額逾時（OCR_HOST_SLOTS={OCR_HOST_SLOTS}）")
+    try:
+        yield
+    finally:
+        _SLOTS.release()
+
+def _image_to_string(img: Image.Image, **kwargs) -> str:
+    with _slot():
+        return pytesseract.image_to_string(img, **kwargs)
+
+def _image_to_data(img: Image.Image, **kwargs) -> Dict[str, list]:
+    with _slot():
+        return pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT, **kwargs)
+
+
+# ───────────────────────────────────────────────
+# 前處理
+# ───────────────────────────────────────────────
+def _source_dpi(img: Image.Image) -> float:
+    dpi = img.info.get("dpi")
+    if dpi and dpi[0] and dpi[0] > 72:
+        return float(dpi[0])
+    return float(OCR_ASSUME_DPI)
+
+def _otsu_threshold(gray: Image.Image) -> int:
+    hist = gray.histogram()[:256]
+    total = sum(hist)
+    if not total:
+        return 128
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    sum_b = 0.0
+    w_b = 0
+    best_t, best_var = 128, -1.0
+    for t, h in enumerate(hist):
+        w_b += h
+        if w_b == 0:
+            continue
+        w_f = total - w_b
+        if w_f == 0:
+            break
+        sum_b += t * h
+        m_b = sum_b / w_b
+        m_f = (sum_all - sum_b) / w_f
+        var = w_b * w_f * (m_b - m_f) ** 2
+        if var > best_var:
+            best_var, best_t = var, t
+    return best_t
+
+def preprocess(img: Image.Image, target_dpi: int = OCR_TARGET_DPI) -> Image.Image:
+    """灰階 → 縮到目標 DPI（只縮不放）→ 二值化"""
+    gray = img.convert("L")
+    scale = target_dpi / _source_dpi(img)
+    if scale < 1.0:
+        w, h = gray.size
+        gray = gray.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+    t = _otsu_threshold(gray)
+    return gray.point(lambda p, t=t: 255 if p > t else 0)
+
+def _postprocess(text: str) -> str:
+    return re.sub(r"[ \t]+", " ", text).replace("臺", "台")
+
+
+# ───────────────────────────────────────────────
+# ROI 定位
+# ───────────────────────────────────────────────
+def _scan_lines(img: Image.Image) -> List[Tuple[int, int, str]]:
+    """低解析度掃描，回傳 [(top, bottom, line_text)]（座標為 img 座標）"""
+    data = _image_to_data(img, lang=OCR_LANG, config=f"--dpi {int(OCR_TARGET_DPI * _SCAN_SCALE)}")
+    lines: Dict[Tuple[int, int, int], List[int]] = {}
+    for i, word in enumerate(data["text"]):
+        if not (word or "").strip():
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(i)
+    out = []
+    for idxs in lines.values():
+        top = min(data["top"][i] for i in idxs)
+        bottom = max(data["top"][i] + data["height"][i] for i in idxs)
+        text = " ".join(data["text"][i] for i in idxs)
+        out.append((top, bottom, text))
+    out.sort(key=lambda x: x[0])
+    return out
+
+def _locate_roi(lines: List[Tuple[int, int, str]], height: int) -> Optional[Tuple[int, int]]:
+    """找出包含 (O) 與 送餐資訊 錨點的垂直區段"""
+    hits = []
+    for top, bottom, text in lines:
+        t = text.replace(" ", "")
+        if _DROP_ANCHOR in t or t.startswith(_PICK_ANCHORS):
+            hits.append((top, bottom))
+    if not hits:
+        return None
+    line_h = max(1, sum(b - t for t, b in hits) // len(hits))
+    top = max(0, int(min(t for t, _ in hits) - _ROI_PAD_ABOVE * line_h))
+    bottom = min(height, int(max(b for _, b in hits) + _ROI_PAD_BELOW * line_h))
+    return top, bottom
+
+
+# ───────────────────────────────────────────────
+# Worker（於子行程內執行）
+# ───────────────────────────────────────────────
+def _warmup() -> None:
+    """載入 tesseract 與語言資料，讓第一張圖不用付冷啟動成本"""
+    try:
+        pytesseract.get_tesseract_version()
+        _image_to_string(Image.new("L", (64, 32), 255), lang=OCR_LANG)
+    except Exception as e:
+        logger.warning(f"[OCR] 預熱失敗：{e}")
+
+def _init_worker(slots) -> None:
+    """行程池 initializer：改用父行程的主機名額號誌，再預熱"""
+    global _SLOTS
+    _SLOTS = slots
+    _warmup()
+
+def _prepare(image_bytes: bytes) -> Image.Image:
+    img = open_image(image_bytes)
+    img.load()
+    return preprocess(img)
+
+def _scan_prepared(prepared: Image.Image) -> List[Tuple[int, int, str]]:
+    """低解析度掃描；座標換回 prepared 的尺度"""
+    w, h = prepared.size
+    small = prepared.resize((max(1, int(w * _SCAN_SCALE)), max(1, int(h * _SCAN_SCALE))))
+    return [(int(t / _SCAN_SCALE), int(b / _SCAN_SCALE), s) for t, b, s in _scan_lines(small)]
+
+def _scan(image_bytes: bytes) -> List[Tuple[int, int, str]]:
+    return _scan_prepared(_prepare(image_bytes))
+
+def _read_amount(image_bytes: bytes, box: Tuple[int, int]) -> str:
+    """box 為掃描行的 (top, bottom)（prepared 座標），上下各留半行高"""
+    prepared = _prepare(image_bytes)
+    w, h = prepared.size
+    top, bottom = box
+    pad = max(1, (bottom - top) // 2)
+    crop = prepared.crop((0, max(0, top - pad), w, min(h, bottom + pad)))
+    config = f"--dpi {OCR_TARGET_DPI} --psm 7 -c tessedit_char_whitelist={AMOUNT_WHITELIST}"
+    return _image_to_string(crop, lang="eng", config=config).strip()
+
+def _recognize(image_bytes: bytes, use_roi: bool = OCR_ROI,
+               lines: Optional[List[Tuple[int, int, str]]] = None) -> str:
+    return _recognize_prepared(_prepare(image_bytes), use_roi, lines)
+
+def _recognize_prepared(prepared: Image.Image, use_roi: bool = OCR_ROI,
+                        lines: Optional[List[Tuple[int, int, str]]] = None) -> str:
+    config = f"--dpi {OCR_TARGET_DPI}"
+
+    if use_roi:
+        w, h = prepared.size
+        if lines is None:
+            lines = _scan_prepared(prepared)
+        roi = _locate_roi(lines, h)
+        if roi:
+            top, bottom = roi
+            roi_text = _image_to_string(prepared.crop((0, top, w, bottom)), lang=OCR_LANG, config=config)
+            # 錨點區塊外（金額、平台標記等）沿用掃描結果
+            before = [s for t, b, s in lines if b <= top]
+            after = [s for t, b, s in lines if t >= bottom]
+            return _postprocess("\n".join(before + [roi_text.strip()] + after))
+
+    return _postprocess(_image_to_string(prepared, lang=OCR_LANG, config=config))
+
+def _recognize_layout(image_bytes: bytes, use_roi: bool = OCR_ROI,
+                      lines: Optional[List[Tuple[int, int, str]]] = None) -> Layout:
+    return _recognize_layout_prepared(_prepare(image_bytes), use_roi, lines)
+
+def _recognize_layout_prepared(prepared: Image.Image, use_roi: bool = OCR_ROI,
+                               lines: Optional[List[Tuple[int, int, str]]] = None) -> Layout:
+    w, h = prepared.size
+    top, bottom = 0, h
+    outside: List[Tuple[int, int, str]] = []
+    if use_roi:
+        if lines is None:
+            lines = _scan_prepared(prepared)
+        roi = _locate_roi(lines, h)
+        if roi:
+            top, bottom = roi
+            outside = [(t, b, s) for t, b, s in lines if b <= top or t >= bottom]
+    img = prepared.crop((0, top, w, bottom)) if (top, bottom) != (0, h) else prepared
+    data = _image_to_data(img, lang=OCR_LANG, config=f"--dpi {OCR_TARGET_DPI}")
+    return layout_from_data(data, w, h, y_offset=top, extra=outside)
+
+def _recognize_template(image_bytes: bytes,
+                        lines: Optional[List[Tuple[int, int, str]]] = None) -> Optional[Tuple[str, str, Dict[str, str]]]:
+    """回傳 (樣板名稱, 平台, {欄位: 文字})；沒有符合的樣板時回 None"""
+    return _recognize_template_prepared(_prepare(image_bytes), lines)
+
+def _recognize_template_prepared(prepared: Image.Image, lines: Optional[List[Tuple[int, int, str]]] = None
+                                 ) -> Optional[Tuple[str, str, Dict[str, str]]]:
+    w, h = prepared.size
+    if lines is None:
+        lines = _scan_prepared(prepared)
+    hit = get_template_registry().match(lines, w, h)
+    if hit is None:
+        return None
+    tpl, boxes = hit
+    regions = {r.name: r for r in tpl.regions}
+    with ThreadPoolExecutor(max_workers=len(boxes)) as ex:
+        futures = {
+            name: ex.submit(_image_to_string, prepared.crop(box), lang=regions[name].lang,
+                            config=regions[name].config(OCR_TARGET_DPI))
+            for name, box in boxes.items()
+        }
+        texts = {name: _postprocess(f.result()).strip() for name, f in futures.items()}
+    return tpl.name, tpl.platform, texts
+
+class OrderOCR(NamedTuple):
+    """recognize_order() 的結果：template / layout / text 三者擇一"""
+    lines: List[Tuple[int, int, str]]
+    template: Optional[TemplateResult] = None
+    layout: Optional[Layout] = None
+    text: str = ""
+    template_miss: str = ""         # 樣板符合但欄位不完整時的樣板名稱
+
+def _recognize_order(image_bytes: bytes, lines: Optional[List[Tuple[int, int, str]]] = None,
+                     use_template: bool = True, use_layout: bool = False, use_roi: bool = OCR_ROI) -> OrderOCR:
+    prepared = _prepare(image_bytes)
+    if lines is None and (use_template or use_roi):
+        lines = _scan_prepared(prepared)
+    lines = lines or []
+    miss = ""
+    if use_template and lines:
+        hit = _recognize_template_prepared(prepared, lines)
+        if hit is not None:
+            result = parse_template_fields(*hit)
+            if result is not None:
+                return OrderOCR(lines, template=result)
+            miss = hit[0]
+    if use_layout:
+        return OrderOCR(lines, layout=_recognize_layout_prepared(prepared, use_roi, lines), template_miss=miss)
+    return OrderOCR(lines, text=_recognize_prepared(prepared, use_roi, lines), template_miss=miss)
+
+def _recognize_timed(image_bytes: bytes) -> Tuple[str, float]:
+    """回傳 (文字, 子行程內實際辨識秒數)"""
+    t0 = time.perf_counter()
+    text = _recognize(image_bytes)
+    return text, time.perf_counter() - t0
+
+
+# ───────────────────────────────────────────────
+# Engine
+# ───────────────────────────────────────────────
+class OCREngine:
+    """OCR 行程池；workers=0 時於呼叫端行程內直接辨識（除錯用；gunicorn 多行程模式的預設）。"""
+
+    def __init__(self, workers: int = OCR_WORKERS, timeout: float = OCR_TIMEOUT):
+        self.workers = max(0, workers)
+        self.timeout = timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                ctx = multiprocessing.get_context(OCR_MP_CONTEXT)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=ctx, initializer=_init_worker, initargs=(_SLOTS,)
+                )
+                self._pid = os.getpid()
+                logger.info(f"[OCR] 行程池啟動：{self.workers} workers（{OCR_MP_CONTEXT}）")
+            return self._pool
+
+    def _reset(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _call(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        try:
+            return self._get_pool().submit(fn, *args).result(timeout=self.timeout)
+        except BrokenProcessPool:
+            self._reset()
+            raise
+
+    def recognize(self, image_bytes: bytes, lines: Optional[List[Tuple[int, int, str]]] = None) -> str:
+        """單張辨識（阻塞直到結果回來或逾時）；lines 為先前 scan() 的結果時略過 ROI 掃描"""
+        return self._call(_recognize, image_bytes, OCR_ROI, lines)
+
+    def recognize_layout(self, image_bytes: bytes,
+                         lines: Optional[List[Tuple[int, int, str]]] = None) -> Layout:
+        """單張辨識，回傳含字詞座標的版面"""
+        return self._call(_recognize_layout, image_bytes, OCR_ROI, lines)
+
+    def recognize_template(self, image_bytes: bytes, lines: Optional[List[Tuple[int, int, str]]] = None
+                           ) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        """樣板區域辨識；不符合任何樣板時回 None"""
+        return self._call(_recognize_template, image_bytes, lines)
+
+    def recognize_order(self, image_bytes: bytes, lines: Optional[List[Tuple[int, int, str]]] = None,
+                        use_template: bool = True, use_layout: bool = False) -> OrderOCR:
+        """單張訂單：樣板 → 版面/整頁 一次 worker 呼叫完成"""
+        return self._call(_recognize_order, image_bytes, lines, use_template, use_layout, OCR_ROI)
+
+    def scan(self, image_bytes: bytes) -> List[Tuple[int, int, str]]:
+        """只做低解析度掃描，回傳 [(top, bottom, line_text)]"""
+        return self._call(_scan, image_bytes)
+
+    def read_amount(self, image_bytes: bytes, box: Tuple[int, int]) -> str:
+        """以目標解析度辨識金額行（box 為 scan() 的 top, bottom）"""
+        return self._call(_read_amount, image_bytes, box)
+
+    def recognize_batch(self, images: Sequence[bytes]) -> List[str]:
+        """批次辨識，結果順序與輸入相同；單張失敗回傳空字串"""
+        if self.workers == 0:
+            return [_recognize(b) for b in images]
+        pool = self._get_pool()
+        futures = [pool.submit(_recognize, b) for b in images]
+        out: List[str] = []
+        for f in futures:
+            try:
+                out.append(f.result(timeout=self.timeout))
+            except BrokenProcessPool:
+                self._reset()
+                raise
+            except Exception as e:
+                logger.error(f"[OCR] 批次單張失敗：{e}")
+                out.append("")
+        return out
+
+    def submit(self, image_bytes: bytes) -> "Future[Tuple[str, float]]":
+        """非阻塞送出；Future 結果為 (文字, 辨識秒數)，不含排隊時間"""
+        if self.workers == 0:
+            fut: Future = Future()
+            try:
+                fut.set_result(_recognize_timed(image_bytes))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
+        return self._get_pool().submit(_recognize_timed, image_bytes)
+
+    def warmup(self) -> None:
+        """預先建立行程池（worker 各自執行 _warmup）"""
+        if self.workers:
+            pool = self._get_pool()
+            list(pool.map(int, range(self.workers)))
+        else:
+            _warmup()
+
+    def shutdown(self) -> None:
+        self._reset()
+
+
+_ENGINE: Optional[OCREngine] = None
+_ENGINE_LOCK = threading.Lock()
+
+def get_engine() -> OCREngine:
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = OCREngine()
+        return _ENGINE
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+modules/ocr_templates.py — v6.3.0
+各平台訂單畫面的區域樣板：
+1. Template 以「平台 + 螢幕長寬比」登記，內含各欄位（amount / pickup / dropoff / distance）的相對矩形，
+   以及每個欄位辨識用的語言、頁面分割模式（psm）與字元白名單（金額只認數字）。
+2. 比對用低解析度掃描的行（ocr_engine.scan）：長寬比在容許範圍內、平台標記字詞出現、錨點（例如「送餐資訊」）找得到；
+   地圖卡片高度會隨地址行數變動，所有矩形依錨點實際位置整體上下平移。
+3. 內建 Foodpanda（iPhone 19.5:9 截圖量得）；其他平台/機型寫在 data/ocr_templates.json（OCR_TEMPLATES_PATH），
+   格式同 Template.to_dict()，啟動時載入，同名覆寫內建。
+4. parse()：區域文字 → 金額、地址；任何必要欄位不成立、或取餐與送達是同一個地址（區域裁錯）就回 None，
+   由呼叫端改走整頁辨識（整頁抽取有去重複）。
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from modules.address_extract import cleanup_line, same_key, score_address
+from modules.features import AMOUNT_HI, AMOUNT_LO
+from modules.postal_lookup import normalize_address
+
+logger = logging.getLogger(__name__)
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+OCR_TEMPLATES_PATH = os.getenv("OCR_TEMPLATES_PATH", os.path.join(_DATA_DIR, "ocr_templates.json"))
+OCR_TEMPLATES = os.getenv("OCR_TEMPLATES", "1") == "1"
+# 錨點位置與樣板差超過此比例（佔畫面高度）視為不同版面
+_MAX_SHIFT = 0.15
+
+_AMOUNT_RE = re.compile(r"\d+(?:\.\d{1,2})?")
+_KM_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(?:公里|km)", re.IGNORECASE)
+_MIN_ADDR_SCORE = 3
+
+Box = Tuple[int, int, int, int]
+
+
+@dataclass(frozen=True)
+class Region:
+    name: str
+    box: Tuple[float, float, float, float]         # (left, top, right, bottom)，皆為畫面寬/高的比例
+    lang: str = "chi_tra+eng"
+    psm: int = 6
+    whitelist: str = ""
+
+    def config(self, dpi: int) -> str:
+        cfg = f"--dpi {dpi} --psm {self.psm}"
+        if self.whitelist:
+            cfg += f" -c tessedit_char_whitelist={self.whitelist}"
+        return cfg
+
+
+@dataclass
+class Template:
+    name: str
+    platform: str
+    aspect: float                                   # 高 ÷ 寬
+    anchor: str
+    anchor_y: float                                 # 樣板量測時錨點行的 top（比例）
+    regions: Tuple[Region, ...]
+    markers: Tuple[str, ...] = ()
+    aspect_tol: float = 0.1
+
+    def match(self, lines: Sequence[Tuple[int, int, str]], width: int, height: int) -> Optional[float]:
+        """符合時回傳錨點相對樣板的垂直位移（比例），否則 None"""
+        if not width or abs(height / width - self.aspect) > self.aspect_tol:
+            return None
+        compact = [(top, text.replace(" ", "")) for top, _, text in lines]
+        if self.markers and not any(m in t for _, t in compact for m in self.markers):
+            return None
+        top = next((t for t, s in compact if self.anchor in s), None)
+        if top is None:
+            return None
+        shift = top / height - self.anchor_y
+        return shift if abs(shift) <= _MAX_SHIFT else None
+
+    def boxes(self, width: int, height: int, shift: float = 0.0) -> Dict[str, Box]:
+        out = {}
+        for r in self.regions:
+            l, t, rt, b = r.box
+            out[r.name] = (int(l * width), max(0, int((t + shift) * height)),
+                           int(rt * width), min(height, int((b + shift) * height)))
+        return out
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Template":
+        regions = tuple(Region(r["name"], tuple(r["box"]), r.get("lang", "chi_tra+eng"), int(r.get("psm", 6)),
+                               r.get("whitelist", "")) for r in d["regions"])
+        return cls(d["name"], d["platform"], float(d["aspect"]), d["anchor"], float(d["anchor_y"]), regions,
+                   tuple(d.get("markers", ())), float(d.get("aspect_tol", 0.1)))
+
+
+# ───────────────────────────────────────────────
+# 內建樣板
+# ───────────────────────────────────────────────
+AMOUNT_WHITELIST = "0123456789.$"
+
+BUILTIN_TEMPLATES: Tuple[Template, ...] = (
+    # 1125×2436：金額在地圖卡片頂端，(△) 取餐地址、「送餐資訊」下方為送達地址
+    Template(
+        name="foodpanda_19.5x9", platform="Foodpanda", aspect=2.165,
+        anchor="送餐資訊", anchor_y=0.7725, markers=("上線中", "拒絕", "接受訂單"),
+        regions=(
+            Region("amount", (0.18, 0.578, 0.82, 0.637), lang="eng", psm=7, whitelist=AMOUNT_WHITELIST),
+            Region("pickup", (0.13, 0.705, 0.99, 0.765)),
+            Region("dropoff", (0.13, 0.803, 0.99, 0.872)),
+        ),
+    ),
+)
+
+
+class TemplateRegistry:
+    def __init__(self, templates: Sequence[Template] = ()):
+        self._templates: Dict[str, Template] = {}
+        self._lock = threading.Lock()
+        for t in templates:
+            self.register(t)
+
+    def register(self, template: Template) -> None:
+        with self._lock:
+            self._templates[template.name] = template
+
+    def load_json(self, path: str) -> int:
+        """載入 [Template.to_dict(), ...]；檔案不存在回傳 0"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            items = json.load(f)
+        n = 0
+        for d in items:
+            try:
+                self.register(Template.from_dict(d))
+                n += 1
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"[TPL] 樣板格式錯誤，略過：{e}")
+        logger.info(f"[TPL] 載入 {n} 個樣板：{path}")
+        return n
+
+    def templates(self) -> List[Template]:
+        with self._lock:
+            return list(self._templates.values())
+
+    def match(self, lines: Sequence[Tuple[int, int, str]], width: int,
+              height: int) -> Optional[Tuple[Template, Dict[str, Box]]]:
+        """位移最小的符合樣板與其各區域像素座標"""
+        best = None
+        for t in self.templates():
+            shift = t.match(lines, width, height)
+            if shift is not None and (best is None or abs(shift) < abs(best[1])):
+                best = (t, shift)
+        if best is None:
+            return None
+        t, shift = best
+        return t, t.boxes(width, height, shift)
+
+
+_REGISTRY: Optional[TemplateRegistry] = None
+_REGISTRY_LOCK = threading.Lock()
+
+def get_registry() -> TemplateRegistry:
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            reg = TemplateRegistry(BUILTIN_TEMPLATES)
+            try:
+                reg.load_json(OCR_TEMPLATES_PATH)
+            except (OSError, ValueError) as e:
+                logger.error(f"[TPL] 讀取 {OCR_TEMPLATES_PATH} 失敗：{e}")
+            _REGISTRY = reg
+        return _REGISTRY
+
+
+# ───────────────────────────────────────────────
+# 區域文字 → 欄位
+# ───────────────────────────────────────────────
+@dataclass
+class TemplateResult:
+    template: str
+    platform: str
+    amount: float
+    pickup: str
+    dropoff: str
+    distance_km: float = 0.0
+    texts: Dict[str, str] = field(default_factory=dict)
+
+
+def _address(text: str) -> str:
+    s = normalize_address(cleanup_line(text.replace("\n", "")))
+    return s if score_address(s) >= _MIN_ADDR_SCORE else ""
+
+def parse(template: str, platform: str, texts: Dict[str, str]) -> Optional[TemplateResult]:
+    m = _AMOUNT_RE.search(texts.get("amount", "").replace(" ", ""))
+    amount = float(m.group(0)) if m else 0.0
+    pickup, dropoff = _address(texts.get("pickup", "")), _address(texts.get("dropoff", ""))
+    if not (AMOUNT_LO <= amount <= AMOUNT_HI) or not pickup or not dropoff:
+        return None
+    if same_key(pickup) == same_key(dropoff):
+        logger.info("[TPL] %s 取餐與送達相同（%s），不採用樣板結果", template, pickup)
+        return None
+    km = _KM_RE.search(texts.get("distance", ""))
+    return TemplateResult(template, platform, amount, pickup, dropoff,
+                          float(km.group(1)) if km else 0.0, dict(texts))
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+modules/order_store.py — v6.3.0
+訂單歷史（SQLite，預設 delivery_ai.db 的 orders 表）：
+1. 寫入不在回覆路徑上：record() 只把資料放進有界佇列，由背景執行緒累積成批、
+   每 ORDER_STORE_BATCH 筆或 ORDER_STORE_FLUSH_MS 毫秒以一個交易寫入；佇列滿時丟棄並計數。
+2. WAL + synchronous=NORMAL（modules.db）：寫入批次不擋讀取查詢，也不必每筆 fsync。
+3. 表結構在 modules.db 的遷移 v4；索引：時間（含彙總欄位的覆蓋索引）、平台+時間、取餐/送達地點+時間；
+   小時統計、熱門取餐點、黑名單命中率在百萬筆等級仍只掃時間範圍內的索引。
+4. 地點以正規化鍵分組（忽略空白、標點、臺/台與 (△) 等標記）。
+"""
+
+import os
+import re
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from dataclasses import astuple, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from modules.db import get_db
+
+logger = logging.getLogger(__name__)
+
+ORDER_STORE_DB = os.getenv("ORDER_STORE_DB", "delivery_ai.db")
+ORDER_STORE_ENABLED = os.getenv("ORDER_STORE_ENABLED", "1") == "1"
+ORDER_STORE_BATCH = int(os.getenv("ORDER_STORE_BATCH", "200"))
+ORDER_STORE_FLUSH_MS = float(os.getenv("ORDER_STORE_FLUSH_MS", "500"))
+ORDER_STORE_QUEUE = int(os.getenv("ORDER_STORE_QUEUE", "10000"))
+
+_INSERT = (
+    "INSERT INTO orders (created_at, hour_of_day, request_id, platform, amount, km, mins, earning_per_km,"
+    " distance_source, pickup, dropoff, pickup_key, dropoff_key, blacklist, blacklist_hit)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+_LOC_STRIP = re.compile(r"[\s,，:：()（）△▲○●]+")
+
+# check_blacklist 的非命中結果；其餘字串視為命中名單
+_BL_MISS = "未命中"
+_BL_UNKNOWN = ("資料庫不存在", "檢查失敗", "")
+
+
+def location_key(addr: str) -> str:
+    if not addr or "辨識中" in addr:
+        return ""
+    return _LOC_STRIP.sub("", addr.replace("臺", "台"))
+
+def _range(since: Optional[float], until: Optional[float]):
+    return (since if since is not None else 0.0), (until if until is not None else time.time() + 1.0)
+
+
+@dataclass
+class OrderRecord:
+    created_at: float
+    hour_of_day: int
+    request_id: str
+    platform: str
+    amount: float
+    km: float
+    mins: float
+    earning_per_km: float
+    distance_source: str
+    pickup: str
+    dropoff: str
+    pickup_key: str
+    dropoff_key: str
+    blacklist: str
+    blacklist_hit: Optional[int] = field(default=None)
+
+    @classmethod
+    def build(cls, platform: str, amount: float, pickup: str, dropoff: str, km: float, mins: float,
+              blacklist: str, distance_source: str = "", request_id: str = "",
+              created_at: Optional[float] = None) -> "OrderRecord":
+        ts = time.time() if created_at is None else created_at
+        hit = None if blacklist in _BL_UNKNOWN else int(blacklist != _BL_MISS)
+        return cls(ts, time.localtime(ts).tm_hour, request_id, platform, float(amount), float(km), float(mins),
+                   round(amount / km, 2) if km > 0 else 0.0, distance_source, pickup, dropoff,
+                   location_key(pickup), location_key(dropoff), blacklist, hit)
+
+
+class OrderStore:
+    def __init__(self, db_path: str = ORDER_STORE_DB, batch_size: int = ORDER_STORE_BATCH,
+                 flush_ms: float = ORDER_STORE_FLUSH_MS, maxsize: int = ORDER_STORE_QUEUE):
+        self.db_path = db_path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.001, flush_ms / 1000.0)
+        self.maxsize = max(1, maxsize)
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=self.maxsize)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._stats = {"recorded": 0, "written": 0, "batches": 0, "dropped": 0, "errors": 0}
+
+    # ───────────────────────────────────────────
+    # 寫入
+    # ───────────────────────────────────────────
+    def start(self) -> None:
+        """啟動背景寫入執行緒（可重複呼叫）；fork 後的子行程會重建佇列與執行緒"""
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid is not None and self._pid != pid:
+                self._q = queue.Queue(maxsize=self.maxsize)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._writer, name="order-store", daemon=True)
+            self._thread.start()
+
+    def record(self, rec: OrderRecord) -> bool:
+        """非阻塞；佇列已滿時丟棄並回傳 False"""
+        self.start()
+        try:
+            self._q.put_nowait(rec)
+        except queue.Full:
+            with self._lock:
+                self._stats["dropped"] += 1
+                dropped = self._stats["dropped"]
+            if dropped % 1000 == 1:
+                logger.warning("[ORDERS] 寫入佇列已滿（%d），已丟棄 %d 筆訂單", self.maxsize, dropped)
+            return False
+        with self._lock:
+            self._stats["recorded"] += 1
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等目前佇列內的資料全部寫入（測試、批次結束、關機時用）"""
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        try:
+            self._q.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        self.flush(timeout)
+        if self._thread is not None and self._pid == os.getpid():
+            self._q.put(None)
+            self._thread.join(timeout)
+        with self._lock:
+            self._thread = None
+
+    def _writer(self) -> None:
+        conn = get_db(self.db_path).conn()      # 寫入執行緒專用的連線
+        batch: List[OrderRecord] = []
+        waiters: List[threading.Event] = []
+        stop = False
+        while not stop:
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = self.flush_interval if deadline is None else deadline - time.monotonic()
+                if batch and timeout <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=timeout if batch else None)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch:
+                self._write(conn, batch)
+                batch = []
+            for ev in waiters:
+                ev.set()
+            waiters = []
+
+    def _write(self, conn: sqlite3.Connection, batch: List[OrderRecord]) -> None:
+        t0 = time.perf_counter()
+        try:
+            with conn:
+                conn.executemany(_INSERT, [astuple(r) for r in batch])
+        except sqlite3.Error as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            logger.error(f"[ORDERS] 批次寫入失敗（{len(batch)} 筆）：{e}")
+            return
+        with self._lock:
+            self._stats["written"] += len(batch)
+            self._stats["batches"] += 1
+        logger.debug("[ORDERS] 寫入 %d 筆 / %.1fms", len(batch), (time.perf_counter() - t0) * 1000.0)
+
+    # ───────────────────────────────────────────
+    # 查詢
+    # ───────────────────────────────────────────
+    def _query(self, sql: str, params: tuple) -> List[tuple]:
+        return get_db(self.db_path).query(sql, params)
+
+    def earnings_by_hour(self, since: Optional[float] = None, until: Optional[float] = None,
+                         platform: Optional[str] = None) -> List[Dict[str, Any]]:
+        """依時段（0–23 時）彙總：單數、總金額、總公里、每公里收益（總金額 ÷ 總公里）"""
+        lo, hi = _range(since, until)
+        sql = ("SELECT hour_of_day, COUNT(*), SUM(amount), SUM(km)"
+               " FROM orders WHERE created_at >= ? AND created_at < ? AND km > 0")
+        params: tuple = (lo, hi)
+        if platform:
+            sql += " AND platform = ?"
+            params += (platform,)
+        sql += " GROUP BY hour_of_day ORDER BY hour_of_day"
+        return [{"hour": hour, "orders": n, "amount": round(amount, 2), "km": round(km, 2),
+                 "earning_per_km": round(amount / km, 2) if km else 0.0}
+                for hour, n, amount, km in self._query(sql, params)]
+
+    def top_pickups(self, limit: int = 10, since: Optional[float] = None,
+                    until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """最常出現的取餐地點與其平均每公里收益"""
+        lo, hi = _range(since, until)
+        rows = self._query(
+            "SELECT MIN(pickup), COUNT(*) AS n, SUM(amount), SUM(km)"
+            " FROM orders WHERE created_at >= ? AND created_at < ? AND pickup_key != ''"
+            " GROUP BY pickup_key ORDER BY n DESC LIMIT ?",
+            (lo, hi, max(1, limit)),
+        )
+        return [{"pickup": pickup, "orders": n, "earning_per_km": round(amount / km, 2) if km else 0.0}
+                for pickup, n, amount, km in rows]
+
+    def blacklist_hit_rate(self, since: Optional[float] = None,
+                           until: Optional[float] = None) -> Dict[str, Any]:
+        """各平台黑名單命中率（不含無法檢查的訂單）"""
+        lo, hi = _range(since, until)
+        rows = self._query(
+            "SELECT platform, COUNT(blacklist_hit), SUM(blacklist_hit)"
+            " FROM orders WHERE created_at >= ? AND created_at < ? GROUP BY platform",
+            (lo, hi),
+        )
+        by_platform = {platform: {"checked": checked, "hits": hits or 0,
+                                  "hit_rate": round((hits or 0) / checked, 4) if checked else 0.0}
+                       for platform, checked, hits in rows}
+        checked = sum(v["checked"] for v in by_platform.values())
+        hits = sum(v["hits"] for v in by_platform.values())
+        return {"checked": checked, "hits": hits, "hit_rate": round(hits / checked, 4) if checked else 0.0,
+                "platforms": by_platform}
+
+    def route_history(self, pickup: str, dropoff: str, source: str = "maps") -> Optional[Tuple[float, float]]:
+        """同一取餐/送達地點過去（預設只看 Maps 結果）最短的一筆 (公里, 分鐘)"""
+        pk, dk = location_key(pickup), location_key(dropoff)
+        if not pk or not dk:
+            return None
+        row = get_db(self.db_path).query_one(
+            "SELECT km, mins FROM orders WHERE pickup_key = ? AND dropoff_key = ? AND distance_source = ?"
+            " AND km > 0 ORDER BY km LIMIT 1",
+            (pk, dk, source),
+        )
+        return (row[0], row[1]) if row else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        s["pending"] = self._q.qsize()
+        return s
+
+
+_STORE: Optional[OrderStore] = None
+_STORE_LOCK = threading.Lock()
+
+def get_store() -> OrderStore:
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = OrderStore()
+        return _STORE
@@ -6,45 +6,103 @@ modules/postal_lookup.py — v6.2.3-patch2
    - 移除前導逗號、郵遞區號、台灣/臺灣字樣。
    - 修正門牌號碼連寫或分隔（367,369 → 367號）。
 2. 保留原先 _load_zip_db()、normalize_address()、pick_best_addr() 等結構。
+v6.3.0：道路比對改用預建索引（Aho–Corasick，ROAD → CITY/ZIPCODE），
+        一次掃過地址找出所有道路；取最長者，同長取最早出現、城市已在地址中者、表格順序在前者。
+        郵遞區號表改讀編譯後的 data/zipcodes.sqlite（modules.zipdb），執行期不再需要 pandas。
 """
 
-import os
 import re
-import pandas as pd
+import threading
+from typing import NamedTuple, Optional
+
 import logging
 
+from modules.aho import Automaton
+from modules.zipdb import ZipTable, load_table
+from modules.metrics import span
+
 # ───────────────────────────────────────────────
 # Logger
 # ───────────────────────────────────────────────
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 # ───────────────────────────────────────────────
 # 郵遞區號資料庫快取
 # ───────────────────────────────────────────────
 ZIP_DF = None
 
-def _load_zip_db() -> pd.DataFrame:
-    """載入 data/zipcodes.xlsx"""
+def _load_zip_db() -> ZipTable:
+    """載入郵遞區號表（data/zipcodes.xlsx 編譯後的 sqlite；xlsx 有變動會自動重建）"""
     global ZIP_DF
     if ZIP_DF is not None:
         return ZIP_DF
 
-    data_path = os.path.join("data", "zipcodes.xlsx")
-    if not os.path.exists(data_path):
-        logger.error(f"zipcodes.xlsx 不存在於 {data_path}")
-        raise FileNotFoundError(f"缺少郵遞區號資料表 {data_path}")
-
     try:
-        df = pd.read_excel(data_path, dtype=str)
-        df.columns = [c.strip().upper() for c in df.columns]
-        ZIP_DF = df
-        logger.info(f"zipcodes.xlsx 已載入，共 {len(df)} 筆資料")
-        return df
+        table = load_table()
+        ZIP_DF = table
+        logger.info(f"zipcodes 已載入，共 {len(table)} 筆資料")
+        return table
+    except FileNotFoundError as e:
+        logger.error(str(e))
+        raise
     except Exception as e:
-        logger.error(f"讀取 zipcodes.xlsx 失敗：{e}")
+        logger.error(f"讀取 zipcodes 失敗：{e}")
         raise
 
+# ───────────────────────────────────────────────
+# 道路索引
+# ───────────────────────────────────────────────
+class RoadHit(NamedTuple):
+    road: str
+    city: str
+    zipcode: str
+    order: int          # 在 zipcodes 表中的列序
+
+_ROAD_INDEX: Optional[Automaton] = None
+_PREFIX_INDEX: Optional[Automaton] = None
+_INDEX_LOCK = threading.Lock()
+
+def _str(v) -> str:
+    return v if isinstance(v, str) else ""
+
+def _build_indexes() -> None:
+    """由 zipcodes 表建道路全名索引與道路前兩字索引（fuzzy_match_city 用）"""
+    global _ROAD_INDEX, _PREFIX_INDEX
+    with _INDEX_LOCK:
+        if _ROAD_INDEX is not None:
+            return
+        df = _load_zip_db()
+        roads, prefixes = Automaton(), Automaton()
+        for i, (road, city, zipc) in enumerate(zip(df["ROAD"], df["CITY"], df["ZIPCODE"])):
+            road = _str(road)
+            if not road:
+                continue
+            hit = RoadHit(road, _str(city), _str(zipc), i)
+            roads.add(road, hit)
+            prefixes.add(road[:2], hit)
+        _PREFIX_INDEX = prefixes.build()
+        _ROAD_INDEX = roads.build()
+        logger.info(f"道路索引建立完成：{len(roads)} 筆")
+
+def _best_hit(index: Automaton, addr: str) -> Optional[RoadHit]:
+    best, best_key = None, None
+    for m in index.iter(addr):
+        hit = m.value
+        key = (-(m.end - m.start), m.start, 0 if hit.city and hit.city in addr else 1, hit.order)
+        if best_key is None or key < best_key:
+            best, best_key = hit, key
+    return best
+
+def lookup_road(addr: str) -> Optional[RoadHit]:
+    """地址中最長的道路名稱與其 CITY / ZIPCODE；無命中回 None"""
+    if not addr:
+        return None
+    if _ROAD_INDEX is None:
+        with span("zip_index_build"):
+            _build_indexes()
+    with span("zip_lookup"):
+        return _best_hit(_ROAD_INDEX, addr)
+
 # ───────────────────────────────────────────────
 # 地址正規化
 # ───────────────────────────────────────────────
@@ -75,26 +133,18 @@ def compose_clean_address(addr: str) -> str:
                   r"\1", r"\1", addr)
 
     # 4. 從郵遞區號表比對補全
-    df = _load_zip_db()
-    hit = df[df["ROAD"].apply(lambda r: isinstance(r, str) and r in addr)]
-    if not hit.empty:
-        city = hit.iloc[0]["CITY"]
-        zipc = hit.iloc[0]["ZIPCODE"]
-        if city and city not in addr:
-            return f"{city}{addr}"
-        return addr
+    hit = lookup_road(addr)
+    if hit and hit.city and hit.city not in addr:
+        return f"{hit.city}{addr}"
     return addr
 
 def enrich_address(addr: str) -> str:
     """若缺城市，嘗試從道路比對補上"""
     if not addr:
         return addr
-    df = _load_zip_db()
-    for _, row in df.iterrows():
-        if isinstance(row["ROAD"], str) and row["ROAD"] in addr:
-            city = row.get("CITY", "")
-            if city and city not in addr:
-                return f"{city}{addr}"
+    hit = lookup_road(addr)
+    if hit and hit.city and hit.city not in addr:
+        return f"{hit.city}{addr}"
     return addr
 
 # ───────────────────────────────────────────────
@@ -135,8 +185,9 @@ def fuzzy_match_city(addr: str) -> str:
     """當 OCR 缺城市時，嘗試從郵遞區號表模糊補上"""
     if not addr:
         return addr
-    df = _load_zip_db()
-    for _, row in df.iterrows():
-        if isinstance(row["ROAD"], str) and row["ROAD"][:2] in addr:
-            return f"{row['CITY']}{addr}"
+    if _PREFIX_INDEX is None:
+        _build_indexes()
+    hit = _best_hit(_PREFIX_INDEX, addr)
+    if hit:
+        return f"{hit.city}{addr}"
     return addr
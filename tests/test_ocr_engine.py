@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+tests/test_ocr_engine.py
+OCR 行程池（預設 spawn）實際啟動：主機名額號誌要能經 initializer 傳進子行程，
+並以 1 個 worker 辨識 repo 內的截圖。需要 Pillow / pytesseract；辨識另需 tesseract 執行檔。
+"""
+
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("PIL")
+pytest.importorskip("pytesseract")
+
+os.environ.setdefault("OCR_MP_CONTEXT", "spawn")
+
+from modules.ocr_engine import OCREngine
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE = os.path.join(ROOT_DIR, "IMG_4088.PNG")
+
+
+@pytest.fixture
+def engine():
+    eng = OCREngine(workers=1, timeout=120)
+    yield eng
+    eng.shutdown()
+
+
+def test_spawn_pool_starts_with_slots(engine):
+    # initializer 收到號誌失敗時，行程池會變成 BrokenProcessPool
+    pid = engine._get_pool().submit(os.getpid).result(timeout=120)
+    assert pid != os.getpid()
+
+
+@pytest.mark.skipif(shutil.which("tesseract") is None, reason="需要 tesseract 執行檔")
+def test_spawn_pool_recognizes_image(engine):
+    with open(IMAGE, "rb") as f:
+        text = engine.recognize(f.read())
+    assert "送餐資訊" in text.replace(" ", "")
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+modules/triage.py — v6.3.0
+分流：完整辨識、地址補全、Maps 之前先判斷「最好情況也不划算」的訂單。
+1. 輸入為 OCR 低解析度掃描的文字（modules.ocr_engine.scan，ROI 定位本來就要做的那一趟），
+   取平台、金額、畫面上的公里數，以及低解析度下抽得到的取餐/送達地址。
+2. 依序找「最短可能距離」，任何一階段算出 金額 ÷ 最短距離 < 平台門檻（analysis.threshold_for）就拒單：
+   header   畫面上的 xx 公里（平台自己給的路程）
+   cache    Maps 快取（同一組地址先前查過）
+   history  orders 表中同一組取餐/送達地點以 Maps 取得的最短距離
+   estimate 區中心離線估算的最短可能距離 min_km（直線 − 兩區半徑，與預篩相同的下界）
+   header / cache 為實際距離，達門檻即放行，不再往下查。
+3. 金額來自半解析度掃描，可能少讀一位小數或錯字：拒單前以 confirm(金額) 回呼（app 以目標解析度
+   重新辨識金額那一行）確認，讀不到或不一致就放行，交給完整流程。
+4. 拒單時省下的階段（full_ocr / enrich / maps）逐一計數；stats() 提供各階段的略過比例。
+"""
+
+import os
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from modules.analysis import threshold_for
+from modules.address_extract import extract as extract_address_result
+from modules.distance_estimate import (
+    SOURCE_MAPS, SOURCE_TRIAGE, estimate as estimate_distance,
+)
+from modules.features import Features, scan as scan_features
+from modules.maps import DISTANCE_CACHE, normalize_address as maps_normalize
+from modules.metrics import DISTANCE_SOURCE, Counter
+from modules.order_store import get_store as get_order_store
+from modules.postal_lookup import compose_clean_address
+
+logger = logging.getLogger(__name__)
+
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "1") == "1"
+TRIAGE_USE_HISTORY = os.getenv("TRIAGE_USE_HISTORY", "1") == "1"
+
+STAGES = ("header", "cache", "history", "estimate")
+# 拒單時略過的後段處理
+SKIPPED_ON_REJECT = ("full_ocr", "enrich", "maps")
+
+TRIAGE_DECISIONS = Counter("delivery_triage_decisions_total", "分流各階段判定（reject / pass / unknown）",
+                           ["stage", "result"])
+TRIAGE_SKIPPED = Counter("delivery_triage_skipped_total", "分流拒單而略過的處理階段", ["stage"])
+
+_LOCK = threading.Lock()
+_STATS = {"orders": 0, "rejected": 0}
+
+
+@dataclass
+class Verdict:
+    reject: bool
+    stage: str                      # 做出判定的階段；放行且無結論時為 ""
+    platform: str
+    amount: float
+    threshold: float
+    km: float = 0.0                 # 最短可能距離
+    mins: float = 0.0
+    pickup: str = ""
+    dropoff: str = ""
+    features: Optional[Features] = field(default=None, repr=False)
+
+    @property
+    def earning_per_km(self) -> float:
+        return round(self.amount / self.km, 2) if self.km > 0 else 0.0
+
+
+def _addresses(text: str) -> Tuple[str, str]:
+    pickup, dropoff = extract_address_result(text).pair
+    if "辨識中" in pickup or "辨識中" in dropoff or pickup == dropoff:
+        return "", ""
+    return pickup, dropoff
+
+def _header(feats: Features, pickup: str, dropoff: str) -> Optional[Tuple[float, float]]:
+    kms = [v for v in feats.distances_km if v > 0]
+    if not kms:
+        return None
+    mins = [v for v in feats.durations_min if v > 0]
+    return min(kms), (min(mins) if mins else 0.0)
+
+def _cache(feats: Features, pickup: str, dropoff: str) -> Optional[Tuple[float, float]]:
+    if not pickup:
+        return None
+    route = DISTANCE_CACHE.get(maps_normalize(compose_clean_address(pickup)),
+                               maps_normalize(compose_clean_address(dropoff)))
+    if route is None or not route.ok or route.km <= 0:
+        return None
+    return route.km, route.mins
+
+def _history(feats: Features, pickup: str, dropoff: str) -> Optional[Tuple[float, float]]:
+    if not pickup or not TRIAGE_USE_HISTORY:
+        return None
+    return get_order_store().route_history(pickup, dropoff, SOURCE_MAPS)
+
+def _estimate(feats: Features, pickup: str, dropoff: str) -> Optional[Tuple[float, float]]:
+    if not pickup:
+        return None
+    est = estimate_distance(pickup, dropoff)
+    if est is None or est.level != "district" or est.min_km <= 0:
+        return None
+    return est.min_km, est.mins * est.min_km / est.km
+
+_LOOKUPS = {"header": _header, "cache": _cache, "history": _history, "estimate": _estimate}
+# 實際距離：達門檻即可放行
+_EXACT = ("header", "cache")
+
+
+def amount_box(lines: List[Tuple[int, int, str]], amount: float) -> Optional[Tuple[int, int]]:
+    """掃描行中讀出此金額的那一行 (top, bottom)"""
+    for top, bottom, text in lines:
+        if scan_features(text).amount == amount:
+            return top, bottom
+    return None
+
+def read_amount(text: str) -> float:
+    """金額行重新辨識的文字 → 金額；讀不到回 0"""
+    return scan_features(text).amount
+
+
+def triage(scan_text: str, confirm: Optional[Callable[[float], bool]] = None) -> Verdict:
+    """依低解析度掃描文字判定；reject=True 時可直接出報告，略過後段。
+    confirm 回傳 False（或拋例外）時不拒單，改為放行"""
+    feats = scan_features(scan_text)
+    threshold = threshold_for(feats.platform)
+    verdict = Verdict(False, "", feats.platform, feats.amount, threshold, features=feats)
+    with _LOCK:
+        _STATS["orders"] += 1
+    if feats.amount <= 0:
+        TRIAGE_DECISIONS.inc(stage="amount", result="unknown")
+        return verdict
+
+    pickup, dropoff = _addresses(scan_text)
+    verdict.pickup, verdict.dropoff = pickup, dropoff
+    for stage in STAGES:
+        try:
+            best = _LOOKUPS[stage](feats, pickup, dropoff)
+        except Exception as e:
+            logger.warning("[TRIAGE] %s 查詢失敗：%s", stage, e)
+            best = None
+        if best is None:
+            TRIAGE_DECISIONS.inc(stage=stage, result="unknown")
+            continue
+        km, mins = best
+        if feats.amount / km < threshold:
+            if confirm is not None and not _confirmed(confirm, feats.amount):
+                TRIAGE_DECISIONS.inc(stage="confirm", result="unknown")
+                logger.info("[TRIAGE] 金額 $%s 無法以完整解析度確認，放行", feats.amount)
+                return verdict
+            TRIAGE_DECISIONS.inc(stage=stage, result="reject")
+            verdict.reject, verdict.stage = True, stage
+            verdict.km, verdict.mins = round(km, 2), round(mins, 1)
+            for skipped in SKIPPED_ON_REJECT:
+                TRIAGE_SKIPPED.inc(stage=skipped)
+            DISTANCE_SOURCE.inc(source=SOURCE_TRIAGE)
+            with _LOCK:
+                _STATS["rejected"] += 1
+            logger.info("[TRIAGE] 拒單（%s）：$%s / 最短 %.2fkm < %s 元/km",
+                        stage, feats.amount, km, threshold)
+            return verdict
+        TRIAGE_DECISIONS.inc(stage=stage, result="pass")
+        if stage in _EXACT:
+            verdict.stage = stage
+            return verdict
+    return verdict
+
+
+def _confirmed(confirm: Callable[[float], bool], amount: float) -> bool:
+    try:
+        return bool(confirm(amount))
+    except Exception as e:
+        logger.warning("[TRIAGE] 金額確認失敗：%s", e)
+        return False
+
+
+def stats() -> Dict[str, Any]:
+    with _LOCK:
+        s: Dict[str, Any] = dict(_STATS)
+    n = s["orders"]
+    s["enabled"] = TRIAGE_ENABLED
+    s["reject_rate"] = round(s["rejected"] / n, 4) if n else 0.0
+    s["skip_rate"] = {st: round(TRIAGE_SKIPPED.value(stage=st) / n, 4) if n else 0.0 for st in SKIPPED_ON_REJECT}
+    s["by_stage"] = {st: {r: int(TRIAGE_DECISIONS.value(stage=st, result=r)) for r in ("reject", "pass", "unknown")}
+                     for st in ("amount",) + STAGES + ("confirm",)}
+    return s
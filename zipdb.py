@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+modules/zipdb.py — v6.3.0
+郵遞區號表編譯：data/zipcodes.xlsx → data/zipcodes.sqlite
+1. 建置：openpyxl 唯讀模式讀取，寫入暫存檔後原子替換；meta 表記錄來源 sha256 / mtime / 大小與列數。
+2. 執行期：唯讀 + immutable 開啟，一次讀出所有列、轉成各欄位的 Python list（每個行程各一份，
+   gunicorn preload 後 fork 才以 copy-on-write 共用）；不需要 pandas。
+3. xlsx 變動（大小/mtime 不同且 sha256 不同）時自動重建；只有 mtime/大小紀錄不同但 sha256 相同時
+   更新 meta，下次啟動不必再算雜湊；無 xlsx 時沿用既有成品。
+
+用法：python -m modules.zipdb build [--force]
+"""
+
+import os
+import sys
+import time
+import hashlib
+import logging
+import sqlite3
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ZIP_XLSX_PATH = os.getenv("ZIP_XLSX_PATH", os.path.join("data", "zipcodes.xlsx"))
+ZIPDB_PATH = os.getenv("ZIPDB_PATH", os.path.join("data", "zipcodes.sqlite"))
+ZIPDB_MMAP = int(os.getenv("ZIPDB_MMAP_BYTES", str(64 * 1024 * 1024)))
+
+_FORMAT_VERSION = "1"
+
+
+class ZipTable:
+    """欄位導向的郵遞區號表：table["ROAD"] → List[str]（缺值為空字串）"""
+
+    def __init__(self, columns: Dict[str, List[str]], meta: Optional[Dict[str, str]] = None):
+        self.columns = columns
+        self.meta = meta or {}
+
+    def __getitem__(self, name: str) -> List[str]:
+        return self.columns[name]
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()), []))
+
+
+# ───────────────────────────────────────────────
+# 建置
+# ───────────────────────────────────────────────
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _quoted(cols: List[str]) -> str:
+    return ", ".join(f'"{c}"' for c in cols)
+
+def _read_meta(db_path: str) -> Dict[str, str]:
+    if not os.path.exists(db_path):
+        return {}
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            return dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+
+def build(xlsx_path: str = ZIP_XLSX_PATH, db_path: str = ZIPDB_PATH) -> int:
+    """編譯 xlsx → sqlite，回傳列數"""
+    from openpyxl import load_workbook
+
+    t0 = time.perf_counter()
+    wb = load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(c or "").strip().upper() for c in next(rows)]
+        cols = [c for c in header if c]
+        idx = [i for i, c in enumerate(header) if c]
+        data = [
+            tuple("" if i >= len(r) or r[i] is None else str(r[i]).strip() for i in idx)
+            for r in rows
+            if r and any(v is not None for v in r)
+        ]
+    finally:
+        wb.close()
+
+    st = os.stat(xlsx_path)
+    meta = {
+        "format": _FORMAT_VERSION,
+        "source_sha256": _sha256(xlsx_path),
+        "source_size": str(st.st_size),
+        "source_mtime_ns": str(st.st_mtime_ns),
+        "rows": str(len(data)),
+        "columns": ",".join(cols),
+        "built_at": str(int(time.time())),
+    }
+
+    tmp = f"{db_path}.tmp{os.getpid()}"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        col_defs = ", ".join(f'"{c}" TEXT' for c in cols)
+        conn.execute(f"CREATE TABLE zipcodes (rowid INTEGER PRIMARY KEY, {col_defs})")
+        placeholders = ", ".join("?" * len(cols))
+        conn.executemany(f"INSERT INTO zipcodes ({_quoted(cols)}) VALUES ({placeholders})", data)
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+        conn.commit()
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(tmp, db_path)
+    logger.info(f"zipcodes 編譯完成：{len(data)} 筆 → {db_path}（{time.perf_counter() - t0:.2f}s）")
+    return len(data)
+
+def _needs_build(xlsx_path: str, db_path: str) -> bool:
+    meta = _read_meta(db_path)
+    if meta.get("format") != _FORMAT_VERSION:
+        return True
+    st = os.stat(xlsx_path)
+    if meta.get("source_size") == str(st.st_size) and meta.get("source_mtime_ns") == str(st.st_mtime_ns):
+        return False
+    # 只有 mtime 變（例如重新 checkout）但內容相同時不重建，記下新的 mtime
+    if meta.get("source_sha256") != _sha256(xlsx_path):
+        return True
+    _touch_meta(db_path, st)
+    return False
+
+def _touch_meta(db_path: str, st: os.stat_result) -> None:
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                             [("source_size", str(st.st_size)), ("source_mtime_ns", str(st.st_mtime_ns))])
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"zipcodes meta 更新失敗（下次啟動會再比對雜湊）：{e}")
+
+def ensure_built(xlsx_path: str = ZIP_XLSX_PATH, db_path: str = ZIPDB_PATH) -> str:
+    """確保成品存在且與 xlsx 一致；回傳成品路徑"""
+    if os.path.exists(xlsx_path):
+        if _needs_build(xlsx_path, db_path):
+            try:
+                build(xlsx_path, db_path)
+            except Exception as e:
+                if not os.path.exists(db_path):
+                    raise
+                logger.error(f"zipcodes 重建失敗，沿用既有成品：{e}")
+    elif not os.path.exists(db_path):
+        raise FileNotFoundError(f"缺少郵遞區號資料表 {xlsx_path} / {db_path}")
+    return db_path
+
+
+# ───────────────────────────────────────────────
+# 執行期載入
+# ───────────────────────────────────────────────
+def open_db(db_path: str = ZIPDB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size={ZIPDB_MMAP}")
+    return conn
+
+def load_table(xlsx_path: str = ZIP_XLSX_PATH, db_path: str = ZIPDB_PATH) -> ZipTable:
+    """讀出整張表（複製成行程內的 list；mmap 只加速這次讀取）"""
+    ensure_built(xlsx_path, db_path)
+    conn = open_db(db_path)
+    try:
+        meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        cols = [c for c in meta.get("columns", "").split(",") if c]
+        rows = conn.execute(f"SELECT {_quoted(cols)} FROM zipcodes ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+    columns = {c: [r[i] or "" for r in rows] for i, c in enumerate(cols)}
+    return ZipTable(columns, meta)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    args = sys.argv[1:]
+    if not args or args[0] != "build":
+        print("usage: python -m modules.zipdb build [--force]")
+        sys.exit(2)
+    if "--force" in args or not os.path.exists(ZIPDB_PATH) or _needs_build(ZIP_XLSX_PATH, ZIPDB_PATH):
+        build()
+    else:
+        print(f"{ZIPDB_PATH} 已是最新")